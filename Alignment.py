@@ -0,0 +1,371 @@
+import re
+import json
+import threading
+from bisect import bisect_left
+import numpy as np
+import gemmi
+from DiskCache import DiskCache, hash_key
+"""
+Fast global alignment of two protein sequences that are expected to be nearly identical. Instead of running the
+O(L1*L2) dynamic programming alignment over the whole sequences, exact k-mer matches that are unique in both sequences
+are used as anchors, and gemmi only aligns the short regions between the anchors. The ends of every anchor are given
+back to the regions around it so that gemmi decides where the gaps next to an anchor go, the same as it does in the full
+alignment. When the anchors cover too little of the sequences (low identity), the full alignment is used instead.
+"""
+
+# Length of the k-mers used as anchors
+ANCHOR_K = 12
+# Number of residues at each end of an anchor that are realigned with the regions around it
+ANCHOR_MARGIN = 8
+# The minimum fraction of the shorter sequence covered by anchors for the anchored alignment to be used
+MIN_ANCHOR_COVERAGE = 0.5
+# Sequences shorter than this are always aligned in full
+MIN_ANCHORED_LENGTH = 100
+
+CIGAR_RE = re.compile(r"(\d+)([MID])")
+
+# The folder of the persistent alignment cache. Bump ALIGNMENT_CACHE_VERSION whenever the alignment can change.
+ALIGNMENT_CACHE_DIR = "./data/cache/alignments"
+ALIGNMENT_CACHE_VERSION = 1
+
+
+class SequenceAlignment:
+    def __init__(self, cigar, match_count, length_1, length_2):
+        """
+        The alignment of two sequences, with the same methods as the gemmi.AlignmentResult that MotionTree uses.
+        :param cigar: List of (length, op) of the alignment. M is aligned residues, I is residues only in sequence 1 and
+        D is residues only in sequence 2.
+        :param match_count: The number of aligned residues that are identical
+        :param length_1: The length of sequence 1
+        :param length_2: The length of sequence 2
+        """
+        self.cigar = cigar
+        self.match_count = match_count
+        self.length_1 = length_1
+        self.length_2 = length_2
+
+    def cigar_str(self):
+        return "".join(f"{length}{op}" for length, op in self.cigar)
+
+    def calculate_identity(self, which=0):
+        if which == 1:
+            length = self.length_1
+        elif which == 2:
+            length = self.length_2
+        else:
+            length = min(self.length_1, self.length_2)
+        return 100 * self.match_count / length if length > 0 else 0
+
+    def add_gaps(self, s, which):
+        gap_op = "D" if which == 1 else "I"
+        parts = []
+        pos = 0
+        for length, op in self.cigar:
+            if op == gap_op:
+                parts.append("-" * length)
+            else:
+                parts.append(s[pos:pos + length])
+                pos += length
+        return "".join(parts)
+
+    def aligned_indices(self):
+        """
+        Get the indices of the aligned residue pairs (the M columns of the alignment).
+        :return: Array of the residue indices in sequence 1 and array of the matching residue indices in sequence 2
+        """
+        indices_1 = []
+        indices_2 = []
+        pos_1, pos_2 = 0, 0
+        for length, op in self.cigar:
+            if op == "M":
+                indices_1.append(np.arange(pos_1, pos_1 + length))
+                indices_2.append(np.arange(pos_2, pos_2 + length))
+            if op != "D":
+                pos_1 += length
+            if op != "I":
+                pos_2 += length
+        if len(indices_1) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(indices_1), np.concatenate(indices_2)
+
+
+def align_sequences(sequence_1, sequence_2, k=ANCHOR_K, margin=ANCHOR_MARGIN):
+    """
+    Aligns two sequences, using the anchored alignment when the sequences share enough exact k-mers and the full gemmi
+    alignment otherwise.
+    :param sequence_1: The one-letter code sequence of protein 1
+    :param sequence_2: The one-letter code sequence of protein 2
+    :param k: The length of the anchor k-mers
+    :param margin: The number of residues at each end of an anchor that are realigned
+    :return: SequenceAlignment or gemmi.AlignmentResult
+    """
+    if sequence_1 == sequence_2:
+        length = len(sequence_1)
+        return SequenceAlignment([(length, "M")] if length > 0 else [], length, length, length)
+    if min(len(sequence_1), len(sequence_2)) < MIN_ANCHORED_LENGTH:
+        return align_full(sequence_1, sequence_2)
+    anchors = find_anchors(sequence_1, sequence_2, k)
+    # Only the middle of each anchor is kept as fixed, so anchors must be longer than both margins
+    anchors = [(i + margin, j + margin, length - 2 * margin) for i, j, length in anchors if length > 2 * margin]
+    covered = sum(length for _, _, length in anchors)
+    if covered < MIN_ANCHOR_COVERAGE * min(len(sequence_1), len(sequence_2)):
+        return align_full(sequence_1, sequence_2)
+    return align_anchored(sequence_1, sequence_2, anchors, margin)
+
+
+def align_full(sequence_1, sequence_2):
+    return gemmi.align_string_sequences(list(sequence_1), list(sequence_2), [])
+
+
+def find_anchors(sequence_1, sequence_2, k):
+    """
+    Finds the exact matches between the sequences made of k-mers that appear once in each sequence. The matches are
+    kept in the same order in both sequences and merged into maximal runs on the same diagonal.
+    :return: List of (start in sequence 1, start in sequence 2, length)
+    """
+    kmers_1 = get_unique_kmers(sequence_1, k)
+    kmers_2 = get_unique_kmers(sequence_2, k)
+    seeds = sorted((i, kmers_2[kmer]) for kmer, i in kmers_1.items() if kmer in kmers_2)
+    seeds = longest_increasing_chain(seeds)
+
+    anchors = []
+    for i, j in seeds:
+        if anchors:
+            start_1, start_2, length = anchors[-1]
+            # The seed continues the previous anchor on the same diagonal
+            if i - start_1 == j - start_2 and i <= start_1 + length:
+                anchors[-1] = (start_1, start_2, i + k - start_1)
+                continue
+            # Seeds overlapping the previous anchor on another diagonal are dropped
+            if i < start_1 + length or j < start_2 + length:
+                continue
+        anchors.append((i, j, k))
+    return anchors
+
+
+def get_unique_kmers(sequence, k):
+    # k-mer -> start of the k-mers that only appear once in the sequence
+    positions = {}
+    repeated = set()
+    for i in range(len(sequence) - k + 1):
+        kmer = sequence[i:i + k]
+        if kmer in positions:
+            repeated.add(kmer)
+        else:
+            positions[kmer] = i
+    for kmer in repeated:
+        del positions[kmer]
+    return positions
+
+
+def longest_increasing_chain(seeds):
+    """
+    Gets the longest chain of seeds whose positions increase in both sequences.
+    :param seeds: List of (position in sequence 1, position in sequence 2) sorted by the position in sequence 1
+    :return: List of seeds
+    """
+    # tails[n] is the index of the seed ending the best chain of length n + 1 found so far
+    tails = []
+    tail_values = []
+    previous = [-1] * len(seeds)
+    for n, (_, j) in enumerate(seeds):
+        pos = bisect_left(tail_values, j)
+        if pos > 0:
+            previous[n] = tails[pos - 1]
+        if pos == len(tails):
+            tails.append(n)
+            tail_values.append(j)
+        else:
+            tails[pos] = n
+            tail_values[pos] = j
+    chain = []
+    n = tails[-1] if tails else -1
+    while n >= 0:
+        chain.append(seeds[n])
+        n = previous[n]
+    return chain[::-1]
+
+
+def align_anchored(sequence_1, sequence_2, anchors, margin=ANCHOR_MARGIN):
+    """
+    Aligns the sequences by joining the anchors with gemmi alignments of the regions between them. A gap at the end of a
+    region could slide into the anchor next to it in the full alignment (e.g. in a run of the same residue), so when a
+    region's alignment starts or ends with a gap, that end of the anchor is given to the region and it is aligned again.
+    :param anchors: List of (start in sequence 1, start in sequence 2, length) in the order of the sequences
+    :param margin: The number of residues given back from an anchor each time
+    :return: SequenceAlignment
+    """
+    anchors = list(anchors)
+    # (start 1, end 1, start 2, end 2) -> cigar of the region, so regions that do not change are not aligned again
+    region_cigars = {}
+    while True:
+        regions = get_anchor_regions(sequence_1, sequence_2, anchors)
+        for region in regions:
+            if region not in region_cigars:
+                region_cigars[region] = align_region(sequence_1, sequence_2, *region)
+        changed = False
+        for n in range(len(anchors)):
+            i, j, length = anchors[n]
+            before = region_cigars[regions[n]]
+            after = region_cigars[regions[n + 1]]
+            trim_start = margin if before and before[-1][1] != "M" else 0
+            trim_end = margin if after and after[0][1] != "M" else 0
+            if trim_start > 0 or trim_end > 0:
+                anchors[n] = (i + trim_start, j + trim_start, length - trim_start - trim_end)
+                changed = True
+        if not changed:
+            break
+        anchors = [anchor for anchor in anchors if anchor[2] > 0]
+
+    cigar = []
+    match_count = 0
+    for n, region in enumerate(regions):
+        for op_length, op in region_cigars[region]:
+            add_cigar_op(cigar, op_length, op)
+        start_1, end_1, start_2, end_2 = region
+        match_count += sum(sequence_1[start_1 + p] == sequence_2[start_2 + q]
+                           for p, q in iter_matched_positions(region_cigars[region]))
+        if n < len(anchors):
+            add_cigar_op(cigar, anchors[n][2], "M")
+            match_count += anchors[n][2]
+    return SequenceAlignment(cigar, match_count, len(sequence_1), len(sequence_2))
+
+
+def get_anchor_regions(sequence_1, sequence_2, anchors):
+    # The (start 1, end 1, start 2, end 2) of the regions before, between and after the anchors
+    regions = []
+    pos_1, pos_2 = 0, 0
+    for i, j, length in anchors:
+        regions.append((pos_1, i, pos_2, j))
+        pos_1, pos_2 = i + length, j + length
+    regions.append((pos_1, len(sequence_1), pos_2, len(sequence_2)))
+    return regions
+
+
+def align_region(sequence_1, sequence_2, start_1, end_1, start_2, end_2):
+    # Cigar list of the alignment of a region
+    if end_1 > start_1 and end_2 > start_2:
+        result = align_full(sequence_1[start_1:end_1], sequence_2[start_2:end_2])
+        return parse_cigar(result.cigar_str())
+    if end_1 > start_1:
+        return [(end_1 - start_1, "I")]
+    if end_2 > start_2:
+        return [(end_2 - start_2, "D")]
+    return []
+
+
+def iter_matched_positions(cigar):
+    # The positions in both sequences of the aligned residues of a cigar
+    pos_1, pos_2 = 0, 0
+    for length, op in cigar:
+        if op == "M":
+            for p in range(length):
+                yield pos_1 + p, pos_2 + p
+        if op != "D":
+            pos_1 += length
+        if op != "I":
+            pos_2 += length
+
+
+def add_cigar_op(cigar, length, op):
+    if length == 0:
+        return
+    if cigar and cigar[-1][1] == op:
+        cigar[-1] = (cigar[-1][0] + length, op)
+    else:
+        cigar.append((length, op))
+
+
+class AlignmentCache:
+    def __init__(self, cache_dir=ALIGNMENT_CACHE_DIR, max_entries=100000, max_bytes=256 * 1024 * 1024):
+        """
+        Persistent cache of the alignments of sequence pairs, keyed by a hash of the two sequences. The cache is shared
+        by every process using the same folder.
+        :param cache_dir: The folder of the cache
+        :param max_entries: The maximum number of alignments kept
+        :param max_bytes: The maximum total size (in bytes) of the cache files
+        """
+        self.disk_cache = DiskCache(cache_dir, ".json", max_entries, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def align(self, sequence_1, sequence_2):
+        """
+        Aligns the sequences, using the cached alignment if the pair has been aligned before. Identical sequences are
+        not aligned or cached at all.
+        :return: SequenceAlignment
+        """
+        if sequence_1 == sequence_2:
+            return align_sequences(sequence_1, sequence_2)
+        key = hash_key(ALIGNMENT_CACHE_VERSION, sequence_1, sequence_2)
+        alignment = self.read(key, sequence_1, sequence_2)
+        with self._lock:
+            if alignment is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if alignment is not None:
+            return alignment
+
+        alignment = to_sequence_alignment(align_sequences(sequence_1, sequence_2), len(sequence_1), len(sequence_2))
+        entry = {
+            "cigar": alignment.cigar_str(),
+            "match_count": alignment.match_count,
+            "lengths": [alignment.length_1, alignment.length_2]
+        }
+        try:
+            self.disk_cache.store(key, lambda path: write_json_file(path, entry))
+        except Exception as e:
+            # Failing to write the cache (e.g. a full disk) is not an error
+            print(e)
+        return alignment
+
+    def read(self, key, sequence_1, sequence_2):
+        path = self.disk_cache.lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "r") as fr:
+                entry = json.load(fr)
+            if entry["lengths"] != [len(sequence_1), len(sequence_2)]:
+                return None
+            return SequenceAlignment(parse_cigar(entry["cigar"]), entry["match_count"], len(sequence_1),
+                                     len(sequence_2))
+        except (OSError, ValueError, KeyError):
+            # Removed or replaced by another process while reading
+            return None
+
+    def configure(self, cache_dir=None, max_entries=None, max_bytes=None):
+        if cache_dir is not None:
+            self.disk_cache.cache_dir = cache_dir
+        if max_entries is not None:
+            self.disk_cache.max_entries = max_entries
+        if max_bytes is not None:
+            self.disk_cache.max_bytes = max_bytes
+
+    def stats(self):
+        stats = self.disk_cache.stats()
+        with self._lock:
+            stats["hits"] = self.hits
+            stats["misses"] = self.misses
+        return stats
+
+
+def to_sequence_alignment(result, length_1, length_2):
+    # Converts a gemmi.AlignmentResult into a SequenceAlignment
+    if isinstance(result, SequenceAlignment):
+        return result
+    return SequenceAlignment(parse_cigar(result.cigar_str()), result.match_count, length_1, length_2)
+
+
+def parse_cigar(cigar_str):
+    return [(int(length), op) for length, op in CIGAR_RE.findall(cigar_str)]
+
+
+def write_json_file(path, data):
+    with open(path, "w") as fw:
+        json.dump(data, fw)
+
+
+alignment_cache = AlignmentCache()
@@ -0,0 +1,213 @@
+import re
+import numpy as np
+import gemmi
+from FileMngr import open_structure_file
+"""
+Lightweight reader for the CA atoms of one chain of a PDB file (optionally gzipped). Instead of building the whole gemmi structure (every
+model, water and ligand), the file is streamed in blocks of lines, only the requested model is kept, and the fixed-column
+ATOM/HETATM records of the requested chain are pulled straight into NumPy arrays.
+
+The residues follow the same rules as gemmi so that index i of the arrays is residue i of the gemmi chain or polymer:
+- A chain is the first contiguous run of atom records with the chain ID in the model.
+- The polymer is made of the residues before the chain's TER record. Without a TER record the chain has no polymer,
+  the same as gemmi.read_pdb.
+"""
+
+BLOCK_SIZE = 1 << 22
+
+# Columns 13-54 of an ATOM/HETATM record
+ATOM_DTYPE = np.dtype([("name", "S4"), ("alt_loc", "S1"), ("res_name", "S3"), ("chain", "S2"), ("seq_num", "S4"),
+                       ("icode", "S1"), ("blank", "S3"), ("x", "S8"), ("y", "S8"), ("z", "S8")])
+# The residue name, chain, sequence number and insertion code columns as one field
+RES_KEY_DTYPE = np.dtype({"names": ["key"], "formats": ["S10"], "offsets": [5], "itemsize": ATOM_DTYPE.itemsize})
+
+
+class CaData:
+    def __init__(self, coords, has_ca, seqids, res_names, icodes, sequence):
+        """
+        The CA atoms of the residues of a protein chain. Index i of every array is residue i of the chain (or polymer).
+        :param coords: Nx3 array of the CA coordinates. Rows of residues without a CA atom are NaN.
+        :param has_ca: Boolean array of whether the residue has a CA atom
+        :param seqids: The residue sequence numbers
+        :param res_names: The residue names
+        :param icodes: The insertion codes of the residues. Empty if there is no insertion code.
+        :param sequence: The one-letter code sequence of the chain
+        """
+        self.coords = coords
+        self.has_ca = has_ca
+        self.seqids = seqids
+        self.res_names = res_names
+        self.icodes = icodes
+        self.sequence = sequence
+
+    def __len__(self):
+        return self.seqids.shape[0]
+
+
+def read_pdb_ca_data(file_path, model_num, chain_id, polymer_only=True):
+    """
+    Reads the CA data of a chain from a PDB file without building a gemmi structure.
+    :param file_path: The path to the PDB file
+    :param model_num: The index of the model in the file (not the MODEL serial number)
+    :param chain_id: The chain ID
+    :param polymer_only: Whether to only use the polymer residues of the chain instead of the whole chain
+    :return: CaData
+    """
+    return parse_ca_data(read_model_block(file_path, model_num), chain_id, polymer_only)
+
+
+def read_pdb_ca_data_models(file_path, chain_id, polymer_only=True):
+    """
+    Reads the CA data of a chain in every model of a PDB file in a single pass over the file.
+    :return: List of CaData, one per model
+    """
+    return [parse_ca_data(model_data, chain_id, polymer_only) for model_data in iter_model_blocks(file_path)]
+
+
+def parse_ca_data(model_data, chain_id, polymer_only=True):
+    """
+    Pulls the CA data of a chain out of the records of one model.
+    :param model_data: The bytes of the model's records
+    :param chain_id: The chain ID
+    :param polymer_only: Whether to only use the polymer residues of the chain instead of the whole chain
+    :return: CaData
+    """
+    # Records are matched from the newline before them, which is much faster than multi-line "^" patterns
+    model_data = b"\n" + model_data
+    chain_data, ter_pos = get_chain_block(model_data, chain_id)
+    atom_re = get_chain_atom_re(chain_id)
+    if ter_pos is None:
+        atoms = atom_re.findall(chain_data)
+        num_before_ter = None
+    else:
+        atoms = atom_re.findall(chain_data, 0, ter_pos)
+        num_before_ter = len(atoms)
+        atoms.extend(atom_re.findall(chain_data, ter_pos))
+    if len(atoms) == 0:
+        raise ValueError(f"Chain {chain_id} not found")
+
+    # Every match is the same 42 columns of the record, so the joined matches can be viewed as a structured array
+    fields = np.frombuffer(b"".join(atoms), dtype=ATOM_DTYPE)
+    res_keys = np.frombuffer(fields.tobytes(), dtype=RES_KEY_DTYPE)["key"]
+    # A new residue starts wherever the residue name, number or insertion code changes
+    is_res_start = np.ones(len(atoms), dtype=bool)
+    is_res_start[1:] = res_keys[1:] != res_keys[:-1]
+    if num_before_ter is not None and num_before_ter < len(atoms):
+        is_res_start[num_before_ter] = True
+    res_starts = np.flatnonzero(is_res_start)
+    atom_res_index = np.cumsum(is_res_start) - 1
+    num_residues = res_starts.shape[0]
+
+    res_names = np.char.strip(fields["res_name"][res_starts]).astype("U5")
+    seqids = fields["seq_num"][res_starts].astype(np.int32)
+    icodes = np.char.strip(fields["icode"][res_starts]).astype("U1")
+
+    # The first atom named CA of each residue
+    ca_atoms = np.flatnonzero(np.char.strip(fields["name"]) == b"CA")
+    ca_res, first = np.unique(atom_res_index[ca_atoms], return_index=True)
+    ca_atoms = ca_atoms[first]
+    coords = np.full((num_residues, 3), np.nan)
+    coords[ca_res, 0] = fields["x"][ca_atoms].astype(np.float64)
+    coords[ca_res, 1] = fields["y"][ca_atoms].astype(np.float64)
+    coords[ca_res, 2] = fields["z"][ca_atoms].astype(np.float64)
+    has_ca = np.zeros(num_residues, dtype=bool)
+    has_ca[ca_res] = True
+
+    if polymer_only:
+        if num_before_ter is None:
+            start, end = 0, 0
+        else:
+            start, end = 0, np.count_nonzero(res_starts < num_before_ter)
+        coords = coords[start:end]
+        has_ca = has_ca[start:end]
+        seqids = seqids[start:end]
+        res_names = res_names[start:end]
+        icodes = icodes[start:end]
+        sequence = gemmi.one_letter_code(first_conformer_names(res_names, seqids, icodes))
+    else:
+        sequence = gemmi.one_letter_code(res_names.tolist())
+    return CaData(coords, has_ca, seqids, res_names, icodes, sequence)
+
+
+def read_model_block(file_path, model_num):
+    """
+    Streams the file and keeps only the lines of the requested model. Reading stops as soon as the model ends.
+    :return: The bytes of the model
+    """
+    for i, model_data in enumerate(iter_model_blocks(file_path)):
+        if i == model_num:
+            return model_data
+    raise IndexError(f"Model {model_num} not found in {file_path}")
+
+
+def iter_model_blocks(file_path):
+    """
+    Streams the file in blocks of whole lines and yields the bytes of each model as soon as the next model starts.
+    Files without MODEL records only have model 0. The lines before the first MODEL record are part of model 0.
+    """
+    parts = []
+    seen_model = False
+    with open_structure_file(file_path) as fr:
+        remainder = b""
+        while True:
+            block = fr.read(BLOCK_SIZE)
+            is_last = len(block) == 0
+            block = remainder + block
+            if is_last:
+                remainder = b""
+            else:
+                cut = block.rfind(b"\n") + 1
+                block, remainder = block[:cut], block[cut:]
+            pos = 0
+            for model_pos in find_record_starts(block, b"MODEL"):
+                parts.append(block[pos:model_pos])
+                if seen_model:
+                    yield b"".join(parts)
+                    parts = []
+                seen_model = True
+                pos = model_pos
+            parts.append(block[pos:])
+            if is_last:
+                break
+    yield b"".join(parts)
+
+
+def find_record_starts(block, record):
+    # Yields the start of every line of the block beginning with the record name
+    if block.startswith(record):
+        yield 0
+    pos = block.find(b"\n" + record)
+    while pos >= 0:
+        yield pos + 1
+        pos = block.find(b"\n" + record, pos + 1)
+
+
+def get_chain_block(model_data, chain_id):
+    """
+    Gets the first contiguous run of atom records of the chain, which is what gemmi treats as the chain.
+    :param model_data: The bytes of the model, starting with a newline
+    :param chain_id: The chain ID
+    :return: The bytes of the chain's records and the position of the chain's TER record in them (or None)
+    """
+    chain_field = re.escape(chain_id.rjust(2).encode())
+    first = re.search(rb"\n(?:ATOM  |HETATM).{14}" + chain_field, model_data)
+    if first is None:
+        raise ValueError(f"Chain {chain_id} not found")
+    other = re.compile(rb"\n(?:ATOM  |HETATM).{14}(?!" + chain_field + rb")").search(model_data, first.start())
+    end = len(model_data) if other is None else other.start()
+    chain_data = model_data[first.start():end]
+    ter_pos = chain_data.find(b"\nTER")
+    return chain_data, None if ter_pos < 0 else ter_pos
+
+
+def get_chain_atom_re(chain_id):
+    chain_field = re.escape(chain_id.rjust(2).encode())
+    # Captures columns 13-54: name, altloc, residue name, chain, sequence number, insertion code, x, y, z
+    return re.compile(rb"\n(?:ATOM  |HETATM).{6}(.{8}" + chain_field + rb".{32})")
+
+
+def first_conformer_names(res_names, seqids, icodes):
+    # Residues sharing the sequence ID of the previous residue are alternative conformations (microheterogeneity)
+    is_first = np.ones(res_names.shape[0], dtype=bool)
+    is_first[1:] = (seqids[1:] != seqids[:-1]) | (icodes[1:] != icodes[:-1])
+    return res_names[is_first].tolist()
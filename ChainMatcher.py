@@ -0,0 +1,191 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import gemmi
+from scipy.optimize import linear_sum_assignment
+from MotionTree import MotionTree
+from StructureCache import structure_cache
+from CoordCache import extract_ca_data_from_structure
+from Alignment import alignment_cache
+from Screening import batch_rmsd_matrix
+from FileMngr import download_structure_file
+"""
+Automatic matching of the chains of two multi-chain structures. Every protein chain of protein 1 is scored against every
+protein chain of protein 2 by sequence identity and by the RMSD of the aligned CA atoms, and motion trees are built for
+the best-matching chain pairs (or every pair passing the thresholds). Each structure is parsed once and the CA data of
+each chain is loaded once, no matter how many chain pairs it is part of.
+"""
+
+PROTEIN_TYPES = [gemmi.PolymerType.PeptideL, gemmi.PolymerType.PeptideD]
+# Chains with fewer polymer residues than this are not treated as protein chains (e.g. peptides)
+MIN_CHAIN_LENGTH = 20
+
+
+class ChainPairScore:
+    def __init__(self, chain_1, chain_2, identity, rmsd, num_residues):
+        """
+        :param chain_1: The chain ID in protein 1
+        :param chain_2: The chain ID in protein 2
+        :param identity: The sequence identity of the chains
+        :param rmsd: The RMSD of the aligned CA atoms after superposition
+        :param num_residues: The number of aligned residues with CA atoms in both chains
+        """
+        self.chain_1 = chain_1
+        self.chain_2 = chain_2
+        self.identity = identity
+        self.rmsd = rmsd
+        self.num_residues = num_residues
+
+    def __repr__(self):
+        return f"{self.chain_1}-{self.chain_2}: identity {round(self.identity, 1)}, RMSD {round(self.rmsd, 3)}"
+
+
+class ChainMatcher:
+    def __init__(self, input_path, output_path, protein_1_name, protein_2_name, spat_prox=7.0, small_node=5,
+                 clust_size=30, magnitude=5, min_identity=90, min_rmsd=1.0, max_workers=None):
+        """
+        :param min_identity: Chain pairs with a lower sequence identity are not matched
+        :param min_rmsd: Chain pairs with a lower RMSD are not matched, as MotionTree rejects them
+        :param max_workers: The number of threads scoring the chain pairs
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        self.protein_1_name = protein_1_name
+        self.protein_2_name = protein_2_name
+        self.spat_prox = spat_prox
+        self.small_node = small_node
+        self.clust_size = clust_size
+        self.magnitude = magnitude
+        self.min_identity = min_identity
+        self.min_rmsd = min_rmsd
+        self.max_workers = max_workers if max_workers is not None else min(8, os.cpu_count() or 1)
+        self.file_path_1 = download_structure_file(input_path, protein_1_name)
+        self.file_path_2 = download_structure_file(input_path, protein_2_name)
+        # Chain ID -> CaData of the protein chains of each structure
+        self.chains_1 = {}
+        self.chains_2 = {}
+        self.scores = []
+
+    def load_chains(self):
+        self.chains_1 = get_protein_chains(self.file_path_1)
+        self.chains_2 = get_protein_chains(self.file_path_2)
+        return list(self.chains_1.keys()), list(self.chains_2.keys())
+
+    def score_pairs(self):
+        """
+        Scores every pair of protein chains of the two structures in parallel.
+        :return: List of ChainPairScore, with the best matches (highest identity, then lowest RMSD) first
+        """
+        if not self.chains_1 or not self.chains_2:
+            self.load_chains()
+        pairs = [(c1, c2) for c1 in self.chains_1 for c2 in self.chains_2]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            scores = list(executor.map(lambda pair: score_chain_pair(*pair, self.chains_1[pair[0]],
+                                                                     self.chains_2[pair[1]]), pairs))
+        self.scores = sorted(scores, key=lambda s: (-s.identity, s.rmsd))
+        return self.scores
+
+    def select_pairs(self, mode="best"):
+        """
+        Selects the chain pairs to build motion trees for.
+        :param mode: "best" matches every chain to at most one chain of the other structure, choosing the assignment with
+        the highest total identity and then the lowest total RMSD. "all" selects every pair passing the identity and
+        RMSD thresholds.
+        :return: List of ChainPairScore
+        """
+        if not self.scores:
+            self.score_pairs()
+        # Pairs with too few aligned residues for a superposition have an infinite RMSD
+        passed = [s for s in self.scores
+                  if s.identity >= self.min_identity and np.isfinite(s.rmsd) and s.rmsd >= self.min_rmsd]
+        if mode == "all":
+            return passed
+        if mode != "best":
+            raise ValueError(f"Unknown chain matching mode: {mode}")
+        if len(passed) == 0:
+            return []
+        # One-to-one assignment of the chains maximising the total identity, with the total RMSD breaking ties
+        chains_1 = sorted({s.chain_1 for s in passed})
+        chains_2 = sorted({s.chain_2 for s in passed})
+        max_cost = 1e9
+        costs = np.full((len(chains_1), len(chains_2)), max_cost)
+        scores = {}
+        for score in passed:
+            i, j = chains_1.index(score.chain_1), chains_2.index(score.chain_2)
+            costs[i, j] = -score.identity * 1e4 + score.rmsd
+            scores[(i, j)] = score
+        rows, cols = linear_sum_assignment(costs)
+        selected = [scores[(i, j)] for i, j in zip(rows, cols) if (i, j) in scores]
+        return sorted(selected, key=lambda s: (-s.identity, s.rmsd))
+
+    def build_motion_tree(self, chain_1, chain_2):
+        """
+        Creates the MotionTree of a chain pair with the chains' CA data already loaded, ready for preprocessing().
+        :return: MotionTree
+        """
+        engine = MotionTree(self.input_path, self.output_path, self.protein_1_name, chain_1, self.protein_2_name,
+                            chain_2, self.spat_prox, self.small_node, self.clust_size, self.magnitude)
+        engine.init_protein(1)
+        engine.init_protein(2)
+        engine.protein_1.ca_data = self.chains_1[chain_1]
+        engine.protein_2.ca_data = self.chains_2[chain_2]
+        return engine
+
+    def run(self, mode="best"):
+        """
+        Builds the motion trees of the selected chain pairs.
+        :param mode: See select_pairs
+        :return: Dictionary of the chain pair to the outputs of MotionTree.run(), or the error if the pair failed
+        """
+        results = {}
+        for score in self.select_pairs(mode):
+            try:
+                engine = self.build_motion_tree(score.chain_1, score.chain_2)
+                engine.preprocessing()
+                engine.dist_mat_processing()
+                engine.create_distance_difference_matrix()
+                results[(score.chain_1, score.chain_2)] = engine.run()
+            except Exception as e:
+                print(e)
+                results[(score.chain_1, score.chain_2)] = e
+        return results
+
+
+def get_protein_chains(file_path):
+    """
+    Loads the CA data of the protein chains of the first model of a structure. The chains and their CA data come from
+    the same parsed structure, so the file is only read once.
+    :param file_path: The path to the structure file
+    :return: Dictionary of the chain ID to the chain's CaData, in the order of the chains in the file
+    """
+    structure = structure_cache.get(file_path)
+    chains = {}
+    for chain in structure[0]:
+        if chain.name in chains:
+            # Another part of a chain that was already seen
+            continue
+        polymer = chain.get_polymer()
+        if len(polymer) < MIN_CHAIN_LENGTH or polymer.check_polymer_type() not in PROTEIN_TYPES:
+            continue
+        chains[chain.name] = extract_ca_data_from_structure(file_path, 0, chain.name)
+    return chains
+
+
+def score_chain_pair(chain_1, chain_2, ca_data_1, ca_data_2):
+    """
+    Scores a pair of chains by their sequence identity and the RMSD of their aligned CA atoms.
+    :return: ChainPairScore
+    """
+    alignment = alignment_cache.align(ca_data_1.sequence, ca_data_2.sequence)
+    identity = min(alignment.calculate_identity(1), alignment.calculate_identity(2))
+    res_ind_1, res_ind_2 = alignment.aligned_indices()
+    in_range = (res_ind_1 < len(ca_data_1)) & (res_ind_2 < len(ca_data_2))
+    res_ind_1 = res_ind_1[in_range]
+    res_ind_2 = res_ind_2[in_range]
+    has_ca = ca_data_1.has_ca[res_ind_1] & ca_data_2.has_ca[res_ind_2]
+    num_residues = int(np.count_nonzero(has_ca))
+    if num_residues < 3:
+        return ChainPairScore(chain_1, chain_2, identity, np.inf, num_residues)
+    coords = np.stack([ca_data_1.coords[res_ind_1[has_ca]], ca_data_2.coords[res_ind_2[has_ca]]])
+    rmsd = batch_rmsd_matrix(coords)[0, 1]
+    return ChainPairScore(chain_1, chain_2, identity, float(rmsd), num_residues)
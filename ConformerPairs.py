@@ -0,0 +1,171 @@
+from collections import OrderedDict
+import gemmi
+from Protein import Protein
+from MotionTree import MotionTree
+from PreprocessedPair import build_preprocessed_pair
+from DistanceMatrix import get_distance_matrix
+from Screening import load_conformers, batch_rmsd_matrix
+from OutputPipeline import wait_for_outputs
+"""
+Motion trees of many pairs of conformers of one protein (e.g. all-vs-all pairs of M structures). The structures are
+mapped onto their common aligned residues once (Screening.load_conformers), so the distance matrix of a structure is the
+same in every pair it is part of. Each distance matrix is computed once and kept in a bounded cache, and the distance
+difference matrix of a pair is the difference of the two cached matrices. All pairs of M structures need M distance
+matrices instead of M(M-1).
+"""
+
+
+class DistanceMatrixCache:
+    def __init__(self, coords, max_bytes=1 << 30):
+        """
+        Least recently used cache of the condensed distance matrices of a stack of coordinate sets.
+        :param coords: (M, N, 3) array of coordinates
+        :param max_bytes: The maximum total size (in bytes) of the cached matrices. At least two matrices (one pair) are
+        always kept.
+        """
+        self.coords = coords
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Structure index -> condensed distance matrix
+        self._matrices = OrderedDict()
+
+    def get(self, index):
+        dist_mat = self._matrices.get(index)
+        if dist_mat is not None:
+            self._matrices.move_to_end(index)
+            self.hits += 1
+            return dist_mat
+        self.misses += 1
+        dist_mat = get_distance_matrix(self.coords[index])
+        self._matrices[index] = dist_mat
+        while len(self._matrices) > 2 and sum(m.nbytes for m in self._matrices.values()) > self.max_bytes:
+            self._matrices.popitem(last=False)
+        return dist_mat
+
+    def stats(self):
+        return {
+            "entries": len(self._matrices),
+            "bytes": sum(m.nbytes for m in self._matrices.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "max_bytes": self.max_bytes
+        }
+
+
+class ConformerPairs:
+    def __init__(self, input_path, output_path, conformers, spat_prox=7.0, small_node=5, clust_size=30, magnitude=5,
+                 max_cache_bytes=1 << 30, output_pipeline=None):
+        """
+        :param conformers: The Screening.ConformerSet of the structures
+        :param max_cache_bytes: The maximum total size (in bytes) of the cached distance matrices
+        :param output_pipeline: The OutputPipeline the outputs of the pairs are written in while the next pairs are run.
+        None writes the outputs of each pair before the next one.
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        self.conformers = conformers
+        self.spat_prox = spat_prox
+        self.small_node = small_node
+        self.clust_size = clust_size
+        self.magnitude = magnitude
+        self.distance_matrices = DistanceMatrixCache(conformers.coords, max_cache_bytes)
+        self.output_pipeline = output_pipeline
+        # Pair -> Future of the outputs of the pairs written in the output pipeline
+        self.output_futures = {}
+
+    @classmethod
+    def load(cls, input_path, output_path, chain="A", codes=None, min_identity=90, **kwargs):
+        """
+        Loads the structures of the input folder onto their common residues (see Screening.load_conformers).
+        :return: ConformerPairs
+        """
+        return cls(input_path, output_path, load_conformers(input_path, chain, codes, min_identity), **kwargs)
+
+    def get_protein(self, index):
+        """
+        Creates the Protein of a structure with the coordinates of the common residues and the cached distance matrix.
+        :param index: The index of the structure in the ConformerSet
+        :return: Protein
+        """
+        protein = Protein(self.input_path, self.conformers.codes[index], self.conformers.chains[index])
+        protein.utilised_res_indices = self.conformers.res_indices[index]
+        protein.utilised_atoms_coords = self.conformers.coords[index]
+        protein.distance_matrix = self.distance_matrices.get(index)
+        return protein
+
+    def build_motion_tree(self, index_1, index_2):
+        """
+        Creates the MotionTree of a pair of structures, ready to run. Structure 2 is superimposed onto structure 1 by
+        the CA atoms of the common residues.
+        :return: MotionTree
+        """
+        code_1, chain_1 = self.conformers.codes[index_1], self.conformers.chains[index_1]
+        code_2, chain_2 = self.conformers.codes[index_2], self.conformers.chains[index_2]
+        engine = MotionTree(self.input_path, self.output_path, code_1, chain_1, code_2, chain_2, self.spat_prox,
+                            self.small_node, self.clust_size, self.magnitude, fetch_files=False,
+                            output_pipeline=self.output_pipeline)
+        engine.protein_1 = self.get_protein(index_1)
+        engine.protein_2 = self.get_protein(index_2)
+        engine.num_residues = engine.protein_1.utilised_res_indices.shape[0]
+        poses_1 = [gemmi.Position(*c) for c in engine.protein_1.utilised_atoms_coords.tolist()]
+        poses_2 = [gemmi.Position(*c) for c in engine.protein_2.utilised_atoms_coords.tolist()]
+        superpose_result = gemmi.superpose_positions(poses_1, poses_2)
+        engine.rmsd = superpose_result.rmsd
+        engine.superimpose_transform = superpose_result.transform
+        engine.pair = build_preprocessed_pair(engine.protein_1, engine.protein_2, False, engine.rmsd,
+                                              engine.superimpose_transform)
+        engine.create_distance_difference_matrix()
+        return engine
+
+    def get_pairs(self, min_rmsd=None):
+        """
+        Get every pair of structures, ordered so that consecutive pairs share their first structure, which keeps it in
+        the cache.
+        :param min_rmsd: Pairs with a lower RMSD of the common residues are left out. None keeps every pair.
+        :return: List of (index 1, index 2)
+        """
+        num_structures = len(self.conformers.codes)
+        pairs = [(i, j) for i in range(num_structures) for j in range(i + 1, num_structures)]
+        if min_rmsd is not None:
+            rmsd_mat = batch_rmsd_matrix(self.conformers.coords)
+            pairs = [(i, j) for i, j in pairs if rmsd_mat[i, j] >= min_rmsd]
+        return pairs
+
+    def iter_pairs(self, pairs):
+        """
+        Runs the motion trees of the structure pairs one at a time.
+        :param pairs: Iterable of (index 1, index 2) pairs
+        :return: Generator of the pair and the outputs of MotionTree.run(), or the error if the pair failed
+        """
+        for index_1, index_2 in pairs:
+            try:
+                engine = self.build_motion_tree(index_1, index_2)
+                outputs = engine.run()
+                if engine.output_future is not None:
+                    self.output_futures[(index_1, index_2)] = engine.output_future
+                yield (index_1, index_2), outputs
+            except Exception as e:
+                print(e)
+                yield (index_1, index_2), e
+
+    def run_pairs(self, pairs=None, min_rmsd=1.0):
+        """
+        Builds the motion trees of the structure pairs.
+        :param pairs: List of (index 1, index 2) pairs. If None, every pair with an RMSD of at least min_rmsd is used.
+        :return: Dictionary of the pair to the outputs of MotionTree.run(), or the error if the pair failed or its
+        outputs could not be written
+        """
+        if pairs is None:
+            pairs = self.get_pairs(min_rmsd)
+        results = dict(self.iter_pairs(pairs))
+        results.update(self.wait_for_outputs())
+        return results
+
+    def wait_for_outputs(self):
+        """
+        Waits for the outputs of the pairs in the output pipeline to be written.
+        :return: Dictionary of the pair to the error of each pair whose outputs could not be written
+        """
+        futures, self.output_futures = self.output_futures, {}
+        return wait_for_outputs(futures)
@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import threading
+import traceback
+import numpy as np
+import gemmi
+from StructureCache import structure_cache
+from CaReader import CaData, read_pdb_ca_data
+from FileMngr import is_pdb_format
+"""
+Binary sidecar cache of the CA atoms of a protein chain. The first time a chain of a file is used, the CA coordinates,
+residue sequence numbers, residue names, insertion codes and one-letter sequence are extracted from the structure and
+written as .npy files in a ".ca_cache" folder next to the structure file. Later runs memory-map the arrays instead of
+parsing the structure. The cache is validated against a SHA-256 hash of the structure file.
+"""
+
+CACHE_DIR_NAME = ".ca_cache"
+CACHE_VERSION = 1
+ARRAY_NAMES = ["coords", "has_ca", "seqids", "res_names", "icodes"]
+
+
+def get_ca_data(file_path, model_num, chain_id, polymer_only=True, use_cache=True):
+    """
+    Get the CA data of the protein chain, from the sidecar cache if it is valid. Otherwise the data is extracted from
+    the structure and written to the cache.
+    :param file_path: The path to the structure file
+    :param model_num: The index of the model in the structure
+    :param chain_id: The chain ID
+    :param polymer_only: Whether to only use the polymer residues of the chain instead of the whole chain
+    :param use_cache: Whether to read and write the sidecar cache
+    :return: CaData
+    """
+    if not use_cache:
+        return extract_ca_data(file_path, model_num, chain_id, polymer_only)
+    cache_path = get_ca_cache_path(file_path, model_num, chain_id, polymer_only)
+    stamp = get_file_stamp(file_path)
+    file_hash = None
+    meta = read_ca_cache_meta(cache_path)
+    if meta is not None:
+        if meta["stamp"] != stamp:
+            # The file has been touched since the cache was written. Only rebuild if the content changed.
+            file_hash = hash_file(file_path)
+            if meta["hash"] == file_hash:
+                meta["stamp"] = stamp
+                write_json(f"{cache_path}/meta.json", meta)
+            else:
+                meta = None
+        if meta is not None:
+            ca_data = read_ca_cache(cache_path, meta)
+            if ca_data is not None:
+                return ca_data
+
+    ca_data = extract_ca_data(file_path, model_num, chain_id, polymer_only)
+    if file_hash is None:
+        file_hash = hash_file(file_path)
+    write_ca_cache(cache_path, ca_data, file_hash, stamp)
+    return ca_data
+
+
+def extract_ca_data(file_path, model_num, chain_id, polymer_only=True):
+    """
+    Extracts the CA data of the chain. PDB files (gzipped or not) are read with the streaming CA reader, which does not
+    build the whole structure. mmCIF files are read through the structure cache.
+    """
+    if is_pdb_format(file_path):
+        return read_pdb_ca_data(file_path, model_num, chain_id, polymer_only)
+    return extract_ca_data_from_structure(file_path, model_num, chain_id, polymer_only)
+
+
+def extract_ca_data_from_structure(file_path, model_num, chain_id, polymer_only=True):
+    structure = structure_cache.get(file_path)
+    chain = structure[model_num][chain_id]
+    residues = chain.get_polymer() if polymer_only else chain
+    num_residues = len(residues)
+    coords = np.full((num_residues, 3), np.nan)
+    seqids = np.empty(num_residues, dtype=np.int32)
+    res_names = []
+    icodes = []
+    for i, r in enumerate(residues):
+        seqids[i] = r.seqid.num
+        res_names.append(r.name)
+        icodes.append(r.seqid.icode.strip())
+        for a in r:
+            if a.name == "CA":
+                coords[i] = a.pos.tolist()
+                break
+    if polymer_only:
+        sequence = gemmi.one_letter_code(residues.extract_sequence())
+    else:
+        sequence = gemmi.one_letter_code(res_names)
+    return CaData(coords, ~np.isnan(coords[:, 0]), seqids, np.asarray(res_names, dtype="U5"),
+                  np.asarray(icodes, dtype="U1"), sequence)
+
+
+def get_ca_cache_path(file_path, model_num, chain_id, polymer_only=True):
+    dir_name, file_name = os.path.split(os.path.abspath(file_path))
+    kind = "polymer" if polymer_only else "chain"
+    return f"{dir_name}/{CACHE_DIR_NAME}/{file_name}_{model_num}_{chain_id}_{kind}"
+
+
+def read_ca_cache_meta(cache_path):
+    try:
+        with open(f"{cache_path}/meta.json", "r") as fr:
+            meta = json.load(fr)
+        if meta.get("version") != CACHE_VERSION:
+            return None
+        return meta
+    except (OSError, ValueError):
+        return None
+
+
+def read_ca_cache(cache_path, meta):
+    try:
+        arrays = {name: np.load(f"{cache_path}/{name}.npy", mmap_mode="r") for name in ARRAY_NAMES}
+    except (OSError, ValueError):
+        return None
+    return CaData(arrays["coords"], arrays["has_ca"], arrays["seqids"], arrays["res_names"], arrays["icodes"],
+                  meta["sequence"])
+
+
+def write_ca_cache(cache_path, ca_data, file_hash, stamp):
+    """
+    Writes the CA data to the cache folder. Every file is written to a temporary file first and then renamed, and the
+    meta file is written last, so a reader never sees a half-written cache. Failing to write the cache (e.g. a
+    read-only input folder) is not an error.
+    """
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        for name in ARRAY_NAMES:
+            tmp_path = f"{cache_path}/{name}.{get_tmp_suffix()}.tmp.npy"
+            np.save(tmp_path, np.ascontiguousarray(getattr(ca_data, name)))
+            os.replace(tmp_path, f"{cache_path}/{name}.npy")
+        meta = {
+            "version": CACHE_VERSION,
+            "hash": file_hash,
+            "stamp": stamp,
+            "sequence": ca_data.sequence
+        }
+        write_json(f"{cache_path}/meta.json", meta)
+    except Exception as e:
+        traceback.print_exc()
+        print(e)
+
+
+def write_json(file_path, data):
+    tmp_path = f"{file_path}.{get_tmp_suffix()}.tmp"
+    with open(tmp_path, "w") as fw:
+        json.dump(data, fw)
+    os.replace(tmp_path, file_path)
+
+
+def get_tmp_suffix():
+    # Unique per process and thread so that concurrent writers never share a temporary file
+    return f"{os.getpid()}_{threading.get_ident()}"
+
+
+def get_file_stamp(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def hash_file(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as fr:
+        for block in iter(lambda: fr.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
@@ -4,6 +4,7 @@ import psycopg2
 import pickle
 from itertools import groupby
 from operator import itemgetter
+from DistanceMatrix import to_condensed
 
 
 conn_str = None
@@ -59,7 +60,7 @@ def check_protein_pair_exists(protein_1, chain_1, protein_2, chain_2):
 
 def insert_protein_pair(protein_1, chain_1, protein_2, chain_2, rmsd, diff_dist_mat):
     try:
-        diff_dist_bin = pickle.dumps(diff_dist_mat)
+        diff_dist_bin = pickle.dumps(to_condensed(diff_dist_mat))
         cur.execute(
             """
             INSERT INTO proteins (protein_1, chain_1, protein_2, chain_2, rmsd, diff_dist_mat) 
@@ -84,7 +85,8 @@ def get_protein_pair(protein_1, chain_1, protein_2, chain_2):
             (protein_1, chain_1, protein_2, chain_2)
         )
         row = cur.fetchone()
-        diff_dist_mat = pickle.loads(row[1])
+        # Matrices stored before the condensed form was used are square
+        diff_dist_mat = to_condensed(pickle.loads(row[1]))
         return row[0], diff_dist_mat
     except Exception as e:
         traceback.print_exc()
@@ -0,0 +1,132 @@
+import hashlib
+import threading
+import numpy as np
+from DiskCache import DiskCache, hash_key
+from DistanceMatrix import condensed_size
+"""
+Persistent cache of distance difference matrices on the local disk, so runs without the database reuse them the same
+way the database's proteins table does. Entries are keyed by a hash of the two aligned CA coordinate sets, with the two
+sets in a canonical order, so (A, B) and (B, A) share an entry. The condensed matrices are stored as .npy files and
+read as memory maps. The contact matrices of both proteins are stored alongside for each spatial proximity distance.
+"""
+
+DIFF_CACHE_DIR = "./data/cache/diff_dist_mats"
+DIFF_CACHE_VERSION = 1
+
+
+class DiffMatrixCache:
+    def __init__(self, cache_dir=DIFF_CACHE_DIR, max_entries=2000, max_bytes=4 << 30):
+        """
+        :param cache_dir: The folder of the cache
+        :param max_entries: The maximum number of files kept
+        :param max_bytes: The maximum total size (in bytes) of the cache files
+        """
+        self.disk_cache = DiskCache(cache_dir, ".npy", max_entries, max_bytes)
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_keys(self, coords_1, coords_2, spat_prox):
+        """
+        :return: The keys of the distance difference matrix and of the contact matrices, and whether the coordinate sets
+        are swapped in the canonical order
+        """
+        digest_1 = hash_coords(coords_1)
+        digest_2 = hash_coords(coords_2)
+        is_swapped = digest_2 < digest_1
+        digests = sorted([digest_1, digest_2])
+        # 7 and 7.0 give the same contact matrices
+        return (hash_key(DIFF_CACHE_VERSION, *digests),
+                hash_key(DIFF_CACHE_VERSION, "contacts", float(spat_prox), *digests), is_swapped)
+
+    def lookup(self, coords_1, coords_2, spat_prox):
+        """
+        Get the cached matrices of the coordinate sets.
+        :return: The memory-mapped condensed distance difference matrix and contact matrices of protein 1 and 2, or None
+        if they are not cached
+        """
+        if not self.enabled:
+            return None
+        diff_key, contacts_key, is_swapped = self.get_keys(coords_1, coords_2, spat_prox)
+        size = condensed_size(coords_1.shape[0])
+        diff_dist_mat = self.read(diff_key, (size,))
+        contact_mats = self.read(contacts_key, (2, size)) if diff_dist_mat is not None else None
+        with self._lock:
+            if contact_mats is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if contact_mats is None:
+            return None
+        if is_swapped:
+            return diff_dist_mat, contact_mats[1], contact_mats[0]
+        return diff_dist_mat, contact_mats[0], contact_mats[1]
+
+    def read(self, key, shape):
+        path = self.disk_cache.lookup(key)
+        if path is None:
+            return None
+        try:
+            arr = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            # Removed or replaced by another process while reading
+            return None
+        return arr if arr.shape == shape else None
+
+    def store(self, coords_1, coords_2, spat_prox, diff_dist_mat, contact_mat_1, contact_mat_2):
+        """
+        Adds the matrices of the coordinate sets to the cache. Failing to write the cache (e.g. a full disk) is not an
+        error.
+        """
+        if not self.enabled:
+            return
+        diff_key, contacts_key, is_swapped = self.get_keys(coords_1, coords_2, spat_prox)
+        if is_swapped:
+            contact_mat_1, contact_mat_2 = contact_mat_2, contact_mat_1
+        try:
+            self.disk_cache.store(diff_key, lambda path: np.save(path, diff_dist_mat))
+            self.disk_cache.store(contacts_key, lambda path: save_stacked(path, [contact_mat_1, contact_mat_2]))
+        except Exception as e:
+            print(e)
+
+    def configure(self, cache_dir=None, max_entries=None, max_bytes=None, enabled=None):
+        if cache_dir is not None:
+            self.disk_cache.cache_dir = cache_dir
+        if max_entries is not None:
+            self.disk_cache.max_entries = max_entries
+        if max_bytes is not None:
+            self.disk_cache.max_bytes = max_bytes
+        if enabled is not None:
+            self.enabled = enabled
+
+    def clear(self):
+        self.disk_cache.clear()
+
+    def stats(self):
+        stats = self.disk_cache.stats()
+        with self._lock:
+            stats["hits"] = self.hits
+            stats["misses"] = self.misses
+        return stats
+
+
+def save_stacked(file_path, arrays):
+    # Saves arrays of the same shape as one .npy file, copying them one at a time so they can be memory maps
+    stacked = np.lib.format.open_memmap(file_path, mode="w+", dtype=arrays[0].dtype,
+                                        shape=(len(arrays),) + arrays[0].shape)
+    for i, arr in enumerate(arrays):
+        stacked[i] = arr
+    stacked.flush()
+    del stacked
+
+
+def hash_coords(coords):
+    # SHA-256 of the coordinates as contiguous float64 values, with the shape so that reshaped data differs
+    coords = np.ascontiguousarray(coords, dtype=np.float64)
+    sha = hashlib.sha256(str(coords.shape).encode())
+    sha.update(coords.data)
+    return sha.hexdigest()
+
+
+diff_matrix_cache = DiffMatrixCache()
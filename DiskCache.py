@@ -0,0 +1,152 @@
+import os
+import time
+import hashlib
+import threading
+from CoordCache import get_tmp_suffix
+"""
+Bounded, content-addressed cache of files on the local disk, shared by every process using the same folder. Entries are
+named by a hash of their content key and written to a temporary file that is renamed into place, so readers never see
+a half-written entry and concurrent writers of the same key simply replace each other's identical entry. Reading an
+entry updates its modification time, and when the cache is over its limits the least recently used entries are removed.
+"""
+
+# Temporary files older than this (in seconds) were left behind by writers that crashed and are removed on eviction
+STALE_TMP_AGE = 3600
+
+
+class DiskCache:
+    def __init__(self, cache_dir, suffix, max_entries=10000, max_bytes=1 << 30, evict_interval=100):
+        """
+        :param cache_dir: The folder of the cache
+        :param suffix: The file extension of the entries, e.g. ".json"
+        :param max_entries: The maximum number of entries kept
+        :param max_bytes: The maximum total size (in bytes) of the entries
+        :param evict_interval: The number of entries this process writes between checks of the cache size
+        """
+        self.cache_dir = cache_dir
+        self.suffix = suffix
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.evictions = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get_path(self, key):
+        # Entries are spread over sub-folders by the first characters of the key so no folder gets too large
+        return f"{self.cache_dir}/{key[:2]}/{key}{self.suffix}"
+
+    def lookup(self, key):
+        """
+        Get the path of the entry of the key, marking it as recently used.
+        :return: The path of the entry, or None if the key is not cached
+        """
+        path = self.get_path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def store(self, key, write):
+        """
+        Adds an entry to the cache.
+        :param key: The key of the entry
+        :param write: Function writing the entry to the file path it is given
+        :return: The path of the entry
+        """
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{get_tmp_suffix()}.tmp{self.suffix}"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._writes += 1
+            check_size = self._writes % self.evict_interval == 0
+        if check_size:
+            self.evict()
+        return path
+
+    def list_entries(self):
+        """
+        :return: List of (modification time, size, path) of the entries, and the paths of stale temporary files
+        """
+        entries = []
+        stale = []
+        now = time.time()
+        if not os.path.isdir(self.cache_dir):
+            return entries, stale
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Removed by another process
+                    continue
+                if ".tmp" in entry.name:
+                    if now - stat.st_mtime > STALE_TMP_AGE:
+                        stale.append(entry.path)
+                elif entry.name.endswith(self.suffix):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries, stale
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is within its limits.
+        :return: The number of entries removed
+        """
+        entries, stale = self.list_entries()
+        for path in stale:
+            remove_file(path)
+        total_bytes = sum(size for _, size, _ in entries)
+        num_entries = len(entries)
+        num_removed = 0
+        for _, size, path in sorted(entries):
+            if num_entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            remove_file(path)
+            num_entries -= 1
+            total_bytes -= size
+            num_removed += 1
+        with self._lock:
+            self.evictions += num_removed
+        return num_removed
+
+    def clear(self):
+        entries, stale = self.list_entries()
+        for _, _, path in entries:
+            remove_file(path)
+        for path in stale:
+            remove_file(path)
+
+    def stats(self):
+        entries, _ = self.list_entries()
+        return {
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "evictions": self.evictions,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes
+        }
+
+
+def hash_key(*parts):
+    # SHA-256 of the parts, separated so that different splits of the same text give different keys
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,169 @@
+import math
+import numpy as np
+from scipy.spatial.distance import cdist, pdist, squareform
+"""
+Condensed storage of the symmetric matrices of the pipeline (the distance matrices of the proteins, the distance
+difference matrix and the cluster distance matrix). Only the entries above the diagonal are kept, row by row, in a 1D
+array of length N(N-1)/2, the same layout as scipy.spatial.distance.pdist. Entry (i, j) of an NxN matrix is found with
+condensed_index(n, i, j), which works the same for (j, i) and on arrays of indices.
+
+Matrices too large for memory can be kept in memory-mapped .npy files instead (create_memmap). The block functions
+(fill_blocks, find_min and the tiled kernel) only hold one block of such a matrix in memory at a time.
+"""
+
+# The number of matrix entries computed at a time by the tiled kernels
+TILE_SIZE = 1 << 20
+
+
+def condensed_size(n):
+    # The number of entries above the diagonal of an NxN matrix
+    return n * (n - 1) // 2
+
+
+def condensed_num_points(size):
+    # The N of a condensed matrix with the given number of entries
+    return (1 + math.isqrt(1 + 8 * size)) // 2
+
+
+def condensed_index(n, i, j):
+    """
+    Get the index of entry (i, j) of an NxN symmetric matrix in its condensed array. i and j must not be equal.
+    :param n: The size of the matrix
+    :param i: Row index, or array of row indices
+    :param j: Column index, or array of column indices (broadcast against i)
+    :return: The index, or array of indices
+    """
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+
+def condensed_pair(n, k):
+    """
+    Get the row and column (row < column) of the entry at index k of the condensed array of an NxN matrix.
+    :return: (i, j)
+    """
+    k = int(k)
+    i = n - 2 - (math.isqrt(4 * n * (n - 1) - 8 * k - 7) - 1) // 2
+    # Rounding of the square root can put i one row out
+    while i > 0 and condensed_index(n, i, i + 1) > k:
+        i -= 1
+    while i < n - 2 and condensed_index(n, i + 1, i + 2) <= k:
+        i += 1
+    return i, int(k - condensed_index(n, i, i + 1) + i + 1)
+
+
+def get_distance_matrix(coords):
+    """
+    :param coords: Nx3 array of coordinates
+    :return: The condensed Euclidean distance matrix of the coordinates
+    """
+    return pdist(coords, metric="euclidean")
+
+
+def get_diff_distance_matrix(dist_mat_1, dist_mat_2):
+    """
+    Get the condensed distance difference matrix of two condensed distance matrices, without another temporary array.
+    """
+    diff_dist_mat = np.subtract(dist_mat_1, dist_mat_2)
+    return np.absolute(diff_dist_mat, out=diff_dist_mat)
+
+
+def get_diff_distances_and_contacts(coords_1, coords_2, spat_prox, tile_size=TILE_SIZE, out=None):
+    """
+    Computes the condensed distance difference matrix of two sets of coordinates, and which residue pairs are within
+    the spatial proximity in each set, in one pass over blocks of rows. Only one block of distances of each set is in
+    memory at a time, so the two full distance matrices are never made.
+    :param coords_1: Nx3 array of the coordinates of protein 1
+    :param coords_2: Nx3 array of the coordinates of protein 2, in the same residue order
+    :param spat_prox: The spatial proximity distance
+    :param tile_size: The number of distances of each set computed at a time
+    :param out: The (distance difference, contacts 1, contacts 2) arrays to write to, e.g. memory maps. New arrays are
+    made if None.
+    :return: The condensed distance difference matrix and the condensed boolean contact matrices of both sets
+    """
+    n = coords_1.shape[0]
+    if out is None:
+        size = condensed_size(n)
+        out = (np.empty(size), np.empty(size, dtype=bool), np.empty(size, dtype=bool))
+    diff_dist_mat, contacts_1, contacts_2 = out
+    block_rows = max(1, tile_size // max(n, 1))
+    for start in range(0, n - 1, block_rows):
+        end = min(start + block_rows, n - 1)
+        # The rows of the block against the columns from the first row of the block. The entries right of the diagonal
+        # of the block, read row by row, are one contiguous part of the condensed array.
+        dist_1 = cdist(coords_1[start:end], coords_1[start:], metric="euclidean")
+        dist_2 = cdist(coords_2[start:end], coords_2[start:], metric="euclidean")
+        upper = np.arange(n - start)[None, :] > np.arange(end - start)[:, None]
+        dist_1 = dist_1[upper]
+        dist_2 = dist_2[upper]
+        part_start = condensed_index(n, start, start + 1)
+        part = slice(part_start, part_start + dist_1.shape[0])
+        np.less(dist_1, spat_prox, out=contacts_1[part])
+        np.less(dist_2, spat_prox, out=contacts_2[part])
+        np.subtract(dist_1, dist_2, out=diff_dist_mat[part])
+        np.absolute(diff_dist_mat[part], out=diff_dist_mat[part])
+    return diff_dist_mat, contacts_1, contacts_2
+
+
+def create_memmap(file_path, size, dtype=np.float64):
+    """
+    Creates a condensed matrix in a memory-mapped .npy file.
+    :param file_path: The path of the file
+    :param size: The number of entries
+    :return: numpy.memmap
+    """
+    return np.lib.format.open_memmap(file_path, mode="w+", dtype=dtype, shape=(size,))
+
+
+def fill_blocks(arr, value, block_size=TILE_SIZE):
+    # Fill the array one block at a time, so a memory map does not have all its pages in memory at once
+    for start in range(0, arr.shape[0], block_size):
+        arr[start:start + block_size] = value
+
+
+def find_min(arr, block_size=None):
+    """
+    Finds the first index of the minimum value of an array, the same as np.argmin.
+    :param arr: The array
+    :param block_size: The number of entries read at a time. If None, the whole array is read at once.
+    :return: The index and the minimum value
+    """
+    if block_size is None or block_size >= arr.shape[0]:
+        min_index = int(np.argmin(arr))
+        return min_index, arr[min_index]
+    min_index = 0
+    min_value = np.inf
+    for start in range(0, arr.shape[0], block_size):
+        block = arr[start:start + block_size]
+        block_index = int(np.argmin(block))
+        # Only a strictly smaller value moves the minimum, so the first index of the minimum value is kept
+        if block[block_index] < min_value or start == 0:
+            min_index = start + block_index
+            min_value = block[block_index]
+    return min_index, min_value
+
+
+def get_block(condensed, n, rows, cols):
+    """
+    Get the entries of the rows and columns of a condensed matrix as a dense block. Rows and columns must not share
+    indices.
+    :return: len(rows) x len(cols) array
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    return condensed[condensed_index(n, rows[:, None], cols[None, :])]
+
+
+def to_condensed(mat):
+    # Matrices saved before the condensed form was used are square
+    mat = np.asarray(mat)
+    if mat.ndim == 1:
+        return mat
+    return squareform(mat, checks=False)
+
+
+def to_square(condensed, diagonal=0):
+    mat = squareform(condensed, checks=False)
+    if diagonal != 0:
+        np.fill_diagonal(mat, diagonal)
+    return mat
@@ -0,0 +1,155 @@
+import numpy as np
+import gemmi
+from Protein import Protein
+from MotionTree import MotionTree
+from StructureCache import structure_cache
+from CaReader import read_pdb_ca_data_models
+from CoordCache import extract_ca_data_from_structure
+from FileMngr import find_structure_file, is_pdb_format
+from OutputPipeline import wait_for_outputs
+from DistanceMatrix import condensed_size, get_distance_matrix
+"""
+Ensemble mode for files holding many models of the same chain, such as NMR ensembles and MD snapshots. All models of
+the chain are loaded into one (M, N, 3) coordinate array and the M condensed distance matrices are computed into one
+(M, N(N-1)/2) array. Motion trees are then built between any pairs of models from those matrices, without parsing the file or
+computing a distance matrix again.
+"""
+
+
+class Ensemble:
+    def __init__(self, input_path, output_path, code, chain="A", spat_prox=7.0, small_node=5, clust_size=30,
+                 magnitude=5, output_pipeline=None):
+        """
+        :param output_pipeline: The OutputPipeline the outputs of the pairs are written in while the next pairs are run.
+        None writes the outputs of each pair before the next one.
+        """
+        self.input_path = input_path
+        self.output_path = output_path
+        self.code = code
+        self.chain = chain
+        self.spat_prox = spat_prox
+        self.small_node = small_node
+        self.clust_size = clust_size
+        self.magnitude = magnitude
+        self.output_pipeline = output_pipeline
+        self.file_path = find_structure_file(input_path, code)
+        if self.file_path is None:
+            raise IOError(f"Unable to find file: {input_path}/{code}")
+        # CaData of the chain in every model
+        self.models_ca_data = []
+        # The indices of the residues with a CA atom in every model. The residues are matched by their index in the
+        # chains, like DynDom files.
+        self.utilised_res_indices = None
+        # (M, N, 3) array of the CA coordinates of the utilised residues of every model
+        self.coords = None
+        # (M, N(N-1)/2) array of the condensed distance matrices of every model
+        self.distance_matrices = None
+
+    def load(self):
+        """
+        Loads the CA atoms of the chain in every model and keeps the residues that have a CA atom in all of them.
+        :return: The number of models
+        """
+        self.models_ca_data = self.read_models_ca_data(polymer_only=True)
+        if min(len(ca_data) for ca_data in self.models_ca_data) == 0:
+            # Files without TER records (e.g. MD snapshots) have no polymer, so use the whole chain. The polymer is the
+            # start of the chain, so the residue indices mean the same thing either way.
+            self.models_ca_data = self.read_models_ca_data(polymer_only=False)
+        num_residues = min(len(ca_data) for ca_data in self.models_ca_data)
+        has_ca = np.all([ca_data.has_ca[:num_residues] for ca_data in self.models_ca_data], axis=0)
+        self.utilised_res_indices = np.flatnonzero(has_ca)
+        self.coords = np.stack([ca_data.coords[self.utilised_res_indices] for ca_data in self.models_ca_data])
+        return self.coords.shape[0]
+
+    def read_models_ca_data(self, polymer_only):
+        if is_pdb_format(self.file_path):
+            return read_pdb_ca_data_models(self.file_path, self.chain, polymer_only)
+        structure = structure_cache.get(self.file_path)
+        return [extract_ca_data_from_structure(self.file_path, m, self.chain, polymer_only)
+                for m in range(len(structure))]
+
+    def get_distance_matrices(self):
+        if self.coords is None:
+            self.load()
+        self.distance_matrices = batch_distance_matrices(self.coords)
+        return self.distance_matrices
+
+    def get_protein(self, model_num):
+        """
+        Creates the Protein of a model of the ensemble with the coordinates and distance matrix already filled in.
+        :param model_num: The index of the model
+        :return: Protein
+        """
+        protein = Protein(self.input_path, self.code, self.chain, is_dyndom=True, model_num=model_num)
+        protein.ca_data = self.models_ca_data[model_num]
+        protein.utilised_res_indices = self.utilised_res_indices
+        protein.utilised_atoms_coords = self.coords[model_num]
+        protein.distance_matrix = self.distance_matrices[model_num]
+        return protein
+
+    def get_rmsd(self, model_1, model_2):
+        poses_1 = [gemmi.Position(*c) for c in self.coords[model_1].tolist()]
+        poses_2 = [gemmi.Position(*c) for c in self.coords[model_2].tolist()]
+        return gemmi.superpose_positions(poses_1, poses_2).rmsd
+
+    def get_pair_output_path(self, model_1, model_2):
+        return f"{self.output_path}/{self.code}_{self.chain}_ensemble/models_{model_1 + 1}_{model_2 + 1}"
+
+    def build_motion_tree(self, model_1, model_2):
+        """
+        Creates the MotionTree of a pair of models, ready to run. The outputs of the pair are written to their own folder
+        in the ensemble folder.
+        :param model_1: The index of the first model
+        :param model_2: The index of the second model
+        :return: MotionTree
+        """
+        if self.distance_matrices is None:
+            self.get_distance_matrices()
+        engine = MotionTree(self.input_path, self.get_pair_output_path(model_1, model_2), self.code, None, None, None,
+                            self.spat_prox, self.small_node, self.clust_size, self.magnitude, is_dyndom=True,
+                            output_pipeline=self.output_pipeline)
+        engine.protein_1 = self.get_protein(model_1)
+        engine.protein_2 = self.get_protein(model_2)
+        engine.num_residues = self.utilised_res_indices.shape[0]
+        engine.rmsd = self.get_rmsd(model_1, model_2)
+        engine.create_distance_difference_matrix()
+        return engine
+
+    def run_pairs(self, pairs=None):
+        """
+        Builds the motion trees of the model pairs.
+        :param pairs: List of (model_1, model_2) index pairs. If None, every pair of models is used.
+        :return: Dictionary of the model pair to the outputs of MotionTree.run(), or the error if the pair failed or its
+        outputs could not be written
+        """
+        if self.distance_matrices is None:
+            self.get_distance_matrices()
+        if pairs is None:
+            num_models = self.coords.shape[0]
+            pairs = [(i, j) for i in range(num_models) for j in range(i + 1, num_models)]
+        results = {}
+        output_futures = {}
+        for model_1, model_2 in pairs:
+            try:
+                engine = self.build_motion_tree(model_1, model_2)
+                results[(model_1, model_2)] = engine.run()
+                if engine.output_future is not None:
+                    output_futures[(model_1, model_2)] = engine.output_future
+            except Exception as e:
+                print(e)
+                results[(model_1, model_2)] = e
+        results.update(wait_for_outputs(output_futures))
+        return results
+
+
+def batch_distance_matrices(coords):
+    """
+    Computes the condensed distance matrices of a stack of coordinate sets into one preallocated array, one model at a
+    time, so no square matrix is made.
+    :param coords: (M, N, 3) array of coordinates
+    :return: (M, N(N-1)/2) array of condensed distance matrices
+    """
+    dist_mats = np.empty((coords.shape[0], condensed_size(coords.shape[1])))
+    for model_num in range(coords.shape[0]):
+        dist_mats[model_num] = get_distance_matrix(coords[model_num])
+    return dist_mats
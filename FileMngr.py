@@ -1,13 +1,30 @@
+import gzip
+import hashlib
+import threading
 import traceback
 import urllib.request
-import matplotlib.pyplot as plt
 import numpy as np
-from itertools import groupby
-from operator import itemgetter
 from pathlib import Path
-from scipy.cluster.hierarchy import dendrogram
 import gemmi
-from copy import deepcopy
+from DistanceMatrix import to_condensed, condensed_num_points, condensed_index
+from PdbWriter import AtomRecords, get_atom_records, write_pdb_models
+from Renderer import submit_render, render_diff_dist_mat, render_dendrogram
+from ImagePyramid import build_pyramid, read_pyramid_meta
+
+# Structure file formats accepted in the input folder, in the order they are looked for
+STRUCTURE_FILE_FORMATS = [".pdb", ".pdb.gz", ".cif", ".cif.gz"]
+# Formats downloaded from the RCSB when the structure is not in the input folder. Large structures are only distributed
+# as mmCIF, so the gzipped mmCIF file is used when there is no PDB format file.
+DOWNLOAD_FILE_FORMATS = [".pdb", ".cif.gz"]
+# Larger distance difference matrices are drawn from every k-th residue, so the image never needs the full square matrix
+MAX_IMAGE_RESIDUES = 2000
+# The folder of the image pyramids of the distance difference matrices larger than MAX_IMAGE_RESIDUES, in the proteins
+# folder. Each pyramid is in a folder named by the digest of its matrix, so it is written once for every parameter set.
+PYRAMID_FOLDER = "diff_dist_pyramids"
+
+# Pyramid folder -> Future of the pyramids being built, so a pyramid is only built once at a time
+_pyramid_futures = {}
+_pyramid_futures_lock = threading.Lock()
 
 
 def read_file_paths():
@@ -29,25 +46,9 @@ def read_file_paths():
 
     temp_dict["protein1"] = temp_dict["protein1"].lower()
     temp_dict["protein2"] = temp_dict["protein2"].lower()
-    file_1 = temp_dict["input_path"] + "/" + temp_dict["protein1"] + ".pdb"
-    file_2 = temp_dict["input_path"] + "/" + temp_dict["protein2"] + ".pdb"
-    path = Path(file_1)
-    if not path.exists():
+    for code in [temp_dict["protein1"], temp_dict["protein2"]]:
         try:
-            urllib.request.urlretrieve(
-                f"https://files.rcsb.org/download/{temp_dict['protein1']}.pdb",
-                file_1
-            )
-        except Exception as e:
-            print(e)
-
-    path = Path(file_2)
-    if not path.exists():
-        try:
-            urllib.request.urlretrieve(
-                f"https://files.rcsb.org/download/{temp_dict['protein2']}.pdb",
-                file_2
-            )
+            download_structure_file(temp_dict["input_path"], code)
         except Exception as e:
             print(e)
 
@@ -55,42 +56,79 @@ def read_file_paths():
 
 
 def ftp_files_to_disk(input_path: str, pdb_1: str, pdb_2: str):
-    file_1 = input_path + "/" + pdb_1 + ".pdb"
-    path = Path(file_1)
-    if not path.exists():
+    for code in [pdb_1, pdb_2]:
         try:
-            urllib.request.urlretrieve(
-                f"https://files.rcsb.org/download/{pdb_1}.pdb",
-                file_1
-            )
+            download_structure_file(input_path, code)
         except Exception as e:
             traceback.print_exc()
             print(e)
             return 1
 
-    file_2 = input_path + "/" + pdb_2 + ".pdb"
-    path = Path(file_2)
-    if not path.exists():
+    return 0
+
+
+def download_structure_file(input_path: str, code: str):
+    """
+    Downloads the structure file from the RCSB into the input folder if the input folder does not already have a
+    structure file of the code in any of the accepted formats. Compressed files are stored as they are.
+    :param input_path: The input folder
+    :param code: The PDB code
+    :return: The path to the structure file
+    """
+    file_path = find_structure_file(input_path, code)
+    if file_path is not None:
+        return file_path
+    error = None
+    for file_format in DOWNLOAD_FILE_FORMATS:
+        file_path = f"{input_path}/{code}{file_format}"
         try:
-            urllib.request.urlretrieve(
-                f"https://files.rcsb.org/download/{pdb_2}.pdb",
-                file_2
-            )
+            urllib.request.urlretrieve(f"https://files.rcsb.org/download/{code}{file_format}", file_path)
+            return file_path
         except Exception as e:
-            traceback.print_exc()
-            print(e)
-            return 1
-
-    return 0
+            Path(file_path).unlink(missing_ok=True)
+            error = e
+    raise IOError(f"Unable to download {code}: {error}")
 
 
 def check_if_dyndom_file_exists(input_path: str, file_name: str):
-    file_path_str = input_path + "/" + file_name + ".pdb"
-    path = Path(file_path_str)
-    if not path.exists():
+    if find_structure_file(input_path, file_name) is None:
         raise IOError(f"Unable to find file: {file_name}")
 
 
+def find_structure_file(input_path: str, code: str):
+    """
+    Finds the structure file of the code in the input folder, looking for the formats in STRUCTURE_FILE_FORMATS.
+    :param input_path: The input folder
+    :param code: The name of the structure file without the extension
+    :return: The path to the file, or None if there is no file
+    """
+    for file_format in STRUCTURE_FILE_FORMATS:
+        file_path = f"{input_path}/{code}{file_format}"
+        if Path(file_path).exists():
+            return file_path
+    return None
+
+
+def is_gzipped(file_path: str):
+    return file_path.endswith(".gz")
+
+
+def is_pdb_format(file_path: str):
+    if is_gzipped(file_path):
+        file_path = file_path[:-3]
+    return file_path.endswith(".pdb") or file_path.endswith(".ent")
+
+
+def open_structure_file(file_path: str):
+    """
+    Opens the structure file for reading bytes. Gzipped files are decompressed while they are read, without writing a
+    decompressed copy to disk.
+    """
+    if is_gzipped(file_path):
+        return gzip.open(file_path, "rb")
+    return open(file_path, "rb")
+
+
 def read_param_file():
     temp_dict = {}
     try:
@@ -107,6 +145,9 @@ def read_param_file():
                     param_val = int(tokens[1])
                 elif param_name == "spatial_proximity":
                     param_val = float(tokens[1])
+                elif param_name == "memory_budget":
+                    # Given in gigabytes
+                    param_val = int(float(tokens[1]) * (1 << 30))
                 temp_dict[param_name] = param_val
         fr.close()
     except Exception as e:
@@ -115,7 +156,25 @@ def read_param_file():
     return temp_dict
 
 
+def get_image_matrix(condensed):
+    """
+    Get the condensed matrix drawn for a condensed distance difference matrix. Matrices of more than MAX_IMAGE_RESIDUES
+    residues are sampled at an even step of residues, so the image never needs the full square matrix.
+    """
+    n = condensed_num_points(condensed.shape[0])
+    if n <= MAX_IMAGE_RESIDUES:
+        return np.array(condensed)
+    sampled = np.arange(0, n, -(-n // MAX_IMAGE_RESIDUES))
+    rows, cols = np.triu_indices(sampled.shape[0], k=1)
+    return condensed[condensed_index(n, sampled[rows], sampled[cols])]
+
+
 def save_results_to_disk(output_path, protein_1, chain_1, protein_2, chain_2, spat_prox, small_node, clust_size, magnitude, data, image_type):
+    """
+    Saves the distance difference matrix or motion tree and draws its image. The image is drawn in the rendering pool
+    (see Renderer).
+    :return: Future of the image path, or None if the image type is unknown
+    """
     if chain_1 is not None:
         proteins_folder = f"{protein_1}_{chain_1}_{protein_2}_{chain_2}"
     else:
@@ -123,73 +182,67 @@ def save_results_to_disk(output_path, protein_1, chain_1, protein_2, chain_2, sp
     params_folder = f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
     dir_path = f"{output_path}/{proteins_folder}/{params_folder}"
     path = Path(dir_path)
-    dpi = 70
     if not path.is_dir():
-        path.mkdir(parents=True)
+        path.mkdir(parents=True, exist_ok=True)
     if image_type == "diff_dist_mat":
-        fig_1, axis_1 = plt.subplots()
-        axis_1.set_title(f"{proteins_folder}_{params_folder} Distance Difference Matrix")
-        axis_1.set_xlabel("Residue Number")
-        axis_1.set_ylabel("Residue Number")
-        axis_1.matshow(data)
-        # plt.show()
-        plt.savefig(f"{dir_path}/diff_dist_mat.png", dpi=dpi)
-        # Saves the difference distance numpy array into a .npy binary file
+        data = to_condensed(data)
+        # Saves the condensed difference distance numpy array into a .npy binary file
         np.save(f"{dir_path}/diff_dist_arr.npy", data)
+        return submit_render(render_diff_dist_mat, f"{dir_path}/diff_dist_mat.png",
+                             f"{proteins_folder}_{params_folder} Distance Difference Matrix", get_image_matrix(data))
     elif image_type == "dendrogram":
-        # for i in range(data.shape[0]):
-        #     print(data[i])
-        fig_1, axis_1 = plt.subplots()
-        axis_1.set_title(f"{proteins_folder}_{params_folder} Motion Tree")
-        axis_1.set_xlabel("Residue Number")
-        axis_1.set_ylabel("Magnitude (Å)")
-        annotated_dendrogram(
-            data,
-            truncate_mode='lastp',
-            p=50,
-            leaf_rotation=90.,
-            leaf_font_size=12.,
-            show_contracted=True,
-            annotate_above=magnitude,
-            max_d=magnitude,
-            show_leaf_counts=False
-        )
-        plt.savefig(f"{dir_path}/motion_tree.png", dpi=dpi)
-    plt.close()
-
-
-def annotated_dendrogram(*args, **kwargs):
+        return submit_render(render_dendrogram, f"{dir_path}/motion_tree.png",
+                             f"{proteins_folder}_{params_folder} Motion Tree", np.array(data), magnitude)
+
+
+def save_diff_dist_pyramid(output_path, protein_1, chain_1, protein_2, chain_2, spat_prox, small_node, clust_size, magnitude, data):
+    """
+    Writes the image pyramid of the distance difference matrix saved by save_results_to_disk, for zooming into matrices
+    whose image is sampled (see ImagePyramid). It is built in the rendering pool from the memory-mapped .npy file, unless
+    the proteins folder already has the pyramid of the matrix.
+    :param data: The condensed distance difference matrix
+    :return: Future of the pyramid folder, or None if the image of the matrix is at full resolution or the pyramid was
+    already written
+    """
+    if condensed_num_points(data.shape[0]) <= MAX_IMAGE_RESIDUES:
+        return None
+    if chain_1 is not None:
+        proteins_folder = f"{protein_1}_{chain_1}_{protein_2}_{chain_2}"
+    else:
+        proteins_folder = protein_1
+    params_folder = f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
+    pyramid_path = f"{output_path}/{proteins_folder}/{PYRAMID_FOLDER}/{get_matrix_digest(data)}"
+    with _pyramid_futures_lock:
+        future = _pyramid_futures.pop(pyramid_path, None)
+        if future is not None and not future.done():
+            _pyramid_futures[pyramid_path] = future
+            return future
+        if read_pyramid_meta(pyramid_path) is not None:
+            return None
+        future = submit_render(build_pyramid, f"{output_path}/{proteins_folder}/{params_folder}/diff_dist_arr.npy",
+                               pyramid_path)
+        _pyramid_futures[pyramid_path] = future
+        return future
+
+
+def get_matrix_digest(condensed):
+    # SHA-256 of the condensed matrix as float64 values, read in blocks so a memory-mapped matrix is not loaded at once
+    sha = hashlib.sha256(str(condensed.shape).encode())
+    block_size = 1 << 22
+    for i in range(0, condensed.shape[0], block_size):
+        sha.update(np.ascontiguousarray(condensed[i:i + block_size], dtype=np.float64).data)
+    return sha.hexdigest()
+
+
+def get_pyramid_path(diff_dist_npy_file_path):
     """
-    Dendrogram customised for better readability.
-    https://joernhees.de/blog/2015/08/26/scipy-hierarchical-clustering-and-dendrogram-tutorial/
-    :param files:
-    :param params:
-    :param args:
-    :param kwargs:
-    :return:
+    :return: The folder of the image pyramid of the saved distance difference matrix, or None if it has none
     """
-    max_d = kwargs.pop('max_d', None)
-    if max_d and 'color_threshold' not in kwargs:
-        kwargs['color_threshold'] = max_d
-    annotate_above = kwargs.pop('annotate_above', 0)
-
-    ddata = dendrogram(*args, **kwargs)
-
-    if not kwargs.get('no_plot', False):
-        plt.title('Hierarchical Clustering Dendrogram (truncated)')
-        plt.xlabel('sample index or (cluster size)')
-        plt.ylabel('distance')
-        for i, d, c in zip(ddata['icoord'], ddata['dcoord'], ddata['color_list']):
-            x = 0.5 * sum(i[1:3])
-            y = d[1]
-            if y > annotate_above:
-                plt.plot(x, y, 'o', c=c)
-                plt.annotate("%.2f" % y, (x, y), xytext=(0, -5),
-                             textcoords='offset points',
-                             va='top', ha='center')
-        if max_d:
-            plt.axhline(y=max_d, c='k')
-    return ddata
+    condensed = np.load(diff_dist_npy_file_path, mmap_mode="r")
+    if condensed_num_points(condensed.shape[0]) <= MAX_IMAGE_RESIDUES:
+        return None
+    dir_path = f"{Path(diff_dist_npy_file_path).parent.parent}/{PYRAMID_FOLDER}/{get_matrix_digest(condensed)}"
+    return dir_path if read_pyramid_meta(dir_path) is not None else None
 
 
 def get_motion_tree_outputs(output_path, protein_1, chain_1, protein_2, chain_2, spat_prox, small_node, clust_size, magnitude):
@@ -213,313 +266,161 @@ def get_motion_tree_outputs(output_path, protein_1, chain_1, protein_2, chain_2,
         return None, None, None
 
 
-def write_to_pdb(output_path, protein_1, protein_2, spat_prox, small_node, clust_size, magnitude):
-    try:
-        proteins_folder = f"{protein_1.code}_{protein_1.chain_param}_{protein_2.code}_{protein_2.chain_param}"
-        params_folder = f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
-        pdb_path = f"{output_path}/{proteins_folder}/{params_folder}/{proteins_folder}.pdb"
-        fw = open(pdb_path, "w")
-
-        protein_1_polymer = protein_1.get_polymer()
-        protein_2_polymer = protein_2.get_polymer()
-        util_res_1 = protein_1.utilised_res_indices
-        util_res_2 = protein_2.utilised_res_indices
+def get_pdb_models(protein_1, protein_2, pair=None):
+    """
+    Get the utilised residues of both proteins as the models of the PDB file, with protein 2 superimposed onto protein 1.
+    :return: List of (chain ID, AtomRecords)
+    """
+    protein_1_polymer = protein_1.get_polymer()
+    protein_2_polymer = protein_2.get_polymer()
 
+    if pair is not None:
+        # The superposition was already done in preprocessing
+        transform = pair.get_transform()
+    else:
         ptype = protein_1_polymer.check_polymer_type()
-        superimpose_result = gemmi.calculate_superposition(protein_1_polymer, protein_2_polymer,
-                                                           ptype, gemmi.SupSelect.CaP)
-        protein_2_polymer.transform_pos_and_adp(superimpose_result.transform)
-
-        atom_count = 1
-        fw.write(f"MODEL{'1'.rjust(9, ' ')}\n")
-        for i in util_res_1:
-            r = protein_1_polymer[i]
-            res_name = r.name.rjust(3, " ")
-            res_num = str(r.seqid.num).rjust(4, " ")
-            for a in r:
-                atom_num = str(atom_count).rjust(5, " ")
-                atom_name = a.name.ljust(4, " ")
-                x = str(round(a.pos.x, 3)).rjust(8, " ")
-                y = str(round(a.pos.y, 3)).rjust(8, " ")
-                z = str(round(a.pos.z, 3)).rjust(8, " ")
-                row = f"ATOM  {atom_num} {atom_name} {res_name} A{res_num}    {x}{y}{z}\n"
-                fw.write(row)
-                atom_count += 1
-        fw.write("ENDMDL\n")
-
-        atom_count = 1
-        fw.write(f"MODEL{'2'.rjust(9, ' ')}\n")
-        for i in util_res_2:
-            r = protein_2_polymer[i]
-            res_name = r.name.rjust(3, " ")
-            res_num = str(r.seqid.num).rjust(4, " ")
-            for a in r:
-                atom_num = str(atom_count).rjust(5, " ")
-                atom_name = a.name.ljust(4, " ")
-                x = str(round(a.pos.x, 3)).rjust(8, " ")
-                y = str(round(a.pos.y, 3)).rjust(8, " ")
-                z = str(round(a.pos.z, 3)).rjust(8, " ")
-                row = f"ATOM  {atom_num} {atom_name} {res_name} B{res_num}    {x}{y}{z}\n"
-                fw.write(row)
-                atom_count += 1
-        fw.write("ENDMDL\n")
-
-    except Exception as e:
-        traceback.print_exc()
-        print(e)
-
-
-def write_to_pdb_dyndom(output_path, protein_1, protein_2, spat_prox, small_node, clust_size, magnitude):
-    try:
-        proteins_folder = protein_1.code
-        params_folder = f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
-        pdb_path = f"{output_path}/{proteins_folder}/{params_folder}/{proteins_folder}.pdb"
-        fw = open(pdb_path, "w")
-
-        protein_1_chain = protein_1.get_chain()
-        protein_2_chain = protein_2.get_chain()
-        util_res_1 = protein_1.utilised_res_indices
-        util_res_2 = protein_2.utilised_res_indices
-
-        atom_count = 1
-        fw.write(f"MODEL{'1'.rjust(9, ' ')}\n")
-        for i in util_res_1:
-            r = protein_1_chain[i]
-            res_name = r.name.rjust(3, " ")
-            res_num = str(r.seqid.num).rjust(4, " ")
-            for a in r:
-                atom_num = str(atom_count).rjust(5, " ")
-                atom_name = a.name.ljust(4, " ")
-                x = str(round(a.pos.x, 3)).rjust(8, " ")
-                y = str(round(a.pos.y, 3)).rjust(8, " ")
-                z = str(round(a.pos.z, 3)).rjust(8, " ")
-                row = f"ATOM  {atom_num} {atom_name} {res_name} A{res_num}    {x}{y}{z}\n"
-                fw.write(row)
-                atom_count += 1
-        fw.write("ENDMDL\n")
-
-        atom_count = 1
-        fw.write(f"MODEL{'2'.rjust(9, ' ')}\n")
-        for i in util_res_2:
-            r = protein_2_chain[i]
-            res_name = r.name.rjust(3, " ")
-            res_num = str(r.seqid.num).rjust(4, " ")
-            for a in r:
-                atom_num = str(atom_count).rjust(5, " ")
-                atom_name = a.name.ljust(4, " ")
-                x = str(round(a.pos.x, 3)).rjust(8, " ")
-                y = str(round(a.pos.y, 3)).rjust(8, " ")
-                z = str(round(a.pos.z, 3)).rjust(8, " ")
-                row = f"ATOM  {atom_num} {atom_name} {res_name} B{res_num}    {x}{y}{z}\n"
-                fw.write(row)
-                atom_count += 1
-        fw.write("ENDMDL\n")
-
-    except Exception as e:
-        traceback.print_exc()
-        print(e)
-
+        transform = gemmi.calculate_superposition(protein_1_polymer, protein_2_polymer,
+                                                  ptype, gemmi.SupSelect.CaP).transform
+    # Protein 2 is moved onto protein 1 as its atoms are collected, leaving the cached structure untouched
+    return [
+        ("A", get_atom_records(protein_1_polymer, protein_1.utilised_res_indices)),
+        ("B", get_atom_records(protein_2_polymer, protein_2.utilised_res_indices, transform))
+    ]
 
-def write_domains_to_pml(output_path, protein_1, protein_2, spat_prox, small_node, clust_size, magnitude, nodes, is_dyndom=False):
-    try:
-        if is_dyndom:
-            proteins_folder = protein_1.code
-        else:
-            proteins_folder = f"{protein_1.code}_{protein_1.chain_param}_{protein_2.code}_{protein_2.chain_param}"
-        params_folder = f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
-        num_nodes = len(nodes)
-
-        large_dom_col = "[0  ,255  ,0]"
-        small_dom_col = "[255,0  ,0  ]"
-        non_dom_col = "[128,128,128]"
-        regions = 0
-
-        for i in range(num_nodes-1, -1, -1):
-            node_num = num_nodes - i
-            pml_path = f"{output_path}/{proteins_folder}/{params_folder}/node_{node_num}.pml"
-            fw = open(pml_path, "w")
-            fw.write(f"load {proteins_folder}.pdb, node_{node_num}\n")
-
-            large_domain = nodes[i]["large_domain"]
-            small_domain = nodes[i]["small_domain"]
-
-            non_domain = deepcopy(nodes[i]["large_domain"])
-            non_domain.extend(small_domain)
-
-            # Colour the large domain in protein 1
-            large_dom_res = protein_1.get_residue_nums(large_domain)
-            groups = group_continuous_num(large_dom_res)
-            first_line = True
-            for group in groups:
-                if first_line:
-                    fw.write(f"select region{regions}, node_{node_num} and chain A and resi {group[0]}-{group[-1]}\n")
-                    first_line = False
-                else:
-                    fw.write(f"select region{regions}, region{regions} + (node_{node_num} and chain A and resi {group[0]}-{group[-1]})\n")
-            fw.write(f"set_color colour{regions} = {large_dom_col}\n")
-            fw.write(f"color colour{regions}, region{regions}\n")
-            fw.write("deselect\n")
-            regions += 1
-
-            # Colour the large domain in protein 2
-            large_dom_res = protein_2.get_residue_nums(large_domain)
-            groups = group_continuous_num(large_dom_res)
-            first_line = True
-            for group in groups:
-                if first_line:
-                    fw.write(
-                        f"select region{regions}, node_{node_num} and chain B and resi {group[0]}-{group[-1]}\n")
-                    first_line = False
-                else:
-                    fw.write(
-                        f"select region{regions}, region{regions} + (node_{node_num} and chain B and resi {group[0]}-{group[-1]})\n")
-            fw.write(f"set_color colour{regions} = {large_dom_col}\n")
-            fw.write(f"color colour{regions}, region{regions}\n")
-            fw.write("deselect\n")
-            regions += 1
-
-            # Colour the small domain in protein 1
-            small_dom_res = protein_1.get_residue_nums(small_domain)
-            groups = group_continuous_num(small_dom_res)
-            first_line = True
-            for group in groups:
-                if first_line:
-                    fw.write(f"select region{regions}, node_{node_num} and chain A and resi {group[0]}-{group[-1]}\n")
-                    first_line = False
-                else:
-                    fw.write(f"select region{regions}, region{regions} + (node_{node_num} and chain A and resi {group[0]}-{group[-1]})\n")
-            fw.write(f"set_color colour{regions} = {small_dom_col}\n")
-            fw.write(f"color colour{regions}, region{regions}\n")
-            fw.write("deselect\n")
-            regions += 1
-
-            # Colour the small domain in protein 2
-            small_dom_res = protein_2.get_residue_nums(small_domain)
-            groups = group_continuous_num(small_dom_res)
-            first_line = True
-            for group in groups:
-                if first_line:
-                    fw.write(
-                        f"select region{regions}, node_{node_num} and chain B and resi {group[0]}-{group[-1]}\n")
-                    first_line = False
-                else:
-                    fw.write(
-                        f"select region{regions}, region{regions} + (node_{node_num} and chain B and resi {group[0]}-{group[-1]})\n")
-            fw.write(f"set_color colour{regions} = {small_dom_col}\n")
-            fw.write(f"color colour{regions}, region{regions}\n")
-            fw.write("deselect\n")
-            regions += 1
-
-            # Colour the rest that are not domains as grey in protein 1
-            non_dom_res = protein_1.get_residue_nums(non_domain, utilised=False)
-            if len(non_dom_res) > 0:
-                groups = group_continuous_num(non_dom_res)
-                first_line = True
-                for group in groups:
-                    if first_line:
-                        fw.write(f"select region{regions}, node_{node_num} and chain A and resi {group[0]}-{group[-1]}\n")
-                        first_line = False
-                    else:
-                        fw.write(f"select region{regions}, region{regions} + (node_{node_num} and chain A and resi {group[0]}-{group[-1]})\n")
-                fw.write(f"set_color colour{regions} = {non_dom_col}\n")
-                fw.write(f"color colour{regions}, region{regions}\n")
-                fw.write("deselect\n")
-            regions += 1
-
-            # Colour the rest that are not domains as grey in protein 2
-            non_dom_res = protein_2.get_residue_nums(non_domain, utilised=False)
-            if len(non_dom_res) > 0:
-                groups = group_continuous_num(non_dom_res)
-                first_line = True
-                for group in groups:
-                    if first_line:
-                        fw.write(
-                            f"select region{regions}, node_{node_num} and chain B and resi {group[0]}-{group[-1]}\n")
-                        first_line = False
-                    else:
-                        fw.write(
-                            f"select region{regions}, region{regions} + (node_{node_num} and chain B and resi {group[0]}-{group[-1]})\n")
-                fw.write(f"set_color colour{regions} = {non_dom_col}\n")
-                fw.write(f"color colour{regions}, region{regions}\n")
-                fw.write("deselect\n")
-            regions += 1
 
-    except Exception as e:
-        traceback.print_exc()
-        print(e)
+def get_dyndom_pdb_models(protein_1, protein_2):
+    # The chains of DynDom files are already superimposed
+    return [
+        ("A", get_atom_records(protein_1.get_chain(), protein_1.utilised_res_indices)),
+        ("B", get_atom_records(protein_2.get_chain(), protein_2.utilised_res_indices))
+    ]
 
 
-def write_info_file(output_path, protein_1, protein_2, spat_prox, small_node, clust_size, magnitude, nodes, rmsd, is_dyndom=False):
+def get_ca_pdb_models(protein_1, protein_2, coords_2=None):
+    """
+    Get the utilised CA atoms of both proteins as the models of the PDB file, for proteins that only have CA
+    coordinates, such as trajectory frames. The residue names and numbers come from the proteins' res_names and res_nums
+    arrays instead of gemmi residues.
+    :param coords_2: The CA coordinates of protein 2 (e.g. after superposition). Uses protein 2's coordinates if None.
+    :return: List of (chain ID, AtomRecords)
+    """
+    if coords_2 is None:
+        coords_2 = protein_2.utilised_atoms_coords
+    models = []
+    for chain_id, protein, coords in [("A", protein_1, protein_1.utilised_atoms_coords), ("B", protein_2, coords_2)]:
+        num_atoms = protein.utilised_res_indices.shape[0]
+        models.append((chain_id, AtomRecords(["CA"] * num_atoms, protein.res_names[protein.utilised_res_indices],
+                                             protein.res_nums[protein.utilised_res_indices], coords)))
+    return models
+
+
+def write_domain_outputs(output_path, protein_1, protein_2, spat_prox, small_node, clust_size, magnitude, nodes, rmsd,
+                         is_dyndom=False, pair=None):
+    """
+    Writes the PyMOL script of each node and the domains.info file in one pass over the nodes. The residue numbers of
+    the utilised residues of both proteins are looked up once, and the domains are sliced from them.
+    :param rmsd: The whole protein RMSD written to domains.info
+    """
     if is_dyndom:
         proteins_folder = protein_1.code
     else:
         proteins_folder = f"{protein_1.code}_{protein_1.chain_param}_{protein_2.code}_{protein_2.chain_param}"
     params_folder = f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
-    file_path = f"{output_path}/{proteins_folder}/{params_folder}/domains.info"
-
-    try:
-        fw = open(file_path, "w")
-        num_nodes = len(nodes)
-        fw.write(f"Protein 1 = {protein_1.code} ({protein_1.chain_param})\n")
-        fw.write(f"Protein 2 = {protein_2.code} ({protein_2.chain_param})\n")
-        fw.write(f"Whole Protein RMSD = {rmsd}\n")
-        fw.write(f"Number of Effective Nodes = {num_nodes}\n\n")
-        for i in range(num_nodes - 1, -1, -1):
-            fw.write("==========================================================================\n")
-            fw.write(f"Effective Node {num_nodes - i}\n")
-            fw.write(f"Magnitude = {round(nodes[i]['magnitude'], 2)}\n")
-            fw.write("--------------------------------------------------------------------------\n")
-            large_domain = nodes[i]["large_domain"]
-            small_domain = nodes[i]["small_domain"]
-            large_size = len(large_domain)
-            small_size = len(small_domain)
-
-            fw.write(f"{protein_1.code} ({protein_1.chain_param})\n")
-
-            fw.write(f"Large Domain: {str(large_size).ljust(3, ' ')} Residues\n")
-            large_dom_res = protein_1.get_residue_nums(large_domain)
-            domain_res_str = build_info_dom_res_str(large_dom_res)
-            fw.write(f"Residues: {domain_res_str}\n")
-
-            fw.write(f"Small Domain: {str(small_size).ljust(3, ' ')} Residues\n")
-            small_dom_res = protein_1.get_residue_nums(small_domain)
-            domain_res_str = build_info_dom_res_str(small_dom_res)
-            fw.write(f"Residues: {domain_res_str}\n\n")
-
-            fw.write(f"{protein_2.code} ({protein_2.chain_param})\n")
-
-            fw.write(f"Large Domain: {str(large_size).ljust(3, ' ')} Residues\n")
-            large_dom_res = protein_2.get_residue_nums(large_domain)
-            domain_res_str = build_info_dom_res_str(large_dom_res)
-            fw.write(f"Residues: {domain_res_str}\n")
-
-            fw.write(f"Small Domain: {str(small_size).ljust(3, ' ')} Residues\n")
-            small_dom_res = protein_2.get_residue_nums(small_domain)
-            domain_res_str = build_info_dom_res_str(small_dom_res)
-            fw.write(f"Residues: {domain_res_str}\n\n")
-        fw.close()
-    except Exception as e:
-        traceback.print_exc()
-        print(e)
-
-
-def group_continuous_num(data):
-    # https://stackoverflow.com/questions/2154249/identify-groups-of-consecutive-numbers-in-a-list
-    for k, g in groupby(enumerate(data), lambda ix: ix[0] - ix[1]):
-        yield list(map(itemgetter(1), g))
-
-
-def build_info_dom_res_str(residue_nums):
-    domain_res_str = ""
-    groups = group_continuous_num(residue_nums)
+    dir_path = f"{output_path}/{proteins_folder}/{params_folder}"
+    num_nodes = len(nodes)
+    proteins = [protein_1, protein_2]
+    res_nums = [np.asarray(get_residue_nums(protein_1, 1, pair, slice(None))),
+                np.asarray(get_residue_nums(protein_2, 2, pair, slice(None)))]
+
+    large_dom_col = "[0  ,255  ,0]"
+    small_dom_col = "[255,0  ,0  ]"
+    non_dom_col = "[128,128,128]"
+    regions = 0
+
+    info = [f"Protein 1 = {protein_1.code} ({protein_1.chain_param})\n",
+            f"Protein 2 = {protein_2.code} ({protein_2.chain_param})\n",
+            f"Whole Protein RMSD = {rmsd}\n",
+            f"Number of Effective Nodes = {num_nodes}\n\n"]
+    for i in range(num_nodes - 1, -1, -1):
+        node_num = num_nodes - i
+        large_domain = np.asarray(nodes[i]["large_domain"], dtype=np.intp)
+        small_domain = np.asarray(nodes[i]["small_domain"], dtype=np.intp)
+        non_domain = np.ones(res_nums[0].shape[0], dtype=bool)
+        non_domain[large_domain] = False
+        non_domain[small_domain] = False
+        # The ranges of the residue numbers of the large, small and non-domain residues of protein 1 and 2
+        large_dom_ranges = [get_continuous_ranges(nums[large_domain]) for nums in res_nums]
+        small_dom_ranges = [get_continuous_ranges(nums[small_domain]) for nums in res_nums]
+
+        pml = [f"load {proteins_folder}.pdb, node_{node_num}\n"]
+        # Colour the large domain, the small domain, and the rest that are not domains as grey
+        non_dom_ranges = [get_continuous_ranges(nums[non_domain]) for nums in res_nums]
+        for domain_ranges, colour, skip_empty in [(large_dom_ranges, large_dom_col, False),
+                                                  (small_dom_ranges, small_dom_col, False),
+                                                  (non_dom_ranges, non_dom_col, True)]:
+            for chain_id, (starts, ends) in zip(["A", "B"], domain_ranges):
+                if not skip_empty or len(starts) > 0:
+                    pml.append(build_pml_region_str(node_num, chain_id, regions, colour, starts, ends))
+                regions += 1
+        with open(f"{dir_path}/node_{node_num}.pml", "w") as fw:
+            fw.write("".join(pml))
+
+        info.append("==========================================================================\n")
+        info.append(f"Effective Node {node_num}\n")
+        info.append(f"Magnitude = {round(nodes[i]['magnitude'], 2)}\n")
+        info.append("--------------------------------------------------------------------------\n")
+        for n, protein in enumerate(proteins):
+            info.append(f"{protein.code} ({protein.chain_param})\n")
+            info.append(f"Large Domain: {str(large_domain.shape[0]).ljust(3, ' ')} Residues\n")
+            info.append(f"Residues: {build_info_dom_res_str(*large_dom_ranges[n])}\n")
+            info.append(f"Small Domain: {str(small_domain.shape[0]).ljust(3, ' ')} Residues\n")
+            info.append(f"Residues: {build_info_dom_res_str(*small_dom_ranges[n])}\n\n")
+
+    with open(f"{dir_path}/domains.info", "w") as fw:
+        fw.write("".join(info))
+
+
+def get_residue_nums(protein, protein_num, pair, indices, utilised=True):
+    """
+    Get the residue sequence numbers of the utilised residues at the indices, from the PreprocessedPair if there is one.
+    """
+    if pair is not None:
+        return pair.get_residue_nums(protein_num, indices, utilised)
+    return protein.get_residue_nums(indices, utilised)
 
-    for group in groups:
-        if len(domain_res_str) > 0:
-            domain_res_str = domain_res_str + " , "
-        if len(group) > 1:
-            domain_res_str = domain_res_str + str(group[0]).ljust(3, ' ') + " - " + str(group[-1]).ljust(3, ' ')
-        else:
-            domain_res_str = domain_res_str + str(group[0]).ljust(3, ' ')
 
-    return domain_res_str
+def get_continuous_ranges(residue_nums):
+    """
+    Get the ranges of consecutive residue numbers, in the order of the residues.
+    :param residue_nums: Array of residue numbers
+    :return: Lists of the first and last residue number of each range
+    """
+    residue_nums = np.asarray(residue_nums)
+    num_residues = residue_nums.shape[0]
+    if num_residues == 0:
+        return [], []
+    # A range starts at every residue that does not follow on from the one before
+    is_start = np.empty(num_residues, dtype=bool)
+    is_start[0] = True
+    np.not_equal(residue_nums[1:] - residue_nums[:-1], 1, out=is_start[1:])
+    is_end = np.empty(num_residues, dtype=bool)
+    is_end[:-1] = is_start[1:]
+    is_end[-1] = True
+    return residue_nums[is_start].tolist(), residue_nums[is_end].tolist()
+
+
+def build_pml_region_str(node_num, chain_id, region, colour, starts, ends):
+    # The PyMOL commands selecting the residue ranges of a chain as one region and colouring it
+    lines = [f"select region{region}, node_{node_num} and chain {chain_id} and resi {start}-{end}\n" if j == 0 else
+             f"select region{region}, region{region} + (node_{node_num} and chain {chain_id} and resi {start}-{end})\n"
+             for j, (start, end) in enumerate(zip(starts, ends))]
+    lines.append(f"set_color colour{region} = {colour}\n")
+    lines.append(f"color colour{region}, region{region}\n")
+    lines.append("deselect\n")
+    return "".join(lines)
+
+
+def build_info_dom_res_str(starts, ends):
+    return " , ".join([f"{str(start).ljust(3, ' ')} - {str(end).ljust(3, ' ')}" if start != end else
+                       str(start).ljust(3, ' ') for start, end in zip(starts, ends)])
 
@@ -1,5 +1,6 @@
 import sys
 import ctypes
+import multiprocessing
 from BuilderPageGUI import BuilderPage, DynDomBuilderPage
 from HelpPageGUI import HelpPage
 from OutputWindowGUI import OutputWindow
@@ -13,8 +14,6 @@ screensize = user32.GetSystemMetrics(0), user32.GetSystemMetrics(1)
 # Used to fit display into correct resolution
 user32.SetProcessDPIAware()
 
-gui_app = QApplication(sys.argv)
-
 
 class MainWindow(QMainWindow):
     def __init__(self, app):
@@ -158,7 +157,11 @@ class MainWindow(QMainWindow):
         self.quit_app()
 
 
-window = MainWindow(gui_app)
-window.show()
-gui_app.exec()
+if __name__ == '__main__':
+    # The rendering processes start this script again, which must not open another window
+    multiprocessing.freeze_support()
+    gui_app = QApplication(sys.argv)
+    window = MainWindow(gui_app)
+    window.show()
+    gui_app.exec()
 
@@ -0,0 +1,271 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from matplotlib import colormaps
+from DistanceMatrix import condensed_index, condensed_num_points
+"""
+Tiled image pyramid of a distance difference matrix for zoomable viewing of large proteins. Level 0 is the matrix at full
+resolution (one pixel per residue pair) and each level above halves the resolution by taking the maximum (or mean) of
+every 2x2 block of the level below, until the whole matrix fits in one tile. The tiles are PNG files coloured on one
+scale for the whole matrix, written once into the folder of the pyramid:
+
+    pyramid.json                 The size, tile size, number of levels and colour scale
+    <level>/<row>_<col>.png      The tiles of each level
+
+The matrix is read in strips of rows from the condensed matrix, which can be memory-mapped, and only one strip per level
+is held in memory. As the matrix is symmetric, only the tiles on and above the diagonal are computed and the tiles below
+are written transposed. pyramid.json is written last, so a pyramid without it is incomplete.
+"""
+
+TILE_SIZE = 256
+PYRAMID_VERSION = 1
+# zlib level of the tiles. The tiles of noisy matrices hardly compress, so a fast level is used.
+PNG_COMPRESS_LEVEL = 1
+
+
+def get_num_levels(num_residues, tile_size=TILE_SIZE):
+    # The number of levels until the matrix fits in one tile
+    num_levels = 1
+    while num_residues > tile_size:
+        num_residues = -(-num_residues // 2)
+        num_levels += 1
+    return num_levels
+
+
+def downsample(block, reduce="max"):
+    """
+    Halves the resolution of a 2D array by reducing every 2x2 block. Odd edges are reduced from the values there are.
+    :param block: 2D array
+    :param reduce: "max" or "mean"
+    :return: Array of ceil(rows / 2) x ceil(columns / 2)
+    """
+    rows, cols = block.shape
+    pad_value = -np.inf if reduce == "max" else np.nan
+    if rows % 2 or cols % 2:
+        block = np.pad(block, ((0, rows % 2), (0, cols % 2)), constant_values=pad_value)
+    blocks = block.reshape(block.shape[0] // 2, 2, block.shape[1] // 2, 2)
+    if reduce == "max":
+        return blocks.max(axis=(1, 3))
+    if reduce == "mean":
+        return np.nanmean(blocks, axis=(1, 3))
+    raise ValueError(f"Unknown reduction: {reduce}")
+
+
+def get_upper_strip(condensed, n, row_start, row_end):
+    """
+    Get the rows of the square matrix from the diagonal onwards, i.e. the columns row_start to n, with the block on the
+    diagonal filled in from its upper triangle.
+    :return: (row_end - row_start) x (n - row_start) array
+    """
+    strip = np.zeros((row_end - row_start, n - row_start))
+    for k, i in enumerate(range(row_start, row_end)):
+        if i < n - 1:
+            start = condensed_index(n, i, i + 1)
+            strip[k, k + 1:] = condensed[start:start + n - i - 1]
+    return fill_diagonal_block(strip)
+
+
+def fill_diagonal_block(strip):
+    # The entries left of the diagonal of the first rows x rows block are the transpose of the ones right of it
+    height = strip.shape[0]
+    diagonal_block = strip[:, :height]
+    strip[:, :height] = np.triu(diagonal_block) + np.triu(diagonal_block, 1).T
+    return strip
+
+
+class PyramidBuilder:
+    def __init__(self, dir_path, num_residues, vmax, tile_size=TILE_SIZE, reduce="max", cmap="viridis"):
+        """
+        Writes the tiles of the levels from strips of level 0 rows, starting from the top of the matrix.
+        :param dir_path: The folder of the pyramid
+        :param num_residues: The number of rows and columns of the matrix
+        :param vmax: The value drawn with the last colour of the colour map (0 is drawn with the first)
+        :param reduce: How the levels are reduced, "max" or "mean"
+        :param cmap: The name of the matplotlib colour map
+        """
+        self.dir_path = dir_path
+        self.num_residues = num_residues
+        self.vmax = vmax
+        self.tile_size = tile_size
+        self.reduce = reduce
+        self.cmap = cmap
+        self.num_levels = get_num_levels(num_residues, tile_size)
+        # The strips of each level waiting for a full row of tiles, and the next row of tiles of each level
+        self.pending = [[] for _ in range(self.num_levels)]
+        self.next_rows = [0] * self.num_levels
+        self.num_tiles = 0
+        # The tiles are 8-bit palette images of the colour map's colours, the same colours as drawing it with matplotlib
+        colours = colormaps[cmap]
+        self.palette = colours(np.arange(colours.N), bytes=True)[:, :3].ravel().tolist()
+        self.num_colours = colours.N
+        for level in range(self.num_levels):
+            os.makedirs(f"{dir_path}/{level}", exist_ok=True)
+
+    def add_strip(self, level, strip):
+        """
+        :param level: The level of the strip
+        :param strip: The next rows of the level, from their diagonal to the last column
+        """
+        self.pending[level].append(strip)
+        if sum(s.shape[0] for s in self.pending[level]) >= self.tile_size:
+            self.flush(level)
+
+    def flush(self, level):
+        # Writes the pending rows of the level as a row of tiles and passes them on to the next level
+        strips = self.pending[level]
+        if len(strips) == 0:
+            return
+        self.pending[level] = []
+        width = strips[0].shape[1]
+        # Later strips start further right. The gaps are below the diagonal and filled in from above it.
+        strip = fill_diagonal_block(np.vstack([np.pad(s, ((0, 0), (width - s.shape[1], 0))) for s in strips]))
+        row = self.next_rows[level]
+        self.next_rows[level] += 1
+        for j in range(0, width, self.tile_size):
+            col = row + j // self.tile_size
+            tile = strip[:, j:j + self.tile_size]
+            self.write_tile(level, row, col, tile)
+            if col != row:
+                self.write_tile(level, col, row, tile.T)
+        if level + 1 < self.num_levels:
+            self.add_strip(level + 1, downsample(strip, self.reduce))
+
+    def write_tile(self, level, row, col, tile):
+        scale = self.num_colours / self.vmax if self.vmax > 0 else 0.0
+        colour_indices = np.clip(tile * scale, 0, self.num_colours - 1).astype(np.uint8)
+        image = Image.fromarray(np.ascontiguousarray(colour_indices))
+        # Makes the greyscale image a palette image
+        image.putpalette(self.palette)
+        image.save(get_tile_path(self.dir_path, level, row, col), compress_level=PNG_COMPRESS_LEVEL)
+        self.num_tiles += 1
+
+    def finish(self):
+        for level in range(self.num_levels):
+            self.flush(level)
+
+
+def build_pyramid(condensed, dir_path, tile_size=TILE_SIZE, reduce="max", cmap="viridis", source_path=None):
+    """
+    Writes the image pyramid of a condensed distance difference matrix.
+    :param condensed: The condensed matrix, or the path to its .npy file, which is memory-mapped
+    :param dir_path: The folder of the pyramid
+    :param source_path: The file the matrix was read from. The pyramid is not written again while it is unchanged.
+    :return: The folder of the pyramid
+    """
+    if isinstance(condensed, str):
+        source_path = condensed
+        condensed = np.load(condensed, mmap_mode="r")
+    n = condensed_num_points(condensed.shape[0])
+    if source_path is not None:
+        stat = os.stat(source_path)
+        source_stamp = [stat.st_mtime_ns, stat.st_size]
+    else:
+        source_stamp = None
+    if source_stamp is not None:
+        meta = read_pyramid_meta(dir_path)
+        if (meta is not None and meta["source_stamp"] == source_stamp and meta["num_residues"] == n
+                and meta["tile_size"] == tile_size and meta["reduce"] == reduce and meta["cmap"] == cmap):
+            return dir_path
+
+    # The tiles are not complete again until the new pyramid.json is written
+    try:
+        os.remove(f"{dir_path}/pyramid.json")
+    except FileNotFoundError:
+        pass
+    # The colour scale is the same for every tile
+    block_size = 1 << 22
+    vmax = max([float(np.max(condensed[i:i + block_size])) for i in range(0, condensed.shape[0], block_size)],
+               default=0.0)
+    builder = PyramidBuilder(dir_path, n, vmax, tile_size, reduce, cmap)
+    for row_start in range(0, n, tile_size):
+        builder.add_strip(0, get_upper_strip(condensed, n, row_start, min(row_start + tile_size, n)))
+    builder.finish()
+    meta = {
+        "version": PYRAMID_VERSION,
+        "num_residues": n,
+        "tile_size": tile_size,
+        "num_levels": builder.num_levels,
+        "reduce": reduce,
+        "cmap": cmap,
+        "vmin": 0.0,
+        "vmax": vmax,
+        "source_stamp": source_stamp
+    }
+    tmp_path = f"{dir_path}/pyramid.json.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as fw:
+        json.dump(meta, fw)
+    os.replace(tmp_path, f"{dir_path}/pyramid.json")
+    return dir_path
+
+
+def get_tile_path(dir_path, level, row, col):
+    return f"{dir_path}/{level}/{row}_{col}.png"
+
+
+def read_pyramid_meta(dir_path):
+    try:
+        with open(f"{dir_path}/pyramid.json", "r") as fr:
+            meta = json.load(fr)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == PYRAMID_VERSION else None
+
+
+class ImagePyramid:
+    def __init__(self, dir_path):
+        """
+        A written image pyramid, for viewers to find the tiles of the part of the matrix in view.
+        :param dir_path: The folder of the pyramid
+        """
+        meta = read_pyramid_meta(dir_path)
+        if meta is None:
+            raise FileNotFoundError(f"No complete image pyramid in {dir_path}")
+        self.dir_path = dir_path
+        self.num_residues = meta["num_residues"]
+        self.tile_size = meta["tile_size"]
+        self.num_levels = meta["num_levels"]
+        self.reduce = meta["reduce"]
+        self.cmap = meta["cmap"]
+        self.vmin = meta["vmin"]
+        self.vmax = meta["vmax"]
+
+    def get_level(self, scale):
+        """
+        Get the level to draw at a scale, the coarsest level with at least one pixel per screen pixel.
+        :param scale: Screen pixels per residue
+        :return: The level
+        """
+        level = 0
+        while level + 1 < self.num_levels and scale * (1 << (level + 1)) <= 1:
+            level += 1
+        return level
+
+    def get_level_size(self, level):
+        # The number of pixels along each side of the level
+        size = self.num_residues
+        for _ in range(level):
+            size = -(-size // 2)
+        return size
+
+    def get_num_tiles(self, level):
+        return -(-self.get_level_size(level) // self.tile_size)
+
+    def get_tile_path(self, level, row, col):
+        return get_tile_path(self.dir_path, level, row, col)
+
+    def get_tiles_in_view(self, level, x_start, y_start, x_end, y_end):
+        """
+        Get the tiles of a level covering a part of the matrix.
+        :param x_start: The first column (residue index) in view
+        :param y_start: The first row (residue index) in view
+        :param x_end: The column after the last one in view
+        :param y_end: The row after the last one in view
+        :return: List of (row, column, residue index of the tile's first row, residue index of its first column, path)
+        """
+        residues_per_tile = self.tile_size << level
+        num_tiles = self.get_num_tiles(level)
+        rows = range(max(0, int(y_start) // residues_per_tile), min(num_tiles, -(-int(y_end) // residues_per_tile)))
+        cols = range(max(0, int(x_start) // residues_per_tile), min(num_tiles, -(-int(x_end) // residues_per_tile)))
+        return [(row, col, row * residues_per_tile, col * residues_per_tile, self.get_tile_path(level, row, col))
+                for row in rows for col in cols]
@@ -1,16 +1,53 @@
+import os
+import shutil
+import tempfile
+import traceback
+import weakref
 import numpy as np
 import gemmi
+from pathlib import Path
 from copy import deepcopy
 from timeit import default_timer
 from statistics import mean
 from Protein import Protein
-from FileMngr import ftp_files_to_disk, save_results_to_disk, write_info_file, write_to_pdb, write_domains_to_pml, \
-    check_if_dyndom_file_exists, write_to_pdb_dyndom
+from Alignment import alignment_cache
+from DiffMatrixCache import diff_matrix_cache
+from Renderer import wait_for_renders
+from PreprocessedPair import build_preprocessed_pair, load_preprocessed_pair, get_pair_file_path
+from DistanceMatrix import condensed_size, condensed_num_points, condensed_index, condensed_pair, get_block, \
+    get_diff_distance_matrix, get_diff_distances_and_contacts, to_condensed, to_square, create_memmap, fill_blocks, \
+    find_min
+from FileMngr import ftp_files_to_disk, save_results_to_disk, save_diff_dist_pyramid, write_domain_outputs, \
+    check_if_dyndom_file_exists, get_pdb_models, get_dyndom_pdb_models
+from PdbWriter import write_pdb_models
+from ResultBundle import ResultBundle, load_bundle, get_bundle_path, get_bundle_lock, get_coords_digest
+
+
+# The number of matrix entries the clustering kernels read at a time
+BLOCK_SIZE = 1 << 20
+# The smallest block size used with a memory budget
+MIN_BLOCK_SIZE = 1 << 16
 
 
 class MotionTree:
     def __init__(self, input_path, output_path, protein_1_name, chain_1, protein_2_name, chain_2,
-                 spat_prox=7.0, small_node=5, clust_size=30, magnitude=5, is_dyndom=False):
+                 spat_prox=7.0, small_node=5, clust_size=30, magnitude=5, is_dyndom=False, fetch_files=True,
+                 reuse_pair=True, memory_budget=None, scratch_path=None, use_diff_cache=True, output_mode="files",
+                 output_pipeline=None):
+        """
+        :param memory_budget: The number of bytes the matrices may use in memory. When the distance difference, contact
+        and cluster distance matrices of the proteins are larger than this, they are kept in memory-mapped files in the
+        scratch folder instead (out-of-core mode), and read in blocks sized to the budget. None keeps them in memory.
+        :param scratch_path: The folder of the memory-mapped files. None uses the system temporary folder.
+        :param use_diff_cache: Whether to reuse and store the distance difference and contact matrices in the on-disk
+        cache (DiffMatrixCache)
+        :param output_mode: "files" writes the output files of the run into its parameters folder. "bundle" adds the
+        results to the single-file bundle of the proteins instead (see ResultBundle), from which the files can be written
+        when needed.
+        :param output_pipeline: The OutputPipeline the outputs of run are written in, so that the caller can start the
+        next motion tree while they are written. The Future of the outputs is output_future. None writes the outputs
+        before run returns.
+        """
         self.input_path = input_path
         self.output_path = output_path
         self.protein_1_name = protein_1_name
@@ -31,8 +68,37 @@ class MotionTree:
         self.match_str_1 = ""
         self.match_str_2 = ""
         self.rmsd = 0
-        # The starting distance difference matrix
+        # The gemmi.Transform superimposing protein 2 onto protein 1
+        self.superimpose_transform = None
+        # The PreprocessedPair of the proteins, made by preprocessing()
+        self.pair = None
+        # Whether preprocessing() uses the pair saved by an earlier run of the same proteins
+        self.reuse_pair = reuse_pair
+        # The starting distance difference matrix, in condensed form
         self.diff_dist_mat_init = None
+        # The number of residues of the distance difference matrix
+        self.num_points = None
+        # Condensed boolean matrices of the residue pairs within the spatial proximity in protein 1 and 2
+        self.contact_mat_1 = None
+        self.contact_mat_2 = None
+        self.memory_budget = memory_budget
+        self.use_diff_cache = use_diff_cache
+        self.scratch_path = scratch_path
+        if output_mode not in ["files", "bundle"]:
+            raise ValueError(f"Unknown output mode: {output_mode}")
+        self.output_mode = output_mode
+        self.output_pipeline = output_pipeline
+        # The Future of the outputs of the last run in the output pipeline
+        self.output_future = None
+        # Whether the matrices are kept in memory-mapped files, decided by dist_mat_processing()
+        self.is_out_of_core = False
+        # The number of matrix entries the clustering kernels read at a time
+        self.block_size = BLOCK_SIZE
+        # The folder of this engine's memory-mapped files, removed by close()
+        self.scratch_dir = None
+        self._scratch_finalizer = None
+        # The Futures of the images being drawn in the rendering pool
+        self.image_futures = []
         self.num_residues = None
         # Dictionary storing the clusters containing the index of the atoms
         # self.clusters = {i: [i] for i in range(self.diff_dist_mat_init.shape[0])}
@@ -44,6 +110,9 @@ class MotionTree:
         self.is_dyndom = is_dyndom
         self.is_db_connected = True
 
+        # Sources that do not come from structure files (e.g. trajectories) set the proteins themselves
+        if not fetch_files:
+            return
         if self.protein_2_name is not None:
             ftp_files_to_disk(self.input_path, self.protein_1_name, self.protein_2_name)
         else:
@@ -85,26 +154,24 @@ class MotionTree:
 
     def check_sequence_identity_standard(self):
         """
-        Check the sequence identity of the protein chains using sequence alignment from Gemmi
+        Check the sequence identity of the protein chains using sequence alignment. Long, nearly identical chains are
+        aligned between exact k-mer anchors. Otherwise, the full alignment from Gemmi is used. Alignments are cached on
+        disk by the sequences, so a pair of sequences is only aligned once.
         :return:
         """
-        polymer_1_entity: gemmi.Entity = self.protein_1.get_polymer_entity()
-        polymer_2_entity: gemmi.Entity = self.protein_2.get_polymer_entity()
-        print(polymer_1_entity.full_sequence)
-        print(polymer_2_entity.full_sequence)
-        polymer_1 = self.protein_1.get_polymer()
-        polymer_2 = self.protein_2.get_polymer()
+        sequence_1 = self.protein_1.get_ca_data().sequence
+        sequence_2 = self.protein_2.get_ca_data().sequence
+        print(sequence_1)
+        print(sequence_2)
 
-        result = gemmi.align_string_sequences(list(gemmi.one_letter_code(polymer_1.extract_sequence())),
-                                              list(gemmi.one_letter_code(polymer_2.extract_sequence())),
-                                              [])
+        result = alignment_cache.align(sequence_1, sequence_2)
         print(result.calculate_identity(1), result.calculate_identity(2))
         if min(result.calculate_identity(1), result.calculate_identity(2)) < 90:
             raise ValueError("Sequence Identity less than 90%")
         self.similarity = min(result.calculate_identity(1), result.calculate_identity(2))
         self.cigar_str = result.cigar_str()
-        self.match_str_1 = result.add_gaps(gemmi.one_letter_code(polymer_1.extract_sequence()), 1)
-        self.match_str_2 = result.add_gaps(gemmi.one_letter_code(polymer_2.extract_sequence()), 2)
+        self.match_str_1 = result.add_gaps(sequence_1, 1)
+        self.match_str_2 = result.add_gaps(sequence_2, 2)
         # print(self.cigar_str)
         print(self.match_str_1)
         print(self.match_str_2)
@@ -122,13 +189,28 @@ class MotionTree:
         if chain_superimpose_result.rmsd < 1:
             raise ValueError("Proteins RMSD less than 1")
         self.rmsd = chain_superimpose_result.rmsd
+        self.superimpose_transform = chain_superimpose_result.transform
 
     def preprocessing(self):
+        """
+        Aligns the proteins, finds the utilised residues and superimposes protein 2 onto protein 1. The results are kept
+        in a PreprocessedPair which is saved in the proteins' output folder. If a pair saved from the same structure
+        files exists, it is used instead.
+        :return:
+        """
         print("Checking Sequence")
+        pair_path = get_pair_file_path(self.output_path, self.get_proteins_folder())
+        if self.reuse_pair:
+            pair = load_preprocessed_pair(pair_path)
+            if pair is not None and pair.matches(self.protein_1, self.protein_2, self.is_dyndom):
+                self.set_pair(pair)
+                print("Sequence Checked")
+                return
         if self.is_dyndom:
             coords_1, coords_2, poses_1, poses_2, utilised_res_ind_1, utilised_res_ind_2 = self.get_ca_atoms_coords_dyndom()
             chain_superimpose_result = gemmi.superpose_positions(poses_1, poses_2)
             self.rmsd = chain_superimpose_result.rmsd
+            self.superimpose_transform = chain_superimpose_result.transform
         else:
             self.check_sequence_identity_standard()
             self.check_rmsd_standard()
@@ -138,18 +220,135 @@ class MotionTree:
         self.protein_1.utilised_res_indices = np.asarray(utilised_res_ind_1)
         self.protein_2.utilised_atoms_coords = np.asarray(coords_2)
         self.protein_2.utilised_res_indices = np.asarray(utilised_res_ind_2)
+        self.pair = build_preprocessed_pair(self.protein_1, self.protein_2, self.is_dyndom, self.rmsd,
+                                            self.superimpose_transform, None if self.is_dyndom else self.similarity,
+                                            self.cigar_str, self.match_str_1, self.match_str_2)
+        try:
+            Path(pair_path).parent.mkdir(parents=True, exist_ok=True)
+            self.pair.save(pair_path)
+        except Exception as e:
+            traceback.print_exc()
+            print(e)
         print("Sequence Checked")
 
+    def set_pair(self, pair):
+        """
+        Sets the alignment, RMSD, utilised residues and coordinates of the proteins from a PreprocessedPair.
+        :param pair: PreprocessedPair
+        :return:
+        """
+        self.pair = pair
+        self.rmsd = pair.rmsd
+        self.superimpose_transform = pair.get_transform()
+        if pair.identity is not None:
+            self.similarity = pair.identity
+        self.cigar_str = pair.cigar_str
+        self.match_str_1 = pair.match_str_1
+        self.match_str_2 = pair.match_str_2
+        self.num_residues = pair.num_residues
+        self.protein_1.utilised_atoms_coords = pair.coords_1
+        self.protein_1.utilised_res_indices = pair.res_indices_1
+        self.protein_2.utilised_atoms_coords = pair.coords_2
+        self.protein_2.utilised_res_indices = pair.res_indices_2
+
+    def get_proteins_folder(self):
+        if self.chain_1 is not None:
+            return f"{self.protein_1_name}_{self.chain_1}_{self.protein_2_name}_{self.chain_2}"
+        return self.protein_1_name
+
     def dist_mat_processing(self):
         """
         Handles the distance matrices of the proteins. First connects to the database to see if the proteins with
         the distance matrices exist. If it does not exist, the distance matrix is created and stored into the database.
         If something goes wrong when connecting to the database, go straight to offline data management, which is using
         the disk storage.
+        The distance difference matrix and the contact matrices are computed in one pass over the coordinates of both
+        proteins, without making their distance matrices. Proteins whose distance matrices were made beforehand (e.g.
+        shared by the model pairs of an ensemble) use those instead. Matrices of the same coordinates made by an earlier
+        run are read from the on-disk cache. The pairs of proteins with distance matrices made beforehand (ensembles,
+        trajectories and conformer pairs) are not looked up or stored, as they are cheap to make and rarely repeat.
         :return:
         """
-        self.protein_1.get_distance_matrix()
-        self.protein_2.get_distance_matrix()
+        dist_mat_1 = self.protein_1.distance_matrix
+        dist_mat_2 = self.protein_2.distance_matrix
+        coords_1 = self.protein_1.utilised_atoms_coords
+        coords_2 = self.protein_2.utilised_atoms_coords
+        self.set_memory_mode(coords_1.shape[0])
+        use_diff_cache = self.use_diff_cache and (dist_mat_1 is None or dist_mat_2 is None)
+        if use_diff_cache:
+            cached = diff_matrix_cache.lookup(coords_1, coords_2, self.spat_prox)
+            if cached is not None:
+                # The cached matrices are memory maps, so they do not count against the memory budget
+                self.diff_dist_mat_init, self.contact_mat_1, self.contact_mat_2 = cached
+                return
+        if self.is_out_of_core:
+            size = condensed_size(coords_1.shape[0])
+            out = (self.create_scratch_matrix("diff_dist_mat_init", size, np.float64),
+                   self.create_scratch_matrix("contact_mat_1", size, bool),
+                   self.create_scratch_matrix("contact_mat_2", size, bool))
+            self.diff_dist_mat_init, self.contact_mat_1, self.contact_mat_2 = get_diff_distances_and_contacts(
+                coords_1, coords_2, self.spat_prox, self.block_size, out)
+        elif dist_mat_1 is not None and dist_mat_2 is not None:
+            self.diff_dist_mat_init = get_diff_distance_matrix(dist_mat_1, dist_mat_2)
+            self.contact_mat_1 = dist_mat_1 < self.spat_prox
+            self.contact_mat_2 = dist_mat_2 < self.spat_prox
+        else:
+            self.diff_dist_mat_init, self.contact_mat_1, self.contact_mat_2 = get_diff_distances_and_contacts(
+                coords_1, coords_2, self.spat_prox)
+        if use_diff_cache:
+            diff_matrix_cache.store(coords_1, coords_2, self.spat_prox, self.diff_dist_mat_init, self.contact_mat_1,
+                                    self.contact_mat_2)
+
+    def set_memory_mode(self, num_residues):
+        """
+        Decides whether the matrices of the residues fit in the memory budget, and sets the block size of the kernels.
+        :param num_residues: The number of utilised residues
+        :return: Whether the matrices are kept in memory-mapped files
+        """
+        # The distance difference matrix, both contact matrices and the cluster distance matrix
+        size = condensed_size(num_residues)
+        num_bytes = size * (8 + 1 + 1) + condensed_size(2 * num_residues - 1) * 8
+        self.is_out_of_core = self.memory_budget is not None and num_bytes > self.memory_budget
+        if self.is_out_of_core:
+            # Leave room for the several temporary arrays the kernels make from each block
+            self.block_size = max(MIN_BLOCK_SIZE, self.memory_budget // 64)
+        else:
+            self.block_size = BLOCK_SIZE
+        return self.is_out_of_core
+
+    def create_scratch_matrix(self, name, size, dtype):
+        """
+        Creates a condensed matrix in a memory-mapped file in this engine's scratch folder, filled with zeros.
+        :return: numpy.memmap
+        """
+        if self.scratch_dir is None:
+            if self.scratch_path is not None:
+                os.makedirs(self.scratch_path, exist_ok=True)
+            self.scratch_dir = tempfile.mkdtemp(prefix="motion_tree_", dir=self.scratch_path)
+            # Remove the files even if close() is never called
+            self._scratch_finalizer = weakref.finalize(self, shutil.rmtree, self.scratch_dir, True)
+        return create_memmap(f"{self.scratch_dir}/{name}.npy", size, dtype)
+
+    def close(self):
+        """
+        Removes the memory-mapped files of the out-of-core mode. The matrices kept in them cannot be used afterwards.
+        """
+        if self._scratch_finalizer is not None:
+            self.diff_dist_mat_init = None
+            self.contact_mat_1 = None
+            self.contact_mat_2 = None
+            self._scratch_finalizer()
+            self._scratch_finalizer = None
+            self.scratch_dir = None
+
+    def wait_for_images(self):
+        """
+        Waits for the images of the distance difference matrix and motion tree, and the image pyramid, to be drawn.
+        :return: List of the image paths and pyramid folder
+        """
+        paths = wait_for_renders(self.image_futures)
+        self.image_futures = []
+        return paths
 
     def get_ca_atoms_coords_standard(self):
         """
@@ -168,159 +367,135 @@ class MotionTree:
         Protein 1 Residue Sequence Numbers [ 1 2 3 4 * * * 8 9 ...]
         Protein 2 Residue Sequence Numbers [ 1 2 3 4 5 6 7 8 9 ...]
 
-        :return atom_coords_1: List of coordinates of the CA atoms in Protein 1
-        :return atom_coords_2: List of coordinates of the CA atoms in Protein 2
-        :return utilised_res_ind_1: List of the indices of the residues that are used in Protein 1. Not the sequence ID number.
-        :return utilised_res_ind_2: List of the indices of the residues that are used in Protein 2. Not the sequence ID number.
-        """
-
-        # Get the protein 1 and 2 polymer chains. This excludes residues which are only water.
-        protein_1_polymer = self.protein_1.get_polymer()
-        protein_2_polymer = self.protein_2.get_polymer()
-        # Get the length of the polymers
-        protein_1_size = len(protein_1_polymer)
-        protein_2_size = len(protein_2_polymer)
-        # The indices to iterate the polymers
-        match_index = 0
-        index_1 = 0
-        index_2 = 0
-        # Stores the coordinates of the CA atoms
-        atom_coords_1 = []
-        atom_coords_2 = []
-        # Stores the index of the CA atoms in the chains
-        utilised_res_ind_1 = []
-        utilised_res_ind_2 = []
-
-        while index_1 < protein_1_size and index_2 < protein_2_size:
-            if self.match_str_1[match_index] == "-":
-                index_2 += 1
-                match_index += 1
-                continue
-            elif self.match_str_2[match_index] == "-":
-                index_1 += 1
-                match_index += 1
-                continue
-            atom_coord_1 = None
-            atom_coord_2 = None
-            # print(index_1, index_2)
-            for a in protein_1_polymer[index_1]:
-                if a.name == "CA":
-                    atom_coord_1 = a.pos.tolist()
-                    break
-            for a in protein_2_polymer[index_2]:
-                if a.name == "CA":
-                    atom_coord_2 = a.pos.tolist()
-                    break
-            if atom_coord_1 is not None and atom_coord_2 is not None:
-                utilised_res_ind_1.append(index_1)
-                utilised_res_ind_2.append(index_2)
-                atom_coords_1.append(atom_coord_1)
-                atom_coords_2.append(atom_coord_2)
-
-            match_index += 1
-            index_1 += 1
-            index_2 += 1
-
-        # print(len(self.match_str_1))
-        # print(len(atom_coords_1))
+        :return atom_coords_1: Array of coordinates of the CA atoms in Protein 1
+        :return atom_coords_2: Array of coordinates of the CA atoms in Protein 2
+        :return utilised_res_ind_1: Array of the indices of the residues that are used in Protein 1. Not the sequence ID number.
+        :return utilised_res_ind_2: Array of the indices of the residues that are used in Protein 2. Not the sequence ID number.
+        """
+
+        # Get the CA data of the protein 1 and 2 polymer chains. This excludes residues which are only water.
+        ca_data_1 = self.protein_1.get_ca_data()
+        ca_data_2 = self.protein_2.get_ca_data()
+        # Residues are only present in the alignment columns without a gap
+        is_res_1 = np.frombuffer(self.match_str_1.encode(), dtype="S1") != b"-"
+        is_res_2 = np.frombuffer(self.match_str_2.encode(), dtype="S1") != b"-"
+        # The residue index of every alignment column is the number of residues in the columns before it
+        col_res_ind_1 = np.cumsum(is_res_1) - 1
+        col_res_ind_2 = np.cumsum(is_res_2) - 1
+        is_aligned = is_res_1 & is_res_2
+        res_ind_1 = col_res_ind_1[is_aligned]
+        res_ind_2 = col_res_ind_2[is_aligned]
+        in_range = (res_ind_1 < len(ca_data_1)) & (res_ind_2 < len(ca_data_2))
+        res_ind_1 = res_ind_1[in_range]
+        res_ind_2 = res_ind_2[in_range]
+        # Only use the aligned residues where both residues have a CA atom
+        has_ca = ca_data_1.has_ca[res_ind_1] & ca_data_2.has_ca[res_ind_2]
+        utilised_res_ind_1 = res_ind_1[has_ca]
+        utilised_res_ind_2 = res_ind_2[has_ca]
+        atom_coords_1 = ca_data_1.coords[utilised_res_ind_1]
+        atom_coords_2 = ca_data_2.coords[utilised_res_ind_2]
         return atom_coords_1, atom_coords_2, utilised_res_ind_1, utilised_res_ind_2
 
     def get_ca_atoms_coords_dyndom(self):
-        protein_1_chain = self.protein_1.get_chain()
-        protein_2_chain = self.protein_2.get_chain()
-        atom_coords_1 = []
-        atom_coords_2 = []
-        atom_poses_1 = []
-        atom_poses_2 = []
-        utilised_res_ind_1 = []
-        utilised_res_ind_2 = []
-        seq_diff = protein_2_chain[0].seqid.num - protein_1_chain[0].seqid.num
-        for i in range(len(protein_1_chain)):
-            try:
-                atom_coord_1 = None
-                atom_coord_2 = None
-                atom_pos_1 = None
-                atom_pos_2 = None
-                for a in protein_1_chain[i]:
-                    if a.name == "CA":
-                        atom_coord_1 = a.pos.tolist()
-                        atom_pos_1 = a.pos
-                        break
-                for a in protein_2_chain[i]:
-                    if a.name == "CA":
-                        atom_coord_2 = a.pos.tolist()
-                        atom_pos_2 = a.pos
-                        break
-                if atom_coord_1 is not None and atom_coord_2 is not None:
-                    atom_coords_1.append(atom_coord_1)
-                    atom_coords_2.append(atom_coord_2)
-                    atom_poses_1.append(atom_pos_1)
-                    atom_poses_2.append(atom_pos_2)
-                    utilised_res_ind_1.append(i)
-                    utilised_res_ind_2.append(i)
-                else:
-                    continue
-            except Exception as e:
-                print(e)
-                break
-        return atom_coords_1, atom_coords_2, atom_poses_1, atom_poses_2, utilised_res_ind_1, utilised_res_ind_2
+        """
+        Get the coordinates of the CA atoms of the two conformations of a DynDom file. Residues are matched by their
+        index in the chains.
+        :return: The coordinate arrays, lists of gemmi.Position of the CA atoms and the residue index arrays of both chains
+        """
+        ca_data_1 = self.protein_1.get_ca_data()
+        ca_data_2 = self.protein_2.get_ca_data()
+        if len(ca_data_2) < len(ca_data_1):
+            print(f"Chain {self.protein_2.chain_param} is shorter than chain {self.protein_1.chain_param}")
+        num_residues = min(len(ca_data_1), len(ca_data_2))
+        utilised_res_ind = np.flatnonzero(ca_data_1.has_ca[:num_residues] & ca_data_2.has_ca[:num_residues])
+        atom_coords_1 = ca_data_1.coords[utilised_res_ind]
+        atom_coords_2 = ca_data_2.coords[utilised_res_ind]
+        atom_poses_1 = [gemmi.Position(*c) for c in atom_coords_1.tolist()]
+        atom_poses_2 = [gemmi.Position(*c) for c in atom_coords_2.tolist()]
+        return atom_coords_1, atom_coords_2, atom_poses_1, atom_poses_2, utilised_res_ind, np.copy(utilised_res_ind)
 
     def create_distance_difference_matrix(self, diff_dist_mat=None):
         """
         Get the distance difference matrix by subtracting one matrix with the other. All values must be positive.
-        :return:
+        :param diff_dist_mat: A distance difference matrix made earlier (e.g. from the database), condensed or square
+        :return: The condensed distance difference matrix
         """
-        if diff_dist_mat is None:
-            self.diff_dist_mat_init = np.absolute(self.protein_1.distance_matrix - self.protein_2.distance_matrix)
-        else:
-            self.diff_dist_mat_init = diff_dist_mat
-        self.clusters = {i: [i] for i in range(self.diff_dist_mat_init.shape[0])}
-        self.link_mat = np.empty((self.diff_dist_mat_init.shape[0] - 1, 4))
+        if self.contact_mat_1 is None:
+            self.dist_mat_processing()
+        if diff_dist_mat is not None:
+            self.diff_dist_mat_init = to_condensed(diff_dist_mat)
+        self.num_points = condensed_num_points(self.diff_dist_mat_init.shape[0])
+        self.clusters = {i: [i] for i in range(self.num_points)}
+        self.link_mat = np.empty((self.num_points - 1, 4))
 
         # print(len(self.match_str_1), len(self.match_str_2))
         # print(len(self.clusters))
         # print(self.diff_dist_mat_init.shape[0])
         # print(self.protein_1.utilised_atoms_coords.shape[0])
         # print(self.protein_1.distance_matrix.shape[0])
-        # Save the difference distance matrix image and array before setting the diagonals to infinity for a cleaner visual.
-        save_results_to_disk(
-            self.output_path,
-            self.protein_1_name,
-            self.chain_1,
-            self.protein_2_name,
-            self.chain_2,
-            self.spat_prox,
-            self.small_node,
-            self.clust_size,
-            self.magnitude,
-            self.diff_dist_mat_init,
-            "diff_dist_mat"
-        )
+        # Save the difference distance matrix image and array. Bundles save it with the results.
+        if self.output_mode == "files":
+            self.image_futures.append(save_results_to_disk(
+                self.output_path,
+                self.protein_1_name,
+                self.chain_1,
+                self.protein_2_name,
+                self.chain_2,
+                self.spat_prox,
+                self.small_node,
+                self.clust_size,
+                self.magnitude,
+                self.diff_dist_mat_init,
+                "diff_dist_mat"
+            ))
+            pyramid_future = save_diff_dist_pyramid(self.output_path, self.protein_1_name, self.chain_1, self.protein_2_name,
+                                                    self.chain_2, self.spat_prox, self.small_node, self.clust_size,
+                                                    self.magnitude, self.diff_dist_mat_init)
+            if pyramid_future is not None:
+                self.image_futures.append(pyramid_future)
         return self.diff_dist_mat_init
 
     def run(self):
         # print_diff_dist_mat(self.diff_dist_mat_init)
-        np.fill_diagonal(self.diff_dist_mat_init, np.inf)
         start = default_timer()
-        diff_dist_mat = np.copy(self.diff_dist_mat_init)
+        diff_dist_mat = self.init_cluster_distance_matrix()
         n = 0
         # print("Clustering")
         while len(self.clusters) > 1:
             # print(self.link_mat.shape[0], n, len(self.clusters))
             diff_dist_mat = self.hierarchical_clustering(diff_dist_mat, n)
-            if type(diff_dist_mat) == int:
-                print("No cluster pair found")
-                # print(diff_dist_mat)
-                # print(self.clusters)
-                # print(len(self.clusters))
-                break
             n += 1
+        if self.is_out_of_core:
+            # Free the disk space of the cluster distance matrix, which is no longer needed
+            del diff_dist_mat
+            try:
+                os.remove(f"{self.scratch_dir}/cluster_dist_mat.npy")
+            except OSError:
+                pass
         # print("Done")
         end = default_timer()
         total_time = end - start
         # print(self.clusters)
         # print("Time:", total_time)
-        save_results_to_disk(
+        results_meta = {"time": round(total_time, 2)}
+        if self.output_pipeline is not None:
+            # The job waits for the images already being drawn, so its Future is done when all outputs are
+            image_futures, self.image_futures = self.image_futures, []
+            self.output_future = self.output_pipeline.submit(self.write_output_job, image_futures, results_meta, True)
+        else:
+            try:
+                self.write_output_job(self.image_futures, results_meta)
+            except Exception as e:
+                traceback.print_exc()
+                print(e)
+        proteins_str = self.get_proteins_folder()
+        params_str = f"sp_{self.spat_prox}_node_{self.small_node}_clust_{self.clust_size}_mag_{self.magnitude}"
+        print(total_time)
+        return round(total_time, 2), len(self.nodes), proteins_str, params_str
+
+    def save_dendrogram(self):
+        # Future of the motion tree image
+        return save_results_to_disk(
             self.output_path,
             self.protein_1_name,
             self.chain_1,
@@ -333,24 +508,87 @@ class MotionTree:
             self.link_mat,
             "dendrogram"
         )
-        write_domains_to_pml(self.output_path, self.protein_1, self.protein_2, self.spat_prox, self.small_node, self.clust_size, self.magnitude, self.nodes, self.is_dyndom)
-        write_info_file(self.output_path, self.protein_1, self.protein_2, self.spat_prox, self.small_node, self.clust_size, self.magnitude, self.nodes, self.rmsd, self.is_dyndom)
+
+    def write_output_job(self, image_futures, results_meta=None, wait_for_images=False):
+        """
+        Writes the outputs of a run: the motion tree image, the PyMOL scripts of the nodes, domains.info and the PDB file
+        of the utilised residues of both proteins, or the results in the bundle. Errors are raised, to the Future of the
+        job in the output pipeline.
+        :param image_futures: The list of the Futures of the images of the run being drawn. The motion tree image is
+        added to it.
+        :param results_meta: Dictionary of other information about the run, stored in the bundle
+        :param wait_for_images: Whether to wait for the images to be drawn
+        :return: List of the image paths if they are waited for
+        """
+        if self.output_mode == "files":
+            image_futures.append(self.save_dendrogram())
+            write_domain_outputs(self.output_path, self.protein_1, self.protein_2, self.spat_prox, self.small_node,
+                                 self.clust_size, self.magnitude, self.nodes, self.rmsd, self.is_dyndom, self.pair)
+            proteins_folder = self.get_proteins_folder()
+            params_folder = f"sp_{self.spat_prox}_node_{self.small_node}_clust_{self.clust_size}_mag_{self.magnitude}"
+            write_pdb_models(f"{self.output_path}/{proteins_folder}/{params_folder}/{proteins_folder}.pdb",
+                             self.get_pdb_models())
+        else:
+            self.write_bundle(results_meta)
+        if wait_for_images:
+            return wait_for_renders(image_futures)
+        return None
+
+    def get_pdb_models(self):
+        """
+        Get the models of the PDB file of the outputs.
+        :return: List of (chain ID, AtomRecords)
+        """
         if self.is_dyndom:
-            write_to_pdb_dyndom(self.output_path, self.protein_1, self.protein_2, self.spat_prox, self.small_node,
-                                self.clust_size, self.magnitude)
-            proteins_str = self.protein_1.code
+            return get_dyndom_pdb_models(self.protein_1, self.protein_2)
+        return get_pdb_models(self.protein_1, self.protein_2, self.pair)
+
+    def write_bundle(self, results_meta=None):
+        """
+        Adds the motion tree and nodes to the result bundle of the proteins (ResultBundle), creating the bundle with the
+        distance difference matrix and PDB models if there is none for the coordinates of the proteins. The output files
+        are written from the bundle when they are needed.
+        :param results_meta: Dictionary of other information about the run, stored with the nodes
+        :return: The name of the proteins folder
+        """
+        proteins_folder = self.get_proteins_folder()
+        bundle_path = get_bundle_path(self.output_path, proteins_folder)
+        coords_digest = get_coords_digest(self.protein_1.utilised_atoms_coords, self.protein_2.utilised_atoms_coords)
+        # Runs of the same proteins can be written by different writers of the output pipeline
+        with get_bundle_lock(bundle_path):
+            bundle = load_bundle(bundle_path, coords_digest)
+            if bundle is None:
+                bundle = ResultBundle.create(bundle_path, self.protein_1, self.protein_2, self.is_dyndom, self.rmsd,
+                                             self.diff_dist_mat_init, self.get_pdb_models(), coords_digest, self.pair)
+            bundle.add_results(self.spat_prox, self.small_node, self.clust_size, self.magnitude, self.link_mat,
+                               self.nodes, results_meta)
+        return proteins_folder
+
+    def init_cluster_distance_matrix(self):
+        """
+        Creates the condensed distance matrix of the clusters. It has a row for every cluster ID the clustering can
+        create (the residues and the N - 1 merged clusters), so it never has to be resized. The distances of clusters
+        that do not exist (yet or anymore) are infinity.
+        :return: The condensed cluster distance matrix
+        """
+        n = self.num_points
+        num_ids = 2 * n - 1
+        if self.is_out_of_core:
+            diff_dist_mat = self.create_scratch_matrix("cluster_dist_mat", condensed_size(num_ids), np.float64)
+            fill_blocks(diff_dist_mat, np.inf, self.block_size)
         else:
-            write_to_pdb(self.output_path, self.protein_1, self.protein_2, self.spat_prox, self.small_node,
-                         self.clust_size, self.magnitude)
-            proteins_str = f"{self.protein_1.code}_{self.protein_1.chain_param}_{self.protein_2.code}_{self.protein_2.chain_param}"
-        params_str = f"sp_{self.spat_prox}_node_{self.small_node}_clust_{self.clust_size}_mag_{self.magnitude}"
-        print(total_time)
-        return round(total_time, 2), len(self.nodes), proteins_str, params_str
+            diff_dist_mat = np.full(condensed_size(num_ids), np.inf)
+        # Row i of the residues holds the distances to residues i + 1 to n - 1 at the start of the row
+        for i in range(n - 1):
+            start = condensed_index(num_ids, i, i + 1)
+            init_start = condensed_index(n, i, i + 1)
+            diff_dist_mat[start:start + n - 1 - i] = self.diff_dist_mat_init[init_start:init_start + n - 1 - i]
+        return diff_dist_mat
 
     def hierarchical_clustering(self, diff_dist_mat, n):
         """
         Perform hierarchical clustering using the distance difference matrix.
-        :param diff_dist_mat:
+        :param diff_dist_mat: The condensed cluster distance matrix
         :param n: The iteration number
         :return:
         """
@@ -360,10 +598,10 @@ class MotionTree:
             # Find the closest pairs of clusters.
             cluster_pair, min_dist = self.get_closest_clusters(diff_dist_mat, visited_clusters)
             # print("Size", self.protein_1.distance_matrix.shape, "Visited", 0 if visited_clusters is None else visited_clusters.shape[0], "Dist clust pair", cluster_pair, min_dist)
-            # If no cluster pairs are found, exit early
+            # Every remaining cluster pair fails the spatial proximity measure, so the motion tree cannot be completed
+            # and the rest of link_mat would be left unset
             if cluster_pair is None:
-                print("No cluster pair found")
-                return -1
+                raise KeyError("Spatial Proximity too low to merge clusters")
             # print("Checking spatial proximity")
             # When cluster pair is found, check if at least one Ca atom pair between the cluster pair meets the spatial
             # proximity measure.
@@ -403,7 +641,7 @@ class MotionTree:
                     }
                 # self.print_node()
             # print(n, cluster_pair)
-            new_cluster_id = n + self.num_residues
+            new_cluster_id = n + self.num_points
             # print(n, self.clusters[cluster_pair[0]], self.clusters[cluster_pair[1]])
             # write_clustering("motion_tree_test", f"{n} {cluster_pair} {min_dist} {self.clusters[cluster_pair[0]]} {self.clusters[cluster_pair[1]]}", n)
             self.clusters[new_cluster_id] = self.clusters[cluster_pair[0]]
@@ -423,28 +661,27 @@ class MotionTree:
         """
         Using the difference distance matrix, find the closest clusters. If the cluster pair has already been checked,
         ignore it and find another one.
-        :param diff_dist_matrix: A NxN matrix of the distance difference matrix
+        :param diff_dist_matrix: The condensed cluster distance matrix
         :param visited_clusters: An array of visited cluster pairs
-        :return:
+        :return: The cluster pair (smaller ID first) and their distance, or None if every remaining pair was visited
         """
-        # Create a copy of the difference distance matrix for dealing with visited clusters
-        diff_dist_copy = np.copy(diff_dist_matrix)
-        # Set values at the visited cluster indices as infinity so that the next minimum values will be found
+        num_ids = 2 * self.num_points - 1
+        # Set the values of the visited cluster pairs to infinity so that the next minimum value is found, and restore
+        # them afterwards
+        visited_indices = None
+        visited_values = None
         if visited_clusters is not None:
-            # If visited clusters are np.array([[3, 5], [7, 10]])
-            # The matrix at [3, 5], [5, 3], [7, 10], and [10, 7] will need to be set as infinity.
-            rows = np.concatenate((visited_clusters[:, 0], visited_clusters[:, 1]))
-            cols = np.concatenate((visited_clusters[:, 1], visited_clusters[:, 0]))
-            # https://stackoverflow.com/questions/7761393/how-to-modify-a-2d-numpy-array-at-specific-locations-without-a-loop
-            # diff_dist_copy[[3, 7, 5, 10], [5, 10, 3, 7]]
-            diff_dist_copy[rows, cols] = np.inf
-        # Get the index of the cluster pair with the smallest value.
-        # np.argmin gets the index of the minimum value. axis=None means that the array is flattened.
-        # np.unravel_index gets the 2D index by specifying the shape of the array
-        # https://stackoverflow.com/questions/48135736/what-is-an-intuitive-explanation-of-np-unravel-index
-        cluster_pair = np.unravel_index(np.argmin(diff_dist_copy, axis=None), diff_dist_copy.shape)
-
-        return list(cluster_pair), np.min(diff_dist_copy)
+            visited_indices = condensed_index(num_ids, visited_clusters[:, 0], visited_clusters[:, 1])
+            visited_values = diff_dist_matrix[visited_indices]
+            diff_dist_matrix[visited_indices] = np.inf
+        # The condensed matrix is ordered like the upper triangle of the square matrix read row by row, so ties are
+        # broken the same way as np.argmin on the square matrix
+        min_index, min_dist = find_min(diff_dist_matrix, self.block_size if self.is_out_of_core else None)
+        if visited_indices is not None:
+            diff_dist_matrix[visited_indices] = visited_values
+        if min_dist == np.inf:
+            return None, min_dist
+        return list(condensed_pair(num_ids, min_index)), min_dist
 
     def spatial_proximity_measure(self, cluster_pair):
         """
@@ -461,85 +698,72 @@ class MotionTree:
         cluster_1_indices_list.sort()
         cluster_2_indices_list.sort()
 
-        # print(len(cluster_1_indices_list) + len(cluster_2_indices_list))
-        # print(self.protein_1.utilised_res_indices)
-        # print(self.protein_2.utilised_res_indices)
-        # print(cluster_1_indices_list)
-        # print(cluster_2_indices_list)
+        cluster_1_indices = np.asarray(cluster_1_indices_list)
+        cluster_2_indices = np.asarray(cluster_2_indices_list)
 
         is_near_1 = False
         is_near_2 = False
 
-        smallest_1 = np.inf
-        smallest_2 = np.inf
-
-        for i in cluster_1_indices_list:
-            for j in cluster_2_indices_list:
-                if self.protein_1.distance_matrix[i, j] < smallest_1:
-                    smallest_1 = self.protein_1.distance_matrix[i, j]
-                if self.protein_2.distance_matrix[i, j] < smallest_2:
-                    smallest_2 = self.protein_2.distance_matrix[i, j]
-                if self.protein_1.distance_matrix[i, j] < self.spat_prox:
-                    is_near_1 = True
-                if self.protein_2.distance_matrix[i, j] < self.spat_prox:
-                    is_near_2 = True
-
-                if is_near_1 and is_near_2:
-                    break
+        # Check the residue pairs in blocks of rows of cluster 1 to bound the memory used by large clusters
+        block_rows = max(1, self.block_size // cluster_2_indices.shape[0])
+        for start in range(0, cluster_1_indices.shape[0], block_rows):
+            indices = condensed_index(self.num_points, cluster_1_indices[start:start + block_rows, None],
+                                      cluster_2_indices[None, :])
+            if not is_near_1:
+                is_near_1 = bool(np.any(self.contact_mat_1[indices]))
+            if not is_near_2:
+                is_near_2 = bool(np.any(self.contact_mat_2[indices]))
             if is_near_1 and is_near_2:
                 break
 
-        # print(cluster_1_indices_list)
-        # print(cluster_2_indices_list)
-        # print(smallest_1, smallest_2)
-
         return is_near_1 and is_near_2
 
     def update_distance_matrix(self, diff_dist_mat, cluster_pair, new_id):
         """
         Updates the difference distance matrix after the clustering.
-        :param diff_dist_mat: The distance difference matrix
+        :param diff_dist_mat: The condensed cluster distance matrix, which is updated in place
         :param cluster_pair: The pair of cluster IDs which are most similar
         :param new_id: The new cluster id
-        :return:
+        :return: The updated matrix
         """
-        # https://stackoverflow.com/questions/8486294/how-do-i-add-an-extra-column-to-a-numpy-array
-        new_distance_matrix = np.c_[np.copy(diff_dist_mat), np.full(diff_dist_mat.shape[0], np.inf)]
-        new_distance_matrix = np.r_[new_distance_matrix, np.full((1, new_distance_matrix.shape[1]), np.inf)]
-        new_distance_matrix[cluster_pair, :] = np.inf
-        new_distance_matrix[:, cluster_pair] = np.inf
-        for k in self.clusters.keys():
-            # Ignore the cluster pairs
-            if k != cluster_pair[0] and k != cluster_pair[1]:
-                # print(self.clusters.keys())
-                # print(cluster_pair)
-                # print(k, new_id)
-                dists = self.get_diff_distances(self.clusters[k], self.clusters[new_id])
-                # dists = []
-                # dists.extend(self.get_diff_distances(self.clusters[k], self.clusters[cluster_pair[0]]))
-                # dists.extend(self.get_diff_distances(self.clusters[k], self.clusters[cluster_pair[1]]))
-                if len(dists) > self.clust_size:
-                    dists.sort(reverse=True)
-                    new_distance_matrix[new_id, k] = mean(dists[:self.clust_size])
-                else:
-                    new_distance_matrix[new_id, k] = mean(dists)
-                new_distance_matrix[k, new_id] = new_distance_matrix[new_id, k]
-
-        return new_distance_matrix
+        num_ids = 2 * self.num_points - 1
+        other_ids = np.array([k for k in self.clusters.keys() if k not in cluster_pair and k != new_id], dtype=np.int64)
+        # The merged clusters no longer exist
+        diff_dist_mat[condensed_index(num_ids, cluster_pair[0], cluster_pair[1])] = np.inf
+        diff_dist_mat[condensed_index(num_ids, cluster_pair[0], other_ids)] = np.inf
+        diff_dist_mat[condensed_index(num_ids, cluster_pair[1], other_ids)] = np.inf
+        for k in other_ids.tolist():
+            diff_dist_mat[condensed_index(num_ids, new_id, k)] = self.get_cluster_distance(self.clusters[k],
+                                                                                          self.clusters[new_id])
+
+        return diff_dist_mat
+
+    def get_cluster_distance(self, cluster_indices_1, cluster_indices_2):
+        """
+        Get the distance between two clusters, which is the mean of the largest clust_size distance differences between
+        their residues. The residue pairs are read in blocks of rows of cluster 1, keeping only the largest distance
+        differences found so far.
+        :return: The cluster distance
+        """
+        cluster_indices_1 = np.asarray(cluster_indices_1)
+        block_rows = max(1, self.block_size // len(cluster_indices_2))
+        dists = None
+        for start in range(0, cluster_indices_1.shape[0], block_rows):
+            block_dists = self.get_diff_distances(cluster_indices_1[start:start + block_rows], cluster_indices_2)
+            dists = block_dists if dists is None else np.concatenate((dists, block_dists))
+            if dists.shape[0] > self.clust_size:
+                # The largest clust_size distances. The mean of the same values is the same in any order.
+                dists = np.partition(dists, dists.shape[0] - self.clust_size)[-self.clust_size:]
+        return mean(dists.tolist())
 
     def get_diff_distances(self, cluster_indices_1, cluster_indices_2):
         """
-        Get the distance differences
+        Get the distance differences between the residues of two clusters
         :param cluster_indices_1:
         :param cluster_indices_2:
-        :return:
+        :return: Flat array of the distance differences
         """
-        diff_dists = []
-        for i in cluster_indices_1:
-            for j in cluster_indices_2:
-                diff_dists.append(self.diff_dist_mat_init[i, j])
-
-        return diff_dists
+        return get_block(self.diff_dist_mat_init, self.num_points, cluster_indices_1, cluster_indices_2).ravel()
 
     def print_node(self):
         for key, values in self.nodes.items():
@@ -550,6 +774,7 @@ class MotionTree:
 
 
 def print_diff_dist_mat(dist_mat):
+    dist_mat = to_square(dist_mat)
     row = [str(dist_mat[i]).ljust(4) for i in range(dist_mat.shape[1])]
     print("[".ljust(3), " ", " ".join(row))
     for i in range(dist_mat.shape[0]):
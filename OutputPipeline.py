@@ -0,0 +1,97 @@
+import queue
+import threading
+from concurrent.futures import Future
+"""
+Output stage of batch runs. The output jobs of the motion trees are put on a bounded queue and written by background
+writer threads, so the outputs of one pair are written while the motion tree of the next pair is built. When the queue
+is full, submitting a job blocks until a writer takes one (backpressure), which bounds the number of finished motion
+trees held in memory waiting for their outputs. Each job has a Future holding its result, or the error it raised in
+place of printing it.
+"""
+
+# The number of writer threads. One writer writes the jobs in the order they are submitted.
+OUTPUT_WORKERS = 1
+# The number of jobs that can wait in the queue before submitting blocks
+MAX_PENDING_JOBS = 2
+
+
+class OutputPipeline:
+    def __init__(self, num_workers=OUTPUT_WORKERS, max_pending=MAX_PENDING_JOBS):
+        """
+        Starts the writer threads. The pipeline is shut down with shutdown or by using it as a context manager.
+        :param num_workers: The number of writer threads
+        :param max_pending: The number of jobs that can wait for a writer
+        """
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.is_shutdown = False
+        self.workers = [threading.Thread(target=self.work, name=f"OutputWriter-{i}", daemon=True)
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues an output job, waiting for space in the queue if it is full.
+        :param func: The function writing the outputs
+        :return: Future of the result of the function
+        """
+        if self.is_shutdown:
+            raise RuntimeError("Cannot submit output jobs to a shut down pipeline")
+        future = Future()
+        self.jobs.put((future, func, args, kwargs))
+        return future
+
+    def work(self):
+        # The loop of a writer thread, until it takes the None put on the queue by shutdown
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                future, func, args, kwargs = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+            finally:
+                self.jobs.task_done()
+
+    def join(self):
+        # Waits until every queued job has been written
+        self.jobs.join()
+
+    def shutdown(self, wait=True):
+        """
+        Stops the writers after the jobs already queued.
+        :param wait: Whether to wait for the writers to finish
+        """
+        if self.is_shutdown:
+            return
+        self.is_shutdown = True
+        for _ in self.workers:
+            self.jobs.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+def wait_for_outputs(futures):
+    """
+    Waits for output jobs to finish.
+    :param futures: Dictionary of the key (e.g. the pair) to the Future of each job
+    :return: Dictionary of the key to the error of each job that failed
+    """
+    errors = {}
+    for key, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            errors[key] = error
+    return errors
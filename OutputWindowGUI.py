@@ -4,8 +4,9 @@ from PySide6.QtCore import Signal, QObject, QRunnable, Slot
 from PySide6.QtGui import QPixmap
 from PySide6.QtWidgets import QPushButton, QVBoxLayout, QHBoxLayout, QStackedLayout, QWidget, QLabel
 from MotionTree import MotionTree
-from FileMngr import get_motion_tree_outputs, save_results_to_disk, write_info_file, write_to_pdb, write_domains_to_pml, \
-    write_to_pdb_dyndom
+from FileMngr import get_motion_tree_outputs, save_results_to_disk, save_diff_dist_pyramid, get_pyramid_path
+from DistanceMatrix import to_condensed
+from PyramidViewerGUI import PyramidViewer
 from DataMngr import conn, check_motion_tree_exists, get_motion_tree, insert_motion_tree, check_nodes_exist, \
     get_nodes, insert_nodes, check_protein_pair_exists, get_protein_pair, insert_protein_pair
 
@@ -138,26 +139,24 @@ class OutputWindow(QWidget):
                 if type(diff_dist_mat) == int or type(link_mat) == int or type(nodes) == int:
                     has_protein_pair, has_motion_tree, has_nodes = -1, -1, -1
                     continue
-                save_results_to_disk(self.output_path, self.protein_1, self.chain_1, self.protein_2, self.chain_2,
-                                     self.spat_prox, self.small_node, self.clust_size, self.magnitude, diff_dist_mat, "diff_dist_mat")
-                save_results_to_disk(self.output_path, self.protein_1, self.chain_1, self.protein_2, self.chain_2,
-                                     self.spat_prox, self.small_node, self.clust_size, self.magnitude, link_mat, "dendrogram")
-                if is_dyndom:
-                    write_to_pdb_dyndom(self.output_path, engine.protein_1, engine.protein_2, self.spat_prox,
-                                        self.small_node, self.clust_size, self.magnitude)
-                else:
-                    write_to_pdb(self.output_path, engine.protein_1, engine.protein_2, self.spat_prox,
-                                 self.small_node, self.clust_size, self.magnitude)
-                if self.protein_2 is None:
-                    is_dyndom = True
-                    protein_str = self.protein_1
-                else:
-                    is_dyndom = False
-                    protein_str = f"{self.protein_1}_{self.chain_1}_{self.protein_2}_{self.chain_2}"
-                write_domains_to_pml(self.output_path, engine.protein_1, engine.protein_2, self.spat_prox, self.small_node,
-                                     self.clust_size, self.magnitude, nodes, is_dyndom)
-                write_info_file(self.output_path, engine.protein_1, engine.protein_2, self.spat_prox, self.small_node,
-                                self.clust_size, self.magnitude, nodes, rmsd, is_dyndom)
+                engine.image_futures.append(save_results_to_disk(
+                    self.output_path, self.protein_1, self.chain_1, self.protein_2, self.chain_2, self.spat_prox,
+                    self.small_node, self.clust_size, self.magnitude, diff_dist_mat, "diff_dist_mat"))
+                pyramid_future = save_diff_dist_pyramid(
+                    self.output_path, self.protein_1, self.chain_1, self.protein_2, self.chain_2, self.spat_prox,
+                    self.small_node, self.clust_size, self.magnitude, to_condensed(diff_dist_mat))
+                if pyramid_future is not None:
+                    engine.image_futures.append(pyramid_future)
+                # The motion tree, PyMOL scripts, domains.info and PDB file are written from the stored results
+                engine.link_mat = link_mat
+                engine.nodes = nodes
+                engine.rmsd = rmsd
+                try:
+                    engine.write_output_job(engine.image_futures)
+                except Exception as e:
+                    traceback.print_exc()
+                    print(e)
+                protein_str = engine.get_proteins_folder()
                 param_str = f"sp_{self.spat_prox}_node_{self.small_node}_clust_{self.clust_size}_mag_{self.magnitude}"
                 num_nodes = len(nodes)
             # If database does not contain motion tree
@@ -184,6 +183,8 @@ class OutputWindow(QWidget):
                     has_protein_pair, has_motion_tree, has_nodes = -1, -1, -1
                     continue
 
+            progress_callback.emit("Drawing images")
+            engine.wait_for_images()
             diff_dist_npy, diff_dist_img, motion_tree_img = get_motion_tree_outputs(
                 self.output_path, self.protein_1, self.chain_1, self.protein_2, self.chain_2, self.spat_prox,
                 self.small_node, self.clust_size, self.magnitude
@@ -205,9 +206,18 @@ class OutputWindow(QWidget):
 
     def display_output(self, outputs):
         print("paths", outputs)
-        diff_dist_img = QPixmap(outputs[1])
-        self.widgets["diff_dist_mat_img"].setPixmap(diff_dist_img)
-        self.widgets["diff_dist_mat_img"].setScaledContents(True)
+        pyramid_path = get_pyramid_path(outputs[0]) if outputs[0] is not None else None
+        if pyramid_path is not None:
+            # Large matrices are shown in a zoomable view of their image pyramid instead of the image
+            viewer = PyramidViewer(pyramid_path)
+            self.image_output_layout.removeWidget(self.widgets["diff_dist_mat_img"])
+            self.widgets["diff_dist_mat_img"].deleteLater()
+            self.widgets["diff_dist_mat_img"] = viewer
+            self.image_output_layout.insertWidget(0, viewer)
+        else:
+            diff_dist_img = QPixmap(outputs[1])
+            self.widgets["diff_dist_mat_img"].setPixmap(diff_dist_img)
+            self.widgets["diff_dist_mat_img"].setScaledContents(True)
         motion_tree_img = QPixmap(outputs[2])
         self.widgets["motion_tree_img"].setPixmap(motion_tree_img)
         self.widgets["motion_tree_img"].setScaledContents(True)
@@ -0,0 +1,135 @@
+import numpy as np
+import gemmi
+from scipy.spatial.distance import cdist
+from PreprocessedPair import PreprocessedPair
+from DistanceMatrix import condensed_index, condensed_num_points
+"""
+Incremental update of a protein pair whose structures were revised (e.g. a re-refined PDB entry or a remodelled loop)
+without changing which residues are used. The residues whose CA atoms moved are found by comparing the new coordinates
+with the ones saved in the PreprocessedPair, and only the rows and columns of those residues in the distance difference
+matrix are computed again. The stored motion tree (link_mat) is invalid after any change, as the clusters are merged
+greedily and a change smaller than the gaps between the distances of competing cluster pairs can still change which pair
+is merged first.
+"""
+
+# Residues are changed if any coordinate moved by more than this (in Å). PDB coordinates have 3 decimals.
+CHANGE_TOLERANCE = 0.0005
+
+
+class PairRevision:
+    def __init__(self, pair, diff_dist_mat, changed_res_indices, max_change, contacts_changed, is_link_mat_invalid):
+        """
+        :param pair: The PreprocessedPair with the new coordinates and superposition
+        :param diff_dist_mat: The updated condensed distance difference matrix
+        :param changed_res_indices: The indices of the utilised residues that moved in either protein
+        :param max_change: The largest change of a distance difference. No cluster distance changes by more than this.
+        :param contacts_changed: Whether a residue pair crossed the spatial proximity distance in either protein
+        :param is_link_mat_invalid: Whether the motion tree has to be built again, i.e. whether any residue changed
+        """
+        self.pair = pair
+        self.diff_dist_mat = diff_dist_mat
+        self.changed_res_indices = changed_res_indices
+        self.max_change = max_change
+        self.contacts_changed = contacts_changed
+        self.is_link_mat_invalid = is_link_mat_invalid
+
+    def __repr__(self):
+        return (f"PairRevision({self.changed_res_indices.shape[0]} residues changed, max change "
+                f"{round(self.max_change, 3)}, link_mat {'invalid' if self.is_link_mat_invalid else 'valid'})")
+
+
+def find_changed_residues(old_coords, new_coords, tolerance=CHANGE_TOLERANCE):
+    """
+    :param old_coords: Nx3 array of the previous coordinates
+    :param new_coords: Nx3 array of the new coordinates of the same residues
+    :return: The indices of the residues that moved by more than the tolerance
+    """
+    if old_coords.shape != new_coords.shape:
+        raise ValueError(f"The revision has {new_coords.shape[0]} residues but the pair has {old_coords.shape[0]}. "
+                         f"Run the preprocessing again.")
+    return np.flatnonzero(np.any(np.abs(new_coords - old_coords) > tolerance, axis=1))
+
+
+def revise_pair(pair: PreprocessedPair, diff_dist_mat, coords_1=None, coords_2=None, spat_prox=7.0,
+                tolerance=CHANGE_TOLERANCE, in_place=False):
+    """
+    Updates the distance difference matrix of a pair for new coordinates of its utilised residues.
+    :param pair: The PreprocessedPair the distance difference matrix was made from
+    :param diff_dist_mat: The condensed distance difference matrix of the pair
+    :param coords_1: Nx3 array of the new CA coordinates of the utilised residues of protein 1. None if unchanged.
+    :param coords_2: Nx3 array of the new CA coordinates of the utilised residues of protein 2. None if unchanged.
+    :param spat_prox: The spatial proximity distance the motion tree was built with
+    :param tolerance: Residues are changed if a coordinate moved by more than this
+    :param in_place: Whether to update diff_dist_mat itself instead of a copy
+    :return: PairRevision
+    """
+    coords_1 = pair.coords_1 if coords_1 is None else np.asarray(coords_1, dtype=np.float64)
+    coords_2 = pair.coords_2 if coords_2 is None else np.asarray(coords_2, dtype=np.float64)
+    n = pair.num_residues
+    if condensed_num_points(diff_dist_mat.shape[0]) != n:
+        raise ValueError("The distance difference matrix does not belong to the pair")
+    changed = np.union1d(find_changed_residues(pair.coords_1, coords_1, tolerance),
+                         find_changed_residues(pair.coords_2, coords_2, tolerance))
+    if not in_place:
+        diff_dist_mat = np.array(diff_dist_mat)
+
+    max_change = 0.0
+    contacts_changed = False
+    if changed.shape[0] > 0:
+        # The rows of the changed residues. Entries between two changed residues are in two rows and get the same value.
+        new_dist_1 = cdist(coords_1[changed], coords_1)
+        new_dist_2 = cdist(coords_2[changed], coords_2)
+        old_dist_1 = cdist(pair.coords_1[changed], pair.coords_1)
+        old_dist_2 = cdist(pair.coords_2[changed], pair.coords_2)
+        not_diagonal = changed[:, None] != np.arange(n)[None, :]
+        rows, cols = np.nonzero(not_diagonal)
+        indices = condensed_index(n, changed[rows], cols)
+        new_diffs = np.abs(new_dist_1 - new_dist_2)[not_diagonal]
+        max_change = float(np.max(np.abs(new_diffs - diff_dist_mat[indices]), initial=0.0))
+        diff_dist_mat[indices] = new_diffs
+        contacts_changed = bool(np.any((new_dist_1 < spat_prox) != (old_dist_1 < spat_prox))
+                                or np.any((new_dist_2 < spat_prox) != (old_dist_2 < spat_prox)))
+
+    # Any change can change the order of the greedy merges, so only an unchanged pair keeps its motion tree
+    is_link_mat_invalid = changed.shape[0] > 0
+
+    return PairRevision(revise_coords(pair, coords_1, coords_2), diff_dist_mat, changed, max_change,
+                        contacts_changed, is_link_mat_invalid)
+
+
+def revise_coords(pair: PreprocessedPair, coords_1, coords_2):
+    """
+    Get a copy of the pair with new coordinates, superimposing protein 2 onto protein 1 again by the CA atoms of the
+    utilised residues.
+    :return: PreprocessedPair
+    """
+    if coords_1 is pair.coords_1 and coords_2 is pair.coords_2:
+        rotation, translation, rmsd = pair.rotation, pair.translation, pair.rmsd
+    else:
+        poses_1 = [gemmi.Position(*c) for c in coords_1.tolist()]
+        poses_2 = [gemmi.Position(*c) for c in coords_2.tolist()]
+        superpose_result = gemmi.superpose_positions(poses_1, poses_2)
+        rotation = np.array(superpose_result.transform.mat.tolist())
+        translation = np.array(superpose_result.transform.vec.tolist())
+        rmsd = superpose_result.rmsd
+    # The file stamps are of the old files, so the revised pair is not mistaken for the saved one
+    return PreprocessedPair(pair.code_1, pair.chain_1, pair.code_2, pair.chain_2, pair.is_dyndom, pair.res_indices_1,
+                            pair.res_indices_2, coords_1, coords_2, pair.res_nums_1, pair.res_nums_2, rotation,
+                            translation, rmsd, pair.identity, pair.cigar_str, pair.match_str_1, pair.match_str_2)
+
+
+def read_revised_coords(pair: PreprocessedPair, protein_num, ca_data):
+    """
+    Get the new coordinates of the utilised residues of a protein of the pair from the CA data of the revised
+    structure, which must have the same residues.
+    :param protein_num: 1 or 2
+    :param ca_data: The CaData of the revised chain (e.g. CoordCache.get_ca_data of the new file)
+    :return: Nx3 array of the coordinates
+    """
+    res_indices = pair.res_indices_1 if protein_num == 1 else pair.res_indices_2
+    res_nums = pair.res_nums_1 if protein_num == 1 else pair.res_nums_2
+    if res_indices.shape[0] > 0 and (res_indices.max() >= len(ca_data)
+                                     or not np.array_equal(np.asarray(ca_data.seqids)[res_indices], res_nums)
+                                     or not np.all(ca_data.has_ca[res_indices])):
+        raise ValueError(f"The residues of protein {protein_num} changed. Run the preprocessing again.")
+    return ca_data.coords[res_indices]
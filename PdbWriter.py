@@ -0,0 +1,102 @@
+from itertools import chain
+import numpy as np
+"""
+Bulk writer of the two-model PDB files of the outputs. The atoms of the utilised residues of each model are collected
+into arrays, their columns are formatted all at once and the whole file is written with a single write. The output is
+the same as writing each ATOM line with str(round(x, 3)).rjust(8) and the other fields padded the same way.
+"""
+
+
+class AtomRecords:
+    def __init__(self, atom_names, res_names, res_nums, coords):
+        """
+        The atoms of one model of a PDB file.
+        :param atom_names: The atom names
+        :param res_names: The residue name of each atom
+        :param res_nums: The residue sequence number of each atom
+        :param coords: Nx3 array of the atom coordinates
+        """
+        self.atom_names = atom_names
+        self.res_names = res_names
+        self.res_nums = res_nums
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+
+def get_atom_records(residues, res_indices, transform=None):
+    """
+    Collects all atoms of the residues at the indices.
+    :param residues: A gemmi chain or residue span
+    :param res_indices: The indices of the residues to write
+    :param transform: A gemmi.Transform applied to the atom positions (e.g. the superposition), or None
+    :return: AtomRecords
+    """
+    atom_names = []
+    res_names = []
+    res_nums = []
+    coords = []
+    for i in np.asarray(res_indices).tolist():
+        r = residues[i]
+        atoms = list(r)
+        atom_names.extend([a.name for a in atoms])
+        res_names.extend([r.name] * len(atoms))
+        res_nums.extend([r.seqid.num] * len(atoms))
+        if transform is None:
+            coords.extend([a.pos.tolist() for a in atoms])
+        else:
+            # The same arithmetic as moving the atoms with transform_pos_and_adp
+            coords.extend([transform.apply(a.pos).tolist() for a in atoms])
+    return AtomRecords(atom_names, res_names, res_nums, coords)
+
+
+# Scaled values this close to halfway between two integers are rounded with round() instead of np.round
+TIE_TOLERANCE = 1e-6
+
+
+def round_coords(values):
+    """
+    Rounds coordinates to 3 decimals the same as round(value, 3) for every value at once. np.round scales the values
+    by 1000 before rounding, and the scaling error can put a value that is almost halfway on the other side, so those
+    values are rounded again with round().
+    :param values: Array of values
+    :return: Array of the rounded values
+    """
+    rounded = np.round(values, 3)
+    scaled = values * 1000
+    near_tie = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < TIE_TOLERANCE)
+    for i in near_tie.tolist():
+        rounded.flat[i] = round(float(values.flat[i]), 3)
+    return rounded
+
+
+def format_atom_lines(records: AtomRecords, chain_id):
+    # The ATOM lines of a model, numbering the atoms from 1. str() of the rounded floats is the text of
+    # str(round(value, 3)).
+    coords = list(map(str, round_coords(records.coords).ravel().tolist()))
+    num_atoms = len(records)
+    # One format of the line template repeated for every atom
+    template = f"ATOM  %5d %-4s %3s {chain_id}%4d    %8s%8s%8s\n" * num_atoms
+    return template % tuple(chain.from_iterable(zip(range(1, num_atoms + 1), to_list(records.atom_names),
+                                                    to_list(records.res_names), to_list(records.res_nums),
+                                                    coords[0::3], coords[1::3], coords[2::3])))
+
+
+def to_list(values):
+    return values.tolist() if isinstance(values, np.ndarray) else values
+
+
+def write_pdb_models(pdb_path, models):
+    """
+    Writes models to a PDB file.
+    :param pdb_path: The path of the file
+    :param models: List of (chain ID, AtomRecords) of the models, numbered from 1
+    """
+    parts = []
+    for model_num, (chain_id, records) in enumerate(models, start=1):
+        parts.append(f"MODEL{str(model_num).rjust(9, ' ')}\n")
+        parts.append(format_atom_lines(records, chain_id))
+        parts.append("ENDMDL\n")
+    with open(pdb_path, "w") as fw:
+        fw.write("".join(parts))
@@ -0,0 +1,153 @@
+import os
+import json
+import numpy as np
+import gemmi
+from CoordCache import get_file_stamp, get_tmp_suffix
+"""
+Everything the pipeline derives from the two structure files of a protein pair before clustering: the sequence
+alignment, the mapping between the utilised residues of both chains, their CA coordinates and residue numbers, and the
+superposition of protein 2 onto protein 1. It is computed once in MotionTree.preprocessing() and then used by the
+distance matrices, the output writers and the GUI, and can be saved next to the outputs so a later run of the same pair
+skips the alignment and superposition.
+"""
+
+PAIR_FILE_NAME = "preprocessed_pair.npz"
+PAIR_VERSION = 1
+ARRAY_NAMES = ["res_indices_1", "res_indices_2", "coords_1", "coords_2", "res_nums_1", "res_nums_2", "rotation",
+               "translation"]
+
+
+class PreprocessedPair:
+    def __init__(self, code_1, chain_1, code_2, chain_2, is_dyndom, res_indices_1, res_indices_2, coords_1, coords_2,
+                 res_nums_1, res_nums_2, rotation, translation, rmsd, identity=None, cigar_str="", match_str_1="",
+                 match_str_2="", file_stamps=None):
+        """
+        :param res_indices_1: The indices of the utilised residues in the chain (or polymer) of protein 1
+        :param res_indices_2: The indices of the utilised residues in the chain (or polymer) of protein 2. Index i is the
+        residue aligned to residue res_indices_1[i].
+        :param coords_1: Nx3 array of the CA coordinates of the utilised residues of protein 1
+        :param coords_2: Nx3 array of the CA coordinates of the utilised residues of protein 2
+        :param res_nums_1: The residue sequence numbers of the utilised residues of protein 1
+        :param res_nums_2: The residue sequence numbers of the utilised residues of protein 2
+        :param rotation: 3x3 rotation matrix of the superposition of protein 2 onto protein 1
+        :param translation: The translation vector of the superposition of protein 2 onto protein 1
+        :param rmsd: The RMSD of the superposition
+        :param identity: The sequence identity of the chains. None for DynDom files, which are not aligned.
+        :param cigar_str: The CIGAR string of the alignment
+        :param match_str_1: The sequence of protein 1 with the alignment gaps
+        :param match_str_2: The sequence of protein 2 with the alignment gaps
+        :param file_stamps: The [modification time, size] of both structure files, used to check a saved pair
+        """
+        self.code_1 = code_1
+        self.chain_1 = chain_1
+        self.code_2 = code_2
+        self.chain_2 = chain_2
+        self.is_dyndom = is_dyndom
+        self.res_indices_1 = res_indices_1
+        self.res_indices_2 = res_indices_2
+        self.coords_1 = coords_1
+        self.coords_2 = coords_2
+        self.res_nums_1 = res_nums_1
+        self.res_nums_2 = res_nums_2
+        self.rotation = rotation
+        self.translation = translation
+        self.rmsd = rmsd
+        self.identity = identity
+        self.cigar_str = cigar_str
+        self.match_str_1 = match_str_1
+        self.match_str_2 = match_str_2
+        self.file_stamps = file_stamps
+
+    @property
+    def num_residues(self):
+        return self.res_indices_1.shape[0]
+
+    def get_residue_nums(self, protein_num, indices, utilised=True):
+        """
+        Get the residue sequence numbers of utilised residues, the same as Protein.get_residue_nums.
+        :param protein_num: 1 or 2
+        :param indices: Indices into the utilised residues
+        :param utilised: Whether to get the residues at the indices or the utilised residues not at the indices
+        :return: List of residue sequence numbers
+        """
+        res_nums = self.res_nums_1 if protein_num == 1 else self.res_nums_2
+        if utilised:
+            return res_nums[indices].tolist()
+        else:
+            return np.delete(res_nums, indices).tolist()
+
+    def get_transform(self):
+        return gemmi.Transform(gemmi.Mat33(self.rotation.tolist()), gemmi.Vec3(*self.translation.tolist()))
+
+    def get_superposed_coords_2(self):
+        return self.coords_2 @ self.rotation.T + self.translation
+
+    def matches(self, protein_1, protein_2, is_dyndom):
+        # Whether the saved pair was made from the same chains of the same structure files
+        return (self.is_dyndom == is_dyndom
+                and [self.code_1, self.chain_1, self.code_2, self.chain_2] ==
+                [protein_1.code, protein_1.chain_param, protein_2.code, protein_2.chain_param]
+                and self.file_stamps == [get_file_stamp(protein_1.file_path), get_file_stamp(protein_2.file_path)])
+
+    def save(self, file_path):
+        """
+        Saves the pair to a .npz file. The file is written to a temporary file first and then renamed.
+        """
+        meta = {
+            "version": PAIR_VERSION,
+            "codes": [self.code_1, self.chain_1, self.code_2, self.chain_2],
+            "is_dyndom": self.is_dyndom,
+            "rmsd": self.rmsd,
+            "identity": self.identity,
+            "cigar_str": self.cigar_str,
+            "match_str_1": self.match_str_1,
+            "match_str_2": self.match_str_2,
+            "file_stamps": self.file_stamps
+        }
+        arrays = {name: np.asarray(getattr(self, name)) for name in ARRAY_NAMES}
+        tmp_path = f"{file_path}.{get_tmp_suffix()}.tmp.npz"
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, file_path)
+
+
+def build_preprocessed_pair(protein_1, protein_2, is_dyndom, rmsd, transform, identity=None, cigar_str="",
+                            match_str_1="", match_str_2=""):
+    """
+    Creates the PreprocessedPair of two proteins whose utilised residues and coordinates have been set.
+    :param transform: The gemmi.Transform of the superposition of protein 2 onto protein 1
+    :return: PreprocessedPair
+    """
+    res_indices_1 = np.asarray(protein_1.utilised_res_indices)
+    res_indices_2 = np.asarray(protein_2.utilised_res_indices)
+    return PreprocessedPair(
+        protein_1.code, protein_1.chain_param, protein_2.code, protein_2.chain_param, is_dyndom,
+        res_indices_1, res_indices_2,
+        np.asarray(protein_1.utilised_atoms_coords), np.asarray(protein_2.utilised_atoms_coords),
+        np.asarray(protein_1.get_ca_data().seqids)[res_indices_1],
+        np.asarray(protein_2.get_ca_data().seqids)[res_indices_2],
+        np.array(transform.mat.tolist()), np.array(transform.vec.tolist()),
+        rmsd, identity, cigar_str, match_str_1, match_str_2,
+        [get_file_stamp(protein_1.file_path), get_file_stamp(protein_2.file_path)]
+    )
+
+
+def load_preprocessed_pair(file_path):
+    """
+    Loads a saved pair.
+    :return: PreprocessedPair, or None if there is no valid saved pair
+    """
+    try:
+        with np.load(file_path) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta.get("version") != PAIR_VERSION:
+                return None
+            arrays = {name: data[name] for name in ARRAY_NAMES}
+    except (OSError, ValueError, KeyError):
+        return None
+    return PreprocessedPair(*meta["codes"], meta["is_dyndom"], **arrays, rmsd=meta["rmsd"],
+                            identity=meta["identity"], cigar_str=meta["cigar_str"], match_str_1=meta["match_str_1"],
+                            match_str_2=meta["match_str_2"], file_stamps=meta["file_stamps"])
+
+
+def get_pair_file_path(output_path, proteins_folder):
+    return f"{output_path}/{proteins_folder}/{PAIR_FILE_NAME}"
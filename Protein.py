@@ -1,6 +1,9 @@
 import gemmi
 import numpy as np
-from scipy.spatial.distance import cdist
+from StructureCache import structure_cache
+from CoordCache import get_ca_data
+from FileMngr import find_structure_file
+from DistanceMatrix import get_distance_matrix, to_square
 """
 Gemmi follows a hierarchy:
 Structure -> Model -> Chain -> [ResidueSpan] -> Residue -> Atom
@@ -8,70 +11,105 @@ Structure -> Model -> Chain -> [ResidueSpan] -> Residue -> Atom
 
 
 class Protein:
-    def __init__(self, input_path, code, chain: str = "A", is_dyndom=False):
+    def __init__(self, input_path, code, chain: str = "A", is_dyndom=False, model_num=None):
         self.input_path = input_path
         self.code = code
-        self.file_path = f"{input_path}/{code}.pdb"
+        # The structure file can be a PDB or mmCIF file, optionally gzipped
+        self.file_path = find_structure_file(input_path, code)
         self.chain_param: str = chain  # The chain specified in parameter input for the program
         self.is_dyndom = is_dyndom
+        # The index of the model the chain is taken from. None uses the default model of the file.
+        self.model_num = model_num
         # The indices of the residues that are utilised in the protein chain
         self.utilised_res_indices = None
         # Dataframe that stores the coordinates of the utilised atoms of the residues. Only Ca atoms or backbone atoms.
         self.utilised_atoms_coords = None
+        # The condensed distance matrix of the utilised atoms
         self.distance_matrix = None
-        structure = gemmi.read_pdb(self.file_path)
+        # The CA coordinates and residue information of the chain, loaded from the coordinate cache when first needed
+        self.ca_data = None
+        if self.file_path is None:
+            raise IOError(f"Unable to find file: {input_path}/{code}")
 
     def get_distance_matrix(self):
         # print(self.utilised_atoms_coords.shape)
-        self.distance_matrix = cdist(self.utilised_atoms_coords, self.utilised_atoms_coords, metric="euclidean")
+        self.distance_matrix = get_distance_matrix(self.utilised_atoms_coords)
         # print(self.distance_matrix.shape)
 
     def get_structure(self):
-        return gemmi.read_pdb(self.file_path)
+        """
+        Get the structure of the protein from the process-wide structure cache. The structure is shared with the other
+        Protein objects using the same file, so it must not be modified in place.
+        :return:
+        """
+        return structure_cache.get(self.file_path)
 
     def get_model(self):
-        structure = gemmi.read_pdb(self.file_path)
+        structure = self.get_structure()
+        if self.model_num is not None:
+            return structure[self.model_num]
         if self.is_dyndom:
             return structure[1]
         return structure[0]
 
     def get_chain(self):
         # There is usually only one model in the structure
-        structure = gemmi.read_pdb(self.file_path)
+        structure = self.get_structure()
+        return structure[self.get_chain_model_num()][self.chain_param]
+
+    def get_chain_model_num(self):
+        if self.model_num is not None:
+            return self.model_num
+        # DynDom files store the second conformation in the second model as chain B
         if self.is_dyndom and self.chain_param == "B":
-            return structure[1][self.chain_param]
-        else:
-            return structure[0][self.chain_param]
+            return 1
+        return 0
+
+    def get_ca_data(self):
+        """
+        Get the CA coordinates, residue numbers, names and sequence of the residues of the chain. Standard proteins use
+        the polymer of the chain and DynDom proteins use the whole chain, the same as get_residue_nums.
+        :return: CaData
+        """
+        if self.ca_data is None:
+            self.ca_data = get_ca_data(self.file_path, self.get_chain_model_num(), self.chain_param,
+                                       polymer_only=not self.is_dyndom)
+        return self.ca_data
 
-    def get_polymer(self):
-        structure = gemmi.read_pdb(self.file_path)
-        return structure[0][self.chain_param].get_polymer()
+    def get_polymer(self, copy=False):
+        """
+        Get the polymer of the protein chain.
+        :param copy: Whether to get the polymer from a copy of the cached structure, which is safe to modify.
+        :return:
+        """
+        structure = self.get_structure()
+        if copy:
+            structure = structure.clone()
+        return structure[self.get_chain_model_num()][self.chain_param].get_polymer()
 
     def get_polymer_entity(self):
-        structure: gemmi.Structure = gemmi.read_pdb(self.file_path)
+        structure: gemmi.Structure = self.get_structure()
         polymer = self.get_polymer()
         return structure.get_entity_of(polymer)
 
     def get_residue_nums(self, indices, utilised=True):
-        if self.is_dyndom:
-            polymer = self.get_chain()
-        else:
-            polymer = self.get_polymer()
+        seqids = self.get_ca_data().seqids
         if utilised:
-            return [polymer[i].seqid.num for i in self.utilised_res_indices[indices]]
+            return seqids[self.utilised_res_indices[indices]].tolist()
         else:
             temp = np.delete(self.utilised_res_indices, indices)
-            return [polymer[i].seqid.num for i in temp]
+            return seqids[temp].tolist()
 
     def print_chain(self):
         print(f"{self.get_structure().name}({self.chain_param}) - {self.utilised_atoms_coords.shape}")
         print(f"{self.get_structure().name}({self.chain_param}) - \n{self.utilised_atoms_coords}")
 
     def print_dist_mat(self):
-        row = [str(self.utilised_res_indices[i]).ljust(4) for i in range(self.distance_matrix.shape[1])]
+        distance_matrix = to_square(self.distance_matrix)
+        row = [str(self.utilised_res_indices[i]).ljust(4) for i in range(distance_matrix.shape[1])]
         print("[".ljust(3), " ", " ".join(row))
-        for i in range(self.distance_matrix.shape[0]):
-            row = [str(round(j, 1)).ljust(4) for j in self.distance_matrix[i]]
+        for i in range(distance_matrix.shape[0]):
+            row = [str(round(j, 1)).ljust(4) for j in distance_matrix[i]]
             print(str(i).ljust(3), " ", " ".join(row))
         print("]")
 
@@ -0,0 +1,70 @@
+from PySide6.QtCore import Qt
+from PySide6.QtGui import QPixmap, QPainter
+from PySide6.QtWidgets import QGraphicsView, QGraphicsScene, QGraphicsPixmapItem
+from ImagePyramid import ImagePyramid
+
+# The most screen pixels a residue can be zoomed to
+MAX_ZOOM = 32
+ZOOM_STEP = 1.25
+
+
+class PyramidViewer(QGraphicsView):
+    def __init__(self, pyramid_path):
+        """
+        Zoomable view of the image pyramid of a distance difference matrix. The scene is in residues, and only the tiles
+        of the level matching the zoom that are in view are loaded.
+        :param pyramid_path: The folder of the image pyramid
+        """
+        super().__init__()
+        self.pyramid = ImagePyramid(pyramid_path)
+        self.scene = QGraphicsScene(0, 0, self.pyramid.num_residues, self.pyramid.num_residues)
+        self.setScene(self.scene)
+        self.setDragMode(QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
+        self.setRenderHint(QPainter.SmoothPixmapTransform, False)
+        # (level, row, column) -> QGraphicsPixmapItem of the tiles in the scene
+        self.tiles = {}
+        self.is_fitted = False
+        self.horizontalScrollBar().valueChanged.connect(self.update_tiles)
+        self.verticalScrollBar().valueChanged.connect(self.update_tiles)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if not self.is_fitted:
+            # Start with the whole matrix in view
+            self.fitInView(self.scene.sceneRect(), Qt.KeepAspectRatio)
+            self.is_fitted = True
+        self.update_tiles()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.update_tiles()
+
+    def wheelEvent(self, event):
+        factor = ZOOM_STEP if event.angleDelta().y() > 0 else 1 / ZOOM_STEP
+        if factor > 1 and self.transform().m11() * factor > MAX_ZOOM:
+            return
+        self.scale(factor, factor)
+        self.update_tiles()
+
+    def update_tiles(self):
+        """
+        Loads the tiles in view at the level of the current zoom and removes the rest.
+        """
+        level = self.pyramid.get_level(self.transform().m11())
+        view = self.mapToScene(self.viewport().rect()).boundingRect()
+        in_view = set()
+        for row, col, y, x, path in self.pyramid.get_tiles_in_view(level, view.left(), view.top(), view.right() + 1,
+                                                                     view.bottom() + 1):
+            key = (level, row, col)
+            in_view.add(key)
+            if key not in self.tiles:
+                item = QGraphicsPixmapItem(QPixmap(path))
+                item.setPos(x, y)
+                item.setScale(1 << level)
+                # Residues are drawn as blocks when zoomed in
+                item.setTransformationMode(Qt.FastTransformation)
+                self.scene.addItem(item)
+                self.tiles[key] = item
+        for key in [k for k in self.tiles if k not in in_view]:
+            self.scene.removeItem(self.tiles.pop(key))
@@ -0,0 +1,146 @@
+import os
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from scipy.cluster.hierarchy import dendrogram
+from DistanceMatrix import to_square
+"""
+Headless rendering of the output images. Each image is drawn on its own Figure with the Agg canvas instead of the global
+pyplot state, which is not thread-safe, and the drawing is done in a small pool of processes. The arrays are sent to the
+pool and a Future of the image path is returned at once, so the motion tree is not held up by PNG encoding and windows
+building motion trees at the same time do not draw on each other's figures. As the processes are spawned, scripts using
+MotionTree must start under an if __name__ == '__main__' guard.
+"""
+
+# The number of rendering processes, leaving a CPU for the motion tree. 0 renders in the calling thread.
+RENDER_WORKERS = min(2, (os.cpu_count() or 1) - 1)
+DPI = 70
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned processes do not inherit the threads (e.g. Qt) of the parent
+            _pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def submit_render(func, *args):
+    """
+    Runs a rendering function in the pool.
+    :return: Future of the result of the function
+    """
+    if RENDER_WORKERS == 0:
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return get_render_pool().submit(func, *args)
+
+
+def shutdown_render_pool(wait=True):
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=wait)
+            _pool = None
+
+
+def wait_for_renders(futures):
+    """
+    Waits for rendering jobs to finish.
+    :param futures: The Futures of the jobs
+    :return: List of the image paths
+    """
+    return [future.result() for future in futures]
+
+
+def render_diff_dist_mat(image_path, title, condensed, dpi=DPI):
+    """
+    Draws a distance difference matrix.
+    :param image_path: The path of the PNG file
+    :param title: The title of the plot
+    :param condensed: The condensed distance difference matrix to draw
+    :return: The image path
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    axis = fig.subplots()
+    axis.set_title(title)
+    axis.set_xlabel("Residue Number")
+    axis.set_ylabel("Residue Number")
+    axis.matshow(to_square(condensed))
+    fig.savefig(image_path, dpi=dpi)
+    return image_path
+
+
+def render_dendrogram(image_path, title, link_mat, magnitude, dpi=DPI):
+    """
+    Draws the motion tree.
+    :param image_path: The path of the PNG file
+    :param title: The title of the plot
+    :param link_mat: The linkage matrix of the motion tree
+    :param magnitude: The magnitude, above which the merges are annotated
+    :return: The image path
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    axis = fig.subplots()
+    axis.set_title(title)
+    axis.set_xlabel("Residue Number")
+    axis.set_ylabel("Magnitude (Å)")
+    annotated_dendrogram(
+        link_mat,
+        ax=axis,
+        truncate_mode='lastp',
+        p=50,
+        leaf_rotation=90.,
+        leaf_font_size=12.,
+        show_contracted=True,
+        annotate_above=magnitude,
+        max_d=magnitude,
+        show_leaf_counts=False
+    )
+    fig.savefig(image_path, dpi=dpi)
+    return image_path
+
+
+def annotated_dendrogram(*args, **kwargs):
+    """
+    Dendrogram customised for better readability, drawn on the axes given as ax.
+    https://joernhees.de/blog/2015/08/26/scipy-hierarchical-clustering-and-dendrogram-tutorial/
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    max_d = kwargs.pop('max_d', None)
+    if max_d and 'color_threshold' not in kwargs:
+        kwargs['color_threshold'] = max_d
+    annotate_above = kwargs.pop('annotate_above', 0)
+    axis = kwargs['ax']
+
+    ddata = dendrogram(*args, **kwargs)
+
+    if not kwargs.get('no_plot', False):
+        axis.set_title('Hierarchical Clustering Dendrogram (truncated)')
+        axis.set_xlabel('sample index or (cluster size)')
+        axis.set_ylabel('distance')
+        for i, d, c in zip(ddata['icoord'], ddata['dcoord'], ddata['color_list']):
+            x = 0.5 * sum(i[1:3])
+            y = d[1]
+            if y > annotate_above:
+                axis.plot(x, y, 'o', c=c)
+                axis.annotate("%.2f" % y, (x, y), xytext=(0, -5),
+                              textcoords='offset points',
+                              va='top', ha='center')
+        if max_d:
+            axis.axhline(y=max_d, c='k')
+    return ddata
@@ -0,0 +1,373 @@
+import os
+import time
+import json
+import shutil
+import struct
+import zipfile
+import threading
+import numpy as np
+from PdbWriter import AtomRecords, write_pdb_models
+from DiffMatrixCache import hash_coords
+from FileMngr import write_domain_outputs, get_continuous_ranges, get_residue_nums, save_results_to_disk
+"""
+Single-file bundle of the results of a protein pair, in place of the folder of output files of every parameter set. The
+bundle is an uncompressed .npz (zip) file holding:
+
+    meta.json                                   The proteins, whether they are from a DynDom file, and the RMSD
+    diff_dist_mat.npy                           The condensed distance difference matrix, stored once
+    res_nums_1.npy, res_nums_2.npy              The residue numbers of the utilised residues of each protein
+    pdb/<chain>/<field>.npy                     The atoms of each model of the PDB file
+    link_mats/sp_<sp>_clust_<clust>.npy         The motion tree of each spatial proximity and cluster size
+    nodes/sp_<sp>_node_<node>_clust_<clust>_mag_<mag>/
+        magnitudes.npy, range_counts.npy, ranges.npy, meta.json
+                                                The effective nodes of each parameter set, with the domains stored as
+                                                ranges of utilised residue indices
+
+As the arrays are stored uncompressed, each one is read as a memory map of its part of the bundle, so opening a bundle
+only reads the zip index. The PyMOL scripts, domains.info, the PDB file and the images are written from the bundle when
+they are needed (write_outputs). New parameter sets are appended to the bundle. A bundle has one writer at a time.
+"""
+
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = ".npz"
+NODE_DOMAINS = ["large_domain", "small_domain"]
+PDB_FIELDS = ["atom_names", "res_names", "res_nums", "coords"]
+
+# Bundle path -> threading.Lock of the threads writing to it
+_bundle_locks = {}
+_bundle_locks_lock = threading.Lock()
+
+
+def get_bundle_path(output_path, proteins_folder):
+    return f"{output_path}/{proteins_folder}{BUNDLE_SUFFIX}"
+
+
+def get_bundle_lock(path):
+    # The lock held while writing to a bundle. Bundles are written by one process at a time.
+    with _bundle_locks_lock:
+        return _bundle_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def get_params_key(spat_prox, small_node, clust_size, magnitude):
+    return f"sp_{spat_prox}_node_{small_node}_clust_{clust_size}_mag_{magnitude}"
+
+
+def get_link_mat_key(spat_prox, clust_size):
+    # The motion tree only depends on the spatial proximity and cluster size
+    return f"sp_{spat_prox}_clust_{clust_size}"
+
+
+def get_coords_digest(coords_1, coords_2):
+    # Identifies the distance difference matrix by the coordinates it was computed from
+    return hash_coords(np.stack([coords_1, coords_2]))
+
+
+class BundledProtein:
+    def __init__(self, code, chain_param, res_nums):
+        """
+        The residue numbers of a protein of a bundle, used by the output writers in place of a Protein.
+        :param res_nums: The residue numbers of the utilised residues
+        """
+        self.code = code
+        self.chain_param = chain_param
+        self.res_nums = res_nums
+
+    def get_residue_nums(self, indices, utilised=True):
+        if utilised:
+            return self.res_nums[indices].tolist()
+        else:
+            return np.delete(self.res_nums, indices).tolist()
+
+
+class ResultBundle:
+    def __init__(self, path):
+        """
+        Opens a bundle, reading its index and meta data. The arrays are read when they are used.
+        :param path: The path of the bundle file
+        """
+        self.path = path
+        self.meta = None
+        # Member name -> zipfile.ZipInfo
+        self.members = {}
+        self.read_index()
+
+    @classmethod
+    def create(cls, path, protein_1, protein_2, is_dyndom, rmsd, diff_dist_mat, pdb_models=None, coords_digest=None,
+               pair=None):
+        """
+        Writes a new bundle, replacing any bundle at the path.
+        :param protein_1: Protein 1 (or any object with code, chain_param and get_residue_nums)
+        :param protein_2: Protein 2
+        :param rmsd: The RMSD of the superposition of the proteins
+        :param diff_dist_mat: The condensed distance difference matrix
+        :param pdb_models: List of (chain ID, AtomRecords) of the PDB file, or None
+        :param coords_digest: Identifies the coordinates the matrix was computed from (see get_coords_digest)
+        :param pair: The PreprocessedPair of the proteins, if there is one
+        :return: ResultBundle
+        """
+        res_nums_1 = np.asarray(get_residue_nums(protein_1, 1, pair, slice(None)))
+        res_nums_2 = np.asarray(get_residue_nums(protein_2, 2, pair, slice(None)))
+        meta = {
+            "version": BUNDLE_VERSION,
+            "protein_1": protein_1.code,
+            "chain_1": protein_1.chain_param,
+            "protein_2": protein_2.code,
+            "chain_2": protein_2.chain_param,
+            "is_dyndom": is_dyndom,
+            "rmsd": float(rmsd),
+            "num_residues": res_nums_1.shape[0],
+            "pdb_chains": [chain_id for chain_id, _ in pdb_models] if pdb_models is not None else [],
+            "coords_digest": coords_digest
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with zipfile.ZipFile(tmp_path, "w", allowZip64=True) as zf:
+                write_json_member(zf, "meta.json", meta)
+                write_array_member(zf, "diff_dist_mat.npy", diff_dist_mat)
+                write_array_member(zf, "res_nums_1.npy", res_nums_1)
+                write_array_member(zf, "res_nums_2.npy", res_nums_2)
+                for chain_id, records in (pdb_models or []):
+                    write_array_member(zf, f"pdb/{chain_id}/atom_names.npy", np.asarray(records.atom_names))
+                    write_array_member(zf, f"pdb/{chain_id}/res_names.npy", np.asarray(records.res_names))
+                    write_array_member(zf, f"pdb/{chain_id}/res_nums.npy", np.asarray(records.res_nums))
+                    write_array_member(zf, f"pdb/{chain_id}/coords.npy", records.coords)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return cls(path)
+
+    def read_index(self):
+        with zipfile.ZipFile(self.path, "r") as zf:
+            self.members = {info.filename: info for info in zf.infolist()}
+            with zf.open("meta.json") as fr:
+                self.meta = json.load(fr)
+        if self.meta.get("version") != BUNDLE_VERSION:
+            raise ValueError(f"{self.path} is a bundle of version {self.meta.get('version')}, not {BUNDLE_VERSION}")
+
+    def get_array(self, name):
+        """
+        Get an array of the bundle as a read-only memory map of the bundle file.
+        :param name: The member name, e.g. "diff_dist_mat.npy"
+        :return: numpy.memmap (or an empty array)
+        """
+        info = self.members.get(name)
+        if info is None:
+            raise KeyError(f"{name} is not in {self.path}")
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError(f"{name} in {self.path} is compressed and cannot be memory-mapped")
+        with open(self.path, "rb") as fr:
+            # The data follows the local file header, whose extra field can differ from the central directory's
+            fr.seek(info.header_offset)
+            header = fr.read(30)
+            if header[:4] != b"PK\x03\x04":
+                raise ValueError(f"{self.path} is not a valid bundle")
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            fr.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(fr)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fr)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fr)
+            offset = fr.tell()
+        if dtype.hasobject:
+            raise ValueError(f"{name} in {self.path} holds Python objects")
+        if int(np.prod(shape)) == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                         order="F" if fortran_order else "C")
+
+    def read_json(self, name):
+        with zipfile.ZipFile(self.path, "r") as zf:
+            with zf.open(name) as fr:
+                return json.load(fr)
+
+    @property
+    def diff_dist_mat(self):
+        return self.get_array("diff_dist_mat.npy")
+
+    def get_proteins(self):
+        return (BundledProtein(self.meta["protein_1"], self.meta["chain_1"], self.get_array("res_nums_1.npy")),
+                BundledProtein(self.meta["protein_2"], self.meta["chain_2"], self.get_array("res_nums_2.npy")))
+
+    def get_proteins_folder(self):
+        if self.meta["is_dyndom"]:
+            return self.meta["protein_1"]
+        return f"{self.meta['protein_1']}_{self.meta['chain_1']}_{self.meta['protein_2']}_{self.meta['chain_2']}"
+
+    def get_param_sets(self):
+        """
+        :return: List of (spatial proximity, small node size, cluster size, magnitude) of the results in the bundle
+        """
+        param_sets = []
+        for name in self.members:
+            if name.startswith("nodes/") and name.endswith("/meta.json"):
+                meta = self.read_json(name)
+                param_sets.append((meta["spat_prox"], meta["small_node"], meta["clust_size"], meta["magnitude"]))
+        return param_sets
+
+    def has_results(self, spat_prox, small_node, clust_size, magnitude):
+        return f"nodes/{get_params_key(spat_prox, small_node, clust_size, magnitude)}/meta.json" in self.members
+
+    def get_link_mat(self, spat_prox, clust_size):
+        return self.get_array(f"link_mats/{get_link_mat_key(spat_prox, clust_size)}.npy")
+
+    def get_nodes(self, spat_prox, small_node, clust_size, magnitude):
+        """
+        :return: Dictionary of the nodes, the same as MotionTree.nodes
+        """
+        prefix = f"nodes/{get_params_key(spat_prox, small_node, clust_size, magnitude)}"
+        return decode_nodes(self.get_array(f"{prefix}/magnitudes.npy"), self.get_array(f"{prefix}/range_counts.npy"),
+                            self.get_array(f"{prefix}/ranges.npy"))
+
+    def get_results_meta(self, spat_prox, small_node, clust_size, magnitude):
+        return self.read_json(f"nodes/{get_params_key(spat_prox, small_node, clust_size, magnitude)}/meta.json")
+
+    def get_pdb_models(self):
+        """
+        :return: List of (chain ID, AtomRecords) of the PDB file
+        """
+        return [(chain_id, AtomRecords(*[self.get_array(f"pdb/{chain_id}/{field}.npy") for field in PDB_FIELDS]))
+                for chain_id in self.meta["pdb_chains"]]
+
+    def add_results(self, spat_prox, small_node, clust_size, magnitude, link_mat, nodes, results_meta=None):
+        """
+        Adds the motion tree and nodes of a parameter set, replacing the nodes of an earlier run of the same parameters.
+        :param link_mat: The linkage matrix
+        :param nodes: The nodes (MotionTree.nodes)
+        :param results_meta: Dictionary of other information about the run (e.g. the time taken)
+        """
+        prefix = f"nodes/{get_params_key(spat_prox, small_node, clust_size, magnitude)}/"
+        if any(name.startswith(prefix) for name in self.members):
+            self.remove_members(prefix)
+        link_mat_name = f"link_mats/{get_link_mat_key(spat_prox, clust_size)}.npy"
+        magnitudes, range_counts, ranges = encode_nodes(nodes)
+        meta = {"spat_prox": spat_prox, "small_node": small_node, "clust_size": clust_size, "magnitude": magnitude,
+                "num_nodes": len(nodes)}
+        if results_meta is not None:
+            meta.update(results_meta)
+        with zipfile.ZipFile(self.path, "a", allowZip64=True) as zf:
+            # The motion tree of the same spatial proximity and cluster size is the same
+            if link_mat_name not in self.members:
+                write_array_member(zf, link_mat_name, link_mat)
+            write_array_member(zf, f"{prefix}magnitudes.npy", magnitudes)
+            write_array_member(zf, f"{prefix}range_counts.npy", range_counts)
+            write_array_member(zf, f"{prefix}ranges.npy", ranges)
+            # Written last, so a parameter set is listed only once it is complete
+            write_json_member(zf, f"{prefix}meta.json", meta)
+        self.read_index()
+
+    def remove_members(self, prefix):
+        # Zip files cannot remove members, so the bundle is copied without them
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with zipfile.ZipFile(self.path, "r") as zin, zipfile.ZipFile(tmp_path, "w", allowZip64=True) as zout:
+                for info in zin.infolist():
+                    if info.filename.startswith(prefix):
+                        continue
+                    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+                    new_info.compress_type = zipfile.ZIP_STORED
+                    with zin.open(info) as src, zout.open(new_info, "w",
+                                                          force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.read_index()
+
+    def write_outputs(self, output_path, spat_prox, small_node, clust_size, magnitude, images=False):
+        """
+        Writes the output files of a parameter set from the bundle, the same as a run writing them directly: the PyMOL
+        scripts of the nodes, domains.info and the PDB file.
+        :param images: Whether to also save the distance difference matrix and draw the images (see
+        FileMngr.save_results_to_disk)
+        :return: List of the Futures of the images
+        """
+        protein_1, protein_2 = self.get_proteins()
+        proteins_folder = self.get_proteins_folder()
+        dir_path = f"{output_path}/{proteins_folder}/{get_params_key(spat_prox, small_node, clust_size, magnitude)}"
+        os.makedirs(dir_path, exist_ok=True)
+        image_futures = []
+        if images:
+            protein_2_name = None if self.meta["is_dyndom"] else protein_2.code
+            chain_1 = None if self.meta["is_dyndom"] else protein_1.chain_param
+            chain_2 = None if self.meta["is_dyndom"] else protein_2.chain_param
+            for data, image_type in [(self.diff_dist_mat, "diff_dist_mat"),
+                                     (self.get_link_mat(spat_prox, clust_size), "dendrogram")]:
+                image_futures.append(save_results_to_disk(output_path, protein_1.code, chain_1, protein_2_name, chain_2,
+                                                          spat_prox, small_node, clust_size, magnitude, data,
+                                                          image_type))
+        write_domain_outputs(output_path, protein_1, protein_2, spat_prox, small_node, clust_size, magnitude,
+                             self.get_nodes(spat_prox, small_node, clust_size, magnitude), self.meta["rmsd"],
+                             self.meta["is_dyndom"])
+        if self.meta["pdb_chains"]:
+            write_pdb_models(f"{dir_path}/{proteins_folder}.pdb", self.get_pdb_models())
+        return image_futures
+
+
+def load_bundle(path, coords_digest=None):
+    """
+    Opens the bundle at the path if there is a readable one.
+    :param coords_digest: If given, the bundle must hold the distance difference matrix of these coordinates
+    :return: ResultBundle, or None
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        bundle = ResultBundle(path)
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    if coords_digest is not None and bundle.meta["coords_digest"] != coords_digest:
+        return None
+    return bundle
+
+
+def write_array_member(zf, name, arr):
+    # Stored uncompressed, so the array can be memory-mapped
+    arr = np.asanyarray(arr)
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    with zf.open(info, "w", force_zip64=arr.nbytes + 1024 > zipfile.ZIP64_LIMIT) as fw:
+        np.lib.format.write_array(fw, arr, allow_pickle=False)
+
+
+def write_json_member(zf, name, data):
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    zf.writestr(info, json.dumps(data))
+
+
+def encode_nodes(nodes):
+    """
+    Get the nodes as arrays, with each domain as ranges of consecutive utilised residue indices.
+    :param nodes: The nodes (MotionTree.nodes)
+    :return: The magnitudes of the nodes, the number of ranges of the large and small domain of each node, and the
+    first and last index of each range
+    """
+    magnitudes = []
+    range_counts = []
+    ranges = []
+    for key in sorted(nodes.keys()):
+        magnitudes.append(nodes[key]["magnitude"])
+        for domain in NODE_DOMAINS:
+            starts, ends = get_continuous_ranges(np.asarray(nodes[key][domain], dtype=np.int64))
+            range_counts.append(len(starts))
+            ranges.extend(zip(starts, ends))
+    return (np.array(magnitudes, dtype=np.float64), np.array(range_counts, dtype=np.int64).reshape(-1, 2),
+            np.array(ranges, dtype=np.int64).reshape(-1, 2))
+
+
+def decode_nodes(magnitudes, range_counts, ranges):
+    # The nodes from encode_nodes
+    nodes = {}
+    ranges = ranges.tolist()
+    r = 0
+    for i, (magnitude, counts) in enumerate(zip(magnitudes.tolist(), range_counts.tolist())):
+        node = {"magnitude": magnitude}
+        for domain, count in zip(NODE_DOMAINS, counts):
+            node[domain] = [j for start, end in ranges[r:r + count] for j in range(start, end + 1)]
+            r += count
+        nodes[i] = node
+    return nodes
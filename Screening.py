@@ -0,0 +1,345 @@
+import os
+import json
+import numpy as np
+from scipy import sparse
+from FileMngr import find_structure_file, STRUCTURE_FILE_FORMATS
+from CoordCache import get_ca_data, write_json
+from Alignment import alignment_cache
+"""
+Screening of candidate protein pairs before they are run.
+- Sequence identity: The full pipeline downloads and parses both structure files and aligns the chains before rejecting
+  pairs under 90% sequence identity, so large candidate lists are screened first with an estimate of the identity from
+  the k-mers shared by the sequences. The sequences come from a SequenceIndex, which can be filled from the RCSB
+  pdb_seqres.txt file without downloading any structures.
+- RMSD: For a collection of structures of one protein, the CA atoms of every structure are mapped onto a common set of
+  aligned residues once, and the RMSD of every pair is computed with a batched superposition to rank the pairs.
+"""
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+# Length of the k-mers of the identity estimate
+SCREEN_K = 4
+# The estimate is not exact, so pairs are kept if the estimate is within this many percent of the identity threshold
+SCREEN_MARGIN = 5.0
+
+
+class SequenceIndex:
+    def __init__(self, index_path=None):
+        """
+        Persistent map of protein chains to their one-letter code sequences.
+        :param index_path: The path to the JSON file of the index. The index is only kept in memory if None.
+        """
+        self.index_path = index_path
+        self.sequences = {}
+        if index_path is not None and os.path.exists(index_path):
+            with open(index_path, "r") as fr:
+                self.sequences = json.load(fr)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __contains__(self, code_chain):
+        return get_index_key(*code_chain) in self.sequences
+
+    def get(self, code, chain):
+        return self.sequences.get(get_index_key(code, chain))
+
+    def add(self, code, chain, sequence):
+        self.sequences[get_index_key(code, chain)] = sequence
+
+    def save(self):
+        if self.index_path is not None:
+            write_json(self.index_path, self.sequences)
+
+    def load_seqres(self, seqres_path):
+        """
+        Adds the protein chains of a FASTA file in the format of the RCSB pdb_seqres.txt file, where every header is
+        ">{code}_{chain} mol:protein length:{length}  {name}".
+        :param seqres_path: The path to the FASTA file
+        :return: The number of chains added
+        """
+        num_added = 0
+        key = None
+        parts = []
+        with open(seqres_path, "r") as fr:
+            for line in fr:
+                line = line.strip()
+                if line.startswith(">"):
+                    if key is not None:
+                        self.add(*key, "".join(parts))
+                        num_added += 1
+                    tokens = line[1:].split()
+                    key = None
+                    parts = []
+                    if len(tokens) > 1 and tokens[1] != "mol:protein":
+                        continue
+                    code, _, chain = tokens[0].partition("_")
+                    key = (code, chain)
+                elif key is not None:
+                    parts.append(line)
+        if key is not None:
+            self.add(*key, "".join(parts))
+            num_added += 1
+        return num_added
+
+    def add_from_file(self, input_path, code, chain):
+        """
+        Adds the polymer sequence of a chain from a structure file that is already in the input folder.
+        :return: The sequence, or None if there is no structure file
+        """
+        file_path = find_structure_file(input_path, code)
+        if file_path is None:
+            return None
+        sequence = get_ca_data(file_path, 0, chain).sequence
+        self.add(code, chain, sequence)
+        return sequence
+
+
+def get_index_key(code, chain):
+    return f"{code.lower()}_{chain}"
+
+
+def get_kmer_profiles(sequences, k=SCREEN_K):
+    """
+    Counts the k-mers of the sequences.
+    :param sequences: List of one-letter code sequences
+    :param k: The length of the k-mers
+    :return: Sparse matrix of the k-mer counts with a row per sequence
+    """
+    # Residues other than the 20 standard amino acids are mapped to one extra letter
+    alphabet_size = len(AMINO_ACIDS) + 1
+    lookup = np.full(256, len(AMINO_ACIDS), dtype=np.int64)
+    lookup[np.frombuffer(AMINO_ACIDS.encode(), dtype=np.uint8)] = np.arange(len(AMINO_ACIDS))
+    rows = []
+    cols = []
+    for row, sequence in enumerate(sequences):
+        codes = lookup[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+        if codes.shape[0] < k:
+            continue
+        kmer_ids = np.zeros(codes.shape[0] - k + 1, dtype=np.int64)
+        for offset in range(k):
+            kmer_ids = kmer_ids * alphabet_size + codes[offset:offset + kmer_ids.shape[0]]
+        rows.append(np.full(kmer_ids.shape[0], row))
+        cols.append(kmer_ids)
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=np.int64)
+    # Duplicate entries are summed, giving the count of every k-mer
+    return sparse.csr_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(len(sequences), alphabet_size ** k))
+
+
+def estimate_identities(sequences_1, sequences_2, k=SCREEN_K):
+    """
+    Estimates the sequence identity (the lower of the identities over each sequence's length, as in
+    check_sequence_identity_standard) of every pair of sequences. If a fraction c of the residues are conserved, about
+    c^k of the k-mers are shared, so c is estimated from the shared k-mers of the shorter sequence and scaled by the
+    lengths of the sequences.
+    :param sequences_1: List of the first sequences of the pairs
+    :param sequences_2: List of the second sequences of the pairs
+    :param k: The length of the k-mers
+    :return: Array of the estimated identities in percent
+    """
+    unique_sequences = list(dict.fromkeys(list(sequences_1) + list(sequences_2)))
+    row_of = {sequence: row for row, sequence in enumerate(unique_sequences)}
+    rows_1 = np.array([row_of[s] for s in sequences_1], dtype=np.int64)
+    rows_2 = np.array([row_of[s] for s in sequences_2], dtype=np.int64)
+    profiles = get_kmer_profiles(unique_sequences, k)
+    shared = np.asarray(profiles[rows_1].minimum(profiles[rows_2]).sum(axis=1)).ravel()
+
+    lengths = np.array([len(s) for s in unique_sequences], dtype=np.float64)
+    min_lengths = np.minimum(lengths[rows_1], lengths[rows_2])
+    max_lengths = np.maximum(lengths[rows_1], lengths[rows_2])
+    num_kmers = np.maximum(min_lengths - k + 1, 1)
+    conserved = np.clip(shared / num_kmers, 0, 1) ** (1 / k)
+    identities = 100 * conserved * min_lengths / np.maximum(max_lengths, 1)
+    identities[min_lengths < k] = 0
+    return identities
+
+
+def screen_pairs(pairs, sequence_index, min_identity=90, margin=SCREEN_MARGIN, input_path=None, k=SCREEN_K):
+    """
+    Screens candidate pairs of protein chains by their estimated sequence identity.
+    :param pairs: List of (code 1, chain 1, code 2, chain 2)
+    :param sequence_index: The SequenceIndex of the sequences
+    :param min_identity: The sequence identity the pairs need to pass
+    :param margin: Pairs are kept if the estimated identity is at least min_identity - margin
+    :param input_path: If given, chains that are not in the index are added from the structure files in this folder
+    :param k: The length of the k-mers
+    :return: The pairs likely to pass, the estimated identities of all pairs (NaN if a sequence is unknown) and the
+    pairs with an unknown sequence
+    """
+    sequences = []
+    for code_1, chain_1, code_2, chain_2 in pairs:
+        sequence_1 = get_indexed_sequence(sequence_index, code_1, chain_1, input_path)
+        sequence_2 = get_indexed_sequence(sequence_index, code_2, chain_2, input_path)
+        sequences.append((sequence_1, sequence_2))
+    if input_path is not None:
+        sequence_index.save()
+
+    is_known = np.array([s1 is not None and s2 is not None for s1, s2 in sequences], dtype=bool)
+    identities = np.full(len(pairs), np.nan)
+    known = np.flatnonzero(is_known)
+    if known.shape[0] > 0:
+        identities[known] = estimate_identities([sequences[i][0] for i in known], [sequences[i][1] for i in known], k)
+    passed = [pairs[i] for i in known if identities[i] >= min_identity - margin]
+    unknown = [pairs[i] for i in np.flatnonzero(~is_known)]
+    return passed, identities, unknown
+
+
+def get_indexed_sequence(sequence_index, code, chain, input_path=None):
+    sequence = sequence_index.get(code, chain)
+    if sequence is None and input_path is not None:
+        try:
+            sequence = sequence_index.add_from_file(input_path, code, chain)
+        except Exception as e:
+            print(e)
+    return sequence
+
+
+class ConformerSet:
+    def __init__(self, codes, chains, res_indices, coords, res_nums, skipped):
+        """
+        The CA atoms of a collection of structures of one protein on a common set of aligned residues.
+        :param codes: The codes of the M structures
+        :param chains: The chain used in each structure
+        :param res_indices: (M, N) array of the indices of the common residues in each structure's polymer
+        :param coords: (M, N, 3) array of the CA coordinates of the common residues
+        :param res_nums: The residue sequence numbers of the common residues in the first (reference) structure
+        :param skipped: Dictionary of the structures that could not be used to the reason
+        """
+        self.codes = codes
+        self.chains = chains
+        self.res_indices = res_indices
+        self.coords = coords
+        self.res_nums = res_nums
+        self.skipped = skipped
+
+
+def find_structure_codes(input_path):
+    # The codes of the structure files in the folder, in any of the accepted formats
+    codes = set()
+    for file_name in os.listdir(input_path):
+        for file_format in STRUCTURE_FILE_FORMATS:
+            if file_name.endswith(file_format):
+                codes.add(file_name[:-len(file_format)])
+                break
+    return sorted(codes)
+
+
+def load_conformers(input_path, chain="A", codes=None, min_identity=90):
+    """
+    Loads the CA atoms of the structures onto the residues they share. The sequence of every chain is aligned to the
+    first structure, and only the residues of the first structure that are aligned to a residue with a CA atom in every
+    other structure are kept.
+    :param input_path: The folder of the structure files
+    :param chain: The chain ID used in every structure, or a dictionary of the structure code to the chain ID
+    :param codes: The codes of the structures. If None, every structure file in the folder is used.
+    :param min_identity: Structures with a lower sequence identity to the first structure are skipped
+    :return: ConformerSet
+    """
+    if codes is None:
+        codes = find_structure_codes(input_path)
+    skipped = {}
+    loaded = []
+    for code in codes:
+        chain_id = chain.get(code, "A") if isinstance(chain, dict) else chain
+        try:
+            ca_data = get_ca_data(find_structure_file(input_path, code), 0, chain_id)
+        except Exception as e:
+            skipped[code] = str(e)
+            continue
+        if len(ca_data) == 0:
+            skipped[code] = f"Chain {chain_id} has no polymer"
+            continue
+        loaded.append((code, chain_id, ca_data))
+    if len(loaded) == 0:
+        return ConformerSet([], [], np.empty((0, 0), dtype=np.int64), np.empty((0, 0, 3)), np.empty(0), skipped)
+
+    ref_ca_data = loaded[0][2]
+    # (structure, reference residue) -> index of the aligned residue with a CA atom in the structure, or -1
+    mappings = []
+    used = []
+    for code, chain_id, ca_data in loaded:
+        alignment = alignment_cache.align(ref_ca_data.sequence, ca_data.sequence)
+        identity = min(alignment.calculate_identity(1), alignment.calculate_identity(2))
+        if identity < min_identity:
+            skipped[code] = f"Sequence identity {identity:.1f}% to {loaded[0][0]}"
+            continue
+        ref_ind, res_ind = alignment.aligned_indices()
+        # The sequence skips alternative conformations, so indices can run past the CA data (as in MotionTree)
+        in_range = (ref_ind < len(ref_ca_data)) & (res_ind < len(ca_data))
+        ref_ind = ref_ind[in_range]
+        res_ind = res_ind[in_range]
+        has_ca = ca_data.has_ca[res_ind]
+        mapping = np.full(len(ref_ca_data), -1, dtype=np.int64)
+        mapping[ref_ind[has_ca]] = res_ind[has_ca]
+        mappings.append(mapping)
+        used.append((code, chain_id, ca_data))
+
+    mappings = np.stack(mappings)
+    common = np.flatnonzero(np.all(mappings >= 0, axis=0) & ref_ca_data.has_ca)
+    res_indices = mappings[:, common]
+    coords = np.stack([ca_data.coords[res_indices[m]] for m, (_, _, ca_data) in enumerate(used)])
+    return ConformerSet([code for code, _, _ in used], [chain_id for _, chain_id, _ in used], res_indices, coords,
+                        np.asarray(ref_ca_data.seqids)[common], skipped)
+
+
+def batch_rmsd_matrix(coords, block_size=64):
+    """
+    Computes the RMSD after optimal superposition (Kabsch) of every pair of coordinate sets. The covariance matrices of
+    a block of pairs are computed in one einsum and their singular values in one batched SVD.
+    :param coords: (M, N, 3) array of coordinates
+    :param block_size: The number of structures per block of rows, which bounds the memory of the (block, M, 3, 3)
+    covariance array
+    :return: (M, M) array of the RMSDs
+    """
+    num_structures, num_atoms = coords.shape[0], coords.shape[1]
+    centred = coords - coords.mean(axis=1, keepdims=True)
+    sq_sums = np.einsum("mni,mni->m", centred, centred)
+    rmsd_mat = np.zeros((num_structures, num_structures))
+    for start in range(0, num_structures, block_size):
+        end = min(start + block_size, num_structures)
+        covariances = np.einsum("ani,bnj->abij", centred[start:end], centred)
+        singular_values = np.linalg.svd(covariances, compute_uv=False)
+        # A reflection is not a rotation, so the smallest singular value changes sign when the determinant is negative
+        signs = np.sign(np.linalg.det(covariances))
+        singular_values[..., 2] *= np.where(signs == 0, 1, signs)
+        sq_dev = sq_sums[start:end, None] + sq_sums[None, :] - 2 * singular_values.sum(axis=-1)
+        rmsd_mat[start:end] = np.sqrt(np.maximum(sq_dev, 0) / num_atoms)
+    np.fill_diagonal(rmsd_mat, 0)
+    return rmsd_mat
+
+
+def rank_pairs(rmsd_mat, codes, chains=None, min_rmsd=1.0):
+    """
+    Ranks the pairs of structures by RMSD, largest first.
+    :param rmsd_mat: (M, M) array of the RMSDs
+    :param codes: The codes of the structures
+    :param chains: The chain of each structure
+    :param min_rmsd: Pairs with a lower RMSD are left out. MotionTree rejects pairs under 1 Å.
+    :return: List of (code 1, chain 1, code 2, chain 2, RMSD)
+    """
+    if chains is None:
+        chains = ["A"] * len(codes)
+    rows, cols = np.triu_indices(len(codes), k=1)
+    rmsds = rmsd_mat[rows, cols]
+    keep = rmsds >= min_rmsd
+    rows, cols, rmsds = rows[keep], cols[keep], rmsds[keep]
+    order = np.argsort(-rmsds, kind="stable")
+    return [(codes[rows[i]], chains[rows[i]], codes[cols[i]], chains[cols[i]], float(rmsds[i])) for i in order]
+
+
+def screen_conformers(input_path, chain="A", codes=None, min_rmsd=1.0, min_identity=90):
+    """
+    Loads a collection of structures of one protein and ranks every pair of them by the RMSD of their common residues.
+    :return: The ranked pairs (see rank_pairs), the (M, M) RMSD matrix and the ConformerSet
+    """
+    conformers = load_conformers(input_path, chain, codes, min_identity)
+    rmsd_mat = batch_rmsd_matrix(conformers.coords)
+    ranked = rank_pairs(rmsd_mat, conformers.codes, conformers.chains, min_rmsd)
+    return ranked, rmsd_mat, conformers
+
+
+def write_ranked_pairs(file_path, ranked):
+    with open(file_path, "w") as fw:
+        fw.write("# protein1 chain1 protein2 chain2 rmsd\n")
+        for code_1, chain_1, code_2, chain_2, rmsd in ranked:
+            fw.write(f"{code_1} {chain_1} {code_2} {chain_2} {round(rmsd, 3)}\n")
@@ -0,0 +1,145 @@
+import os
+import threading
+from collections import OrderedDict
+import gemmi
+from FileMngr import is_pdb_format
+"""
+Process-wide cache of parsed structures. Every Protein in the process (including the ones built by separate
+OutputWindow workers) reads its structure through `structure_cache`, so a PDB file is only parsed once no matter how
+many parameter sets are run on it at the same time.
+"""
+
+# Rough number of bytes a parsed gemmi atom takes up, including its share of the residue and chain objects.
+APPROX_ATOM_BYTES = 160
+
+
+class StructureCache:
+    def __init__(self, max_entries=32, max_bytes=512 * 1024 * 1024):
+        """
+        Bounded, thread-safe LRU cache of gemmi structures keyed by the file path, modification time and size.
+        :param max_entries: The maximum number of structures kept in the cache
+        :param max_bytes: The approximate maximum memory (in bytes) used by the cached structures
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Key -> (structure, approximate size in bytes). Most recently used entries are at the end.
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        # Key -> threading.Event of the structures currently being parsed, so that threads asking for the same file at
+        # the same time wait for the one parse instead of each parsing the file themselves.
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_path):
+        """
+        Get the parsed structure of the file. The returned structure is shared with every other user of the cache and
+        must be treated as read-only. Use structure.clone() before modifying it.
+        :param file_path: The path to the structure file
+        :return: The gemmi.Structure of the file
+        """
+        key = get_file_key(file_path)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                event = self._loading.get(key)
+                if event is None:
+                    # This thread parses the file
+                    event = threading.Event()
+                    self._loading[key] = event
+                    self.misses += 1
+                    break
+            # Another thread is parsing the file. Wait for it and look up the cache again.
+            event.wait()
+
+        try:
+            structure = read_structure_file(file_path)
+            size = estimate_structure_size(structure)
+            with self._lock:
+                self._insert(key, structure, size)
+            return structure
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+    def _insert(self, key, structure, size):
+        # A structure larger than the whole budget is returned to the caller but not cached
+        if size > self.max_bytes:
+            return
+        # Drop older versions of the same file
+        for old_key in [k for k in self._entries.keys() if k[0] == key[0]]:
+            self._remove(old_key)
+        self._entries[key] = (structure, size)
+        self._total_bytes += size
+        self._evict()
+
+    def _remove(self, key):
+        structure, size = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def configure(self, max_entries=None, max_bytes=None):
+        """
+        Changes the limits of the cache. Entries over the new limits are evicted straight away.
+        :param max_entries: The maximum number of structures kept in the cache
+        :param max_bytes: The approximate maximum memory (in bytes) used by the cached structures
+        :return:
+        """
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes
+            }
+
+
+def get_file_key(file_path):
+    stat = os.stat(file_path)
+    return os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size
+
+
+def read_structure_file(file_path):
+    # gemmi decompresses gzipped files while reading them. PDB files are read with read_pdb, which keeps the chain parts
+    # separate like the CA reader does, instead of read_structure which merges them.
+    if is_pdb_format(file_path):
+        return gemmi.read_pdb(file_path)
+    return gemmi.read_structure(file_path)
+
+
+def estimate_structure_size(structure):
+    num_atoms = 0
+    for model in structure:
+        num_atoms += model.count_atom_sites()
+    return num_atoms * APPROX_ATOM_BYTES
+
+
+structure_cache = StructureCache()
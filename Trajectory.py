@@ -0,0 +1,214 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import gemmi
+from MotionTree import MotionTree
+from FileMngr import get_ca_pdb_models
+from OutputPipeline import wait_for_outputs
+from DistanceMatrix import get_distance_matrix
+"""
+Trajectory mode for long simulations exported as NumPy coordinate stacks. The (F, N, 3) .npy file of the CA coordinates
+of F frames and N residues is memory-mapped, so only the frames of the requested pairs are ever read from disk. The
+residue names and numbers of the N residues come from a residue metadata file, which is a text file with one
+"<residue number> <residue name>" line per residue ('#' lines are comments).
+"""
+
+
+class TrajectoryFrame:
+    def __init__(self, trajectory, frame_num):
+        """
+        A frame of a trajectory, used by MotionTree in place of a Protein.
+        :param trajectory: The Trajectory the frame is from
+        :param frame_num: The index of the frame
+        """
+        self.code = trajectory.name
+        self.chain_param = trajectory.chain
+        self.frame_num = frame_num
+        self.res_names = trajectory.res_names
+        self.res_nums = trajectory.res_nums
+        self.utilised_res_indices = trajectory.utilised_res_indices
+        # Copy the frame out of the memory map
+        self.utilised_atoms_coords = np.array(trajectory.coords[frame_num][self.utilised_res_indices], dtype=np.float64)
+        self.distance_matrix = None
+
+    def get_distance_matrix(self):
+        self.distance_matrix = get_distance_matrix(self.utilised_atoms_coords)
+        return self.distance_matrix
+
+    def get_residue_nums(self, indices, utilised=True):
+        if utilised:
+            return self.res_nums[self.utilised_res_indices[indices]].tolist()
+        else:
+            temp = np.delete(self.utilised_res_indices, indices)
+            return self.res_nums[temp].tolist()
+
+
+class TrajectoryMotionTree(MotionTree):
+    """
+    MotionTree of a pair of trajectory frames. The frames only have CA coordinates, so the PDB file is written from the
+    frame coordinates and residue metadata, with frame 2 superimposed onto frame 1.
+    """
+    def __init__(self, output_path, frame_1, frame_2, spat_prox=7.0, small_node=5, clust_size=30, magnitude=5,
+                 output_mode="files", output_pipeline=None):
+        super().__init__(None, output_path, frame_1.code, None, None, None, spat_prox, small_node, clust_size,
+                         magnitude, is_dyndom=True, fetch_files=False, output_mode=output_mode,
+                         output_pipeline=output_pipeline)
+        self.protein_1 = frame_1
+        self.protein_2 = frame_2
+        self.num_residues = frame_1.utilised_res_indices.shape[0]
+        self.superposed_coords_2 = None
+
+    def superpose(self):
+        poses_1 = [gemmi.Position(*c) for c in self.protein_1.utilised_atoms_coords.tolist()]
+        poses_2 = [gemmi.Position(*c) for c in self.protein_2.utilised_atoms_coords.tolist()]
+        superpose_result = gemmi.superpose_positions(poses_1, poses_2)
+        self.rmsd = superpose_result.rmsd
+        rot = np.array(superpose_result.transform.mat.tolist())
+        shift = np.array(superpose_result.transform.vec.tolist())
+        self.superposed_coords_2 = self.protein_2.utilised_atoms_coords @ rot.T + shift
+        return self.rmsd
+
+    def get_pdb_models(self):
+        return get_ca_pdb_models(self.protein_1, self.protein_2, self.superposed_coords_2)
+
+
+class Trajectory:
+    def __init__(self, coords_path, metadata_path, output_path, name=None, chain="A", spat_prox=7.0, small_node=5,
+                 clust_size=30, magnitude=5, max_cached_frames=2, output_mode="files", output_pipeline=None):
+        """
+        :param coords_path: The path to the (F, N, 3) .npy file of CA coordinates
+        :param metadata_path: The path to the residue metadata file of the N residues
+        :param output_path: The folder the outputs are written to
+        :param name: The name used for the output folders. Defaults to the .npy file name.
+        :param chain: The chain ID written to the outputs
+        :param max_cached_frames: The number of frames (with their distance matrices) kept in memory between pairs, so
+        that pairs sharing a frame do not read it again
+        :param output_mode: The output mode of the motion trees of the pairs (see MotionTree)
+        :param output_pipeline: The OutputPipeline the outputs of the pairs are written in while the next pairs are run.
+        None writes the outputs of each pair before the next one.
+        """
+        self.coords_path = coords_path
+        self.metadata_path = metadata_path
+        self.output_path = output_path
+        self.name = name if name is not None else os.path.splitext(os.path.basename(coords_path))[0]
+        self.chain = chain
+        self.spat_prox = spat_prox
+        self.small_node = small_node
+        self.clust_size = clust_size
+        self.magnitude = magnitude
+        self.max_cached_frames = max_cached_frames
+        self.output_mode = output_mode
+        self.output_pipeline = output_pipeline
+        # Frame pair -> Future of the outputs of the pairs written in the output pipeline
+        self.output_futures = {}
+        # The trajectory stays on disk. Frames are only read when they are used.
+        self.coords = np.load(coords_path, mmap_mode="r")
+        if self.coords.ndim != 3 or self.coords.shape[2] != 3:
+            raise ValueError(f"Expected an (F, N, 3) coordinate array, got {self.coords.shape}")
+        self.res_nums, self.res_names = read_residue_metadata(metadata_path)
+        if self.res_nums.shape[0] != self.coords.shape[1]:
+            raise ValueError(f"The metadata has {self.res_nums.shape[0]} residues but the trajectory has "
+                             f"{self.coords.shape[1]}")
+        self.utilised_res_indices = np.arange(self.coords.shape[1])
+        # Frame index -> TrajectoryFrame of the most recently used frames
+        self._frames = OrderedDict()
+
+    @property
+    def num_frames(self):
+        return self.coords.shape[0]
+
+    def get_frame(self, frame_num):
+        """
+        Get the frame with its distance matrix, reading it from the memory map if it is not one of the cached frames.
+        :param frame_num: The index of the frame
+        :return: TrajectoryFrame
+        """
+        frame = self._frames.get(frame_num)
+        if frame is not None:
+            self._frames.move_to_end(frame_num)
+            return frame
+        if not 0 <= frame_num < self.num_frames:
+            raise IndexError(f"Frame {frame_num} not in trajectory of {self.num_frames} frames")
+        frame = TrajectoryFrame(self, frame_num)
+        frame.get_distance_matrix()
+        self._frames[frame_num] = frame
+        while len(self._frames) > self.max_cached_frames:
+            self._frames.popitem(last=False)
+        return frame
+
+    def get_pair_output_path(self, frame_1, frame_2):
+        return f"{self.output_path}/{self.name}_trajectory/frames_{frame_1}_{frame_2}"
+
+    def build_motion_tree(self, frame_1, frame_2):
+        """
+        Creates the MotionTree of a pair of frames, ready to run.
+        :param frame_1: The index of the first frame
+        :param frame_2: The index of the second frame
+        :return: TrajectoryMotionTree
+        """
+        engine = TrajectoryMotionTree(self.get_pair_output_path(frame_1, frame_2), self.get_frame(frame_1),
+                                      self.get_frame(frame_2), self.spat_prox, self.small_node, self.clust_size,
+                                      self.magnitude, self.output_mode, self.output_pipeline)
+        engine.superpose()
+        engine.create_distance_difference_matrix()
+        return engine
+
+    def iter_pairs(self, pairs):
+        """
+        Runs the motion trees of the frame pairs one at a time, so only the frames of the current pair (and the cached
+        frames) are in memory.
+        :param pairs: Iterable of (frame_1, frame_2) index pairs
+        :return: Generator of the frame pair and the outputs of MotionTree.run(), or the error if the pair failed
+        """
+        for frame_1, frame_2 in pairs:
+            try:
+                engine = self.build_motion_tree(frame_1, frame_2)
+                outputs = engine.run()
+                if engine.output_future is not None:
+                    self.output_futures[(frame_1, frame_2)] = engine.output_future
+                yield (frame_1, frame_2), outputs
+            except Exception as e:
+                print(e)
+                yield (frame_1, frame_2), e
+
+    def run_pairs(self, pairs=None, stride=1):
+        """
+        Builds the motion trees of the frame pairs.
+        :param pairs: List of (frame_1, frame_2) index pairs. If None, every frame is paired with the frame stride frames
+        after it.
+        :param stride: The number of frames between the frames of the default pairs
+        :return: Dictionary of the frame pair to the outputs of MotionTree.run(), or the error if the pair failed or its
+        outputs could not be written
+        """
+        if pairs is None:
+            pairs = [(i, i + stride) for i in range(self.num_frames - stride)]
+        results = dict(self.iter_pairs(pairs))
+        results.update(self.wait_for_outputs())
+        return results
+
+    def wait_for_outputs(self):
+        """
+        Waits for the outputs of the pairs in the output pipeline to be written.
+        :return: Dictionary of the frame pair to the error of each pair whose outputs could not be written
+        """
+        futures, self.output_futures = self.output_futures, {}
+        return wait_for_outputs(futures)
+
+
+def read_residue_metadata(metadata_path):
+    """
+    Reads the residue numbers and names of the trajectory residues.
+    :param metadata_path: The path to the metadata file with a "<residue number> <residue name>" line per residue
+    :return: Array of the residue numbers and array of the residue names
+    """
+    res_nums = []
+    res_names = []
+    with open(metadata_path, "r") as fr:
+        for line in fr:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            columns = line.split()
+            res_nums.append(int(columns[0]))
+            res_names.append(columns[1])
+    return np.asarray(res_nums, dtype=np.int32), np.asarray(res_names, dtype="U5")
@@ -1,3 +1,4 @@
+import multiprocessing
 import FileMngr
 from MotionTree import MotionTree
 
@@ -19,7 +20,9 @@ def main():
     engine = MotionTree(files_dict["input_path"], files_dict["output_path"],
                         files_dict["protein1"], files_dict["chain1id"], files_dict["protein2"], files_dict["chain2id"],
                         param_dict["spatial_proximity"], param_dict["small_node"],
-                        param_dict["clust_size"], param_dict["magnitude"])
+                        param_dict["clust_size"], param_dict["magnitude"],
+                        memory_budget=param_dict.get("memory_budget"), scratch_path=param_dict.get("scratch_path"),
+                        output_mode=param_dict.get("output_mode", "files"))
     engine.init_protein(1)
     engine.init_protein(2)
     engine.check_rmsd_standard()
@@ -28,6 +31,7 @@ def main():
     engine.dist_mat_processing()
     engine.create_distance_difference_matrix()
     engine.run()
+    engine.wait_for_images()
     # cluster_3, link_mat = engine.run()
 
     # for i in range(len(cluster_1[0])):
@@ -41,5 +45,6 @@ def main():
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
 
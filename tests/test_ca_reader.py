@@ -0,0 +1,51 @@
+import os
+import glob
+import numpy as np
+import pytest
+from StructureCache import structure_cache
+from CaReader import read_pdb_ca_data, read_pdb_ca_data_models
+from CoordCache import extract_ca_data_from_structure
+"""
+Conformance of the streaming CA reader with the gemmi structures, for every chain of every model of the bundled PDB
+files.
+"""
+
+INPUT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "input")
+PDB_FILES = sorted(glob.glob(f"{INPUT_PATH}/pdb/*.pdb") + glob.glob(f"{INPUT_PATH}/dyndom_pdb/*.pdb"))
+
+
+def get_model_chains(file_path):
+    # The IDs of the chains of each model. The readers use the first chain of an ID.
+    return [list(dict.fromkeys(chain.name for chain in model)) for model in structure_cache.get(file_path)]
+
+
+def assert_same_ca_data(ca_data, expected):
+    assert len(ca_data) == len(expected)
+    np.testing.assert_array_equal(ca_data.coords, expected.coords)
+    np.testing.assert_array_equal(ca_data.has_ca, expected.has_ca)
+    np.testing.assert_array_equal(ca_data.seqids, expected.seqids)
+    np.testing.assert_array_equal(ca_data.res_names, expected.res_names)
+    np.testing.assert_array_equal(ca_data.icodes, expected.icodes)
+    assert ca_data.sequence == expected.sequence
+
+
+@pytest.mark.parametrize("file_path", PDB_FILES, ids=os.path.basename)
+@pytest.mark.parametrize("polymer_only", [True, False])
+def test_read_pdb_ca_data(file_path, polymer_only):
+    for model_num, chain_ids in enumerate(get_model_chains(file_path)):
+        for chain_id in chain_ids:
+            assert_same_ca_data(read_pdb_ca_data(file_path, model_num, chain_id, polymer_only),
+                                extract_ca_data_from_structure(file_path, model_num, chain_id, polymer_only))
+
+
+@pytest.mark.parametrize("file_path", PDB_FILES, ids=os.path.basename)
+@pytest.mark.parametrize("polymer_only", [True, False])
+def test_read_pdb_ca_data_models(file_path, polymer_only):
+    model_chains = get_model_chains(file_path)
+    # Chains in every model
+    chain_ids = [chain_id for chain_id in model_chains[0] if all(chain_id in chains for chains in model_chains)]
+    for chain_id in chain_ids:
+        models_ca_data = read_pdb_ca_data_models(file_path, chain_id, polymer_only)
+        assert len(models_ca_data) == len(model_chains)
+        for model_num, ca_data in enumerate(models_ca_data):
+            assert_same_ca_data(ca_data, extract_ca_data_from_structure(file_path, model_num, chain_id, polymer_only))
@@ -0,0 +1,33 @@
+import numpy as np
+from DiffMatrixCache import DiffMatrixCache
+from DistanceMatrix import get_diff_distances_and_contacts
+"""
+Keys and round trip of the local distance difference matrix cache.
+"""
+
+
+def test_cache_keys(tmp_path):
+    rng = np.random.default_rng(0)
+    coords_1 = rng.uniform(0, 30, (20, 3))
+    coords_2 = rng.uniform(0, 30, (20, 3))
+    cache = DiffMatrixCache(str(tmp_path))
+    assert cache.get_keys(coords_1, coords_2, 7) == cache.get_keys(coords_1, coords_2, 7.0)
+    assert cache.get_keys(coords_1, coords_2, 7)[1] != cache.get_keys(coords_1, coords_2, 8)[1]
+    diff_key, contacts_key, is_swapped = cache.get_keys(coords_1, coords_2, 7.0)
+    assert cache.get_keys(coords_2, coords_1, 7.0) == (diff_key, contacts_key, not is_swapped)
+
+
+def test_cache_round_trip(tmp_path):
+    rng = np.random.default_rng(1)
+    coords_1 = rng.uniform(0, 30, (20, 3))
+    coords_2 = rng.uniform(0, 30, (20, 3))
+    cache = DiffMatrixCache(str(tmp_path))
+    assert cache.lookup(coords_1, coords_2, 7.0) is None
+    matrices = get_diff_distances_and_contacts(coords_1, coords_2, 7.0)
+    cache.store(coords_1, coords_2, 7.0, *matrices)
+    # A whole-number spatial proximity from params.txt or the GUI finds the same entry
+    for cached, expected in zip(cache.lookup(coords_1, coords_2, 7), matrices):
+        np.testing.assert_array_equal(cached, expected)
+    diff_dist_mat, contacts_1, contacts_2 = cache.lookup(coords_2, coords_1, 7.0)
+    np.testing.assert_array_equal(contacts_1, matrices[2])
+    np.testing.assert_array_equal(contacts_2, matrices[1])
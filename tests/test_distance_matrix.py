@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+from DistanceMatrix import (condensed_size, condensed_num_points, condensed_index, condensed_pair, to_condensed,
+                            to_square, get_block)
+"""
+Index maths of the condensed matrices against the layout of scipy.spatial.distance.squareform.
+"""
+
+SIZES = [2, 3, 4, 5, 17, 100]
+
+
+def make_condensed(n):
+    # Each entry holds its own index, so squareform puts index k at (i, j)
+    return np.arange(condensed_size(n), dtype=np.float64)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_condensed_size(n):
+    assert condensed_size(n) == squareform(np.zeros((n, n))).shape[0]
+    assert condensed_num_points(condensed_size(n)) == n
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_condensed_index(n):
+    square = squareform(make_condensed(n))
+    rows, cols = np.triu_indices(n, 1)
+    np.testing.assert_array_equal(condensed_index(n, rows, cols), square[rows, cols])
+    np.testing.assert_array_equal(condensed_index(n, cols, rows), square[rows, cols])
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        assert condensed_index(n, i, j) == square[i, j]
+    assert condensed_index(n, n - 2, n - 1) == condensed_size(n) - 1
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_condensed_pair(n):
+    square = squareform(make_condensed(n))
+    for k in range(condensed_size(n)):
+        i, j = condensed_pair(n, k)
+        assert 0 <= i < j < n
+        assert square[i, j] == k
+    assert condensed_pair(n, condensed_size(n) - 1) == (n - 2, n - 1)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def test_to_square_and_condensed(n):
+    condensed = make_condensed(n)
+    square = to_square(condensed)
+    np.testing.assert_array_equal(square, squareform(condensed))
+    np.testing.assert_array_equal(to_condensed(square), condensed)
+    np.testing.assert_array_equal(to_condensed(condensed), condensed)
+    np.testing.assert_array_equal(np.diag(to_square(condensed, diagonal=np.inf)), np.full(n, np.inf))
+
+
+def test_get_block():
+    n = 10
+    condensed = make_condensed(n)
+    square = squareform(condensed)
+    rows, cols = [0, 3, 9], [1, 2, 8]
+    np.testing.assert_array_equal(get_block(condensed, n, rows, cols), square[np.ix_(rows, cols)])
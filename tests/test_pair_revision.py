@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from PreprocessedPair import PreprocessedPair
+from PairRevision import revise_pair
+from DistanceMatrix import get_diff_distances_and_contacts
+"""
+The incremental update of the distance difference matrix of a revised pair against computing it again in full.
+"""
+
+NUM_RESIDUES = 120
+SPAT_PROX = 7.0
+
+
+def make_chain(rng):
+    # A random walk with CA-CA steps of 3.8 Å
+    steps = rng.normal(size=(NUM_RESIDUES, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=1)[:, None]
+    return np.cumsum(steps, axis=0)
+
+
+def make_pair(coords_1, coords_2):
+    res_indices = np.arange(NUM_RESIDUES)
+    return PreprocessedPair("1abc", "A", "2abc", "A", False, res_indices, res_indices, coords_1, coords_2,
+                            res_indices + 1, res_indices + 1, np.eye(3), np.zeros(3), 0.0)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_revise_pair_matches_full_recompute(seed):
+    rng = np.random.default_rng(seed)
+    coords_1 = make_chain(rng)
+    coords_2 = coords_1 + rng.normal(scale=2.0, size=coords_1.shape)
+    pair = make_pair(coords_1, coords_2)
+    diff_dist_mat, old_contacts_1, old_contacts_2 = get_diff_distances_and_contacts(coords_1, coords_2, SPAT_PROX)
+
+    # Move 7 residues of each protein
+    new_coords_1 = coords_1.copy()
+    new_coords_2 = coords_2.copy()
+    new_coords_1[rng.choice(NUM_RESIDUES, 7, replace=False)] += rng.normal(scale=1.5, size=(7, 3))
+    new_coords_2[rng.choice(NUM_RESIDUES, 7, replace=False)] += rng.normal(scale=1.5, size=(7, 3))
+    old_diff_dist_mat = diff_dist_mat.copy()
+    revision = revise_pair(pair, diff_dist_mat, new_coords_1, new_coords_2, SPAT_PROX)
+
+    expected, contacts_1, contacts_2 = get_diff_distances_and_contacts(new_coords_1, new_coords_2, SPAT_PROX)
+    np.testing.assert_array_equal(revision.diff_dist_mat, expected)
+    np.testing.assert_array_equal(diff_dist_mat, old_diff_dist_mat)
+    assert revision.max_change == np.max(np.abs(expected - old_diff_dist_mat))
+    assert revision.contacts_changed == bool(np.any(contacts_1 != old_contacts_1)
+                                             or np.any(contacts_2 != old_contacts_2))
+    assert 0 < revision.changed_res_indices.shape[0] <= 14
+    assert revision.is_link_mat_invalid
+    np.testing.assert_array_equal(revision.pair.coords_1, new_coords_1)
+    np.testing.assert_array_equal(revision.pair.coords_2, new_coords_2)
+
+
+def test_revise_pair_in_place(rng):
+    coords_1 = make_chain(rng)
+    coords_2 = make_chain(rng)
+    pair = make_pair(coords_1, coords_2)
+    diff_dist_mat = get_diff_distances_and_contacts(coords_1, coords_2, SPAT_PROX)[0]
+    new_coords_2 = coords_2.copy()
+    new_coords_2[[0, NUM_RESIDUES - 1]] += 1.0
+    revision = revise_pair(pair, diff_dist_mat, coords_2=new_coords_2, in_place=True)
+    assert revision.diff_dist_mat is diff_dist_mat
+    np.testing.assert_array_equal(diff_dist_mat, get_diff_distances_and_contacts(coords_1, new_coords_2, SPAT_PROX)[0])
+    assert revision.changed_res_indices.tolist() == [0, NUM_RESIDUES - 1]
+
+
+def test_revise_pair_unchanged(rng):
+    coords_1 = make_chain(rng)
+    coords_2 = make_chain(rng)
+    pair = make_pair(coords_1, coords_2)
+    diff_dist_mat = get_diff_distances_and_contacts(coords_1, coords_2, SPAT_PROX)[0]
+    # Moves within the tolerance are not changes
+    revision = revise_pair(pair, diff_dist_mat, coords_1 + 0.0001, coords_2.copy(), SPAT_PROX)
+    assert not revision.is_link_mat_invalid
+    assert revision.changed_res_indices.shape[0] == 0
+    assert revision.max_change == 0.0
+    assert not revision.contacts_changed
+    np.testing.assert_array_equal(revision.diff_dist_mat, diff_dist_mat)
+
+
+def test_revise_pair_wrong_size(rng):
+    coords = make_chain(rng)
+    pair = make_pair(coords, coords)
+    diff_dist_mat = get_diff_distances_and_contacts(coords, coords, SPAT_PROX)[0]
+    with pytest.raises(ValueError):
+        revise_pair(pair, diff_dist_mat, coords[:-1])
+    with pytest.raises(ValueError):
+        revise_pair(pair, diff_dist_mat[:-1])
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from PdbWriter import AtomRecords, round_coords, format_atom_lines
+"""
+The bulk PDB writer against the ATOM lines written one at a time with str(round(x, 3)).rjust(8).
+"""
+
+NEAR_TIES = [1.0005, 2.6745, -0.0005, 0.0005, -2.6745, 12.3455, 0.1235, -99.9995, 1e-4, -1e-4, 0.0, -0.0]
+
+
+def get_tie_values():
+    # The values halfway between 3-decimal numbers, and the floats on either side of them
+    halves = np.concatenate([np.array(NEAR_TIES), (np.arange(-3000, 3000) + 0.5) / 1000])
+    return np.concatenate([halves, np.nextafter(halves, np.inf), np.nextafter(halves, -np.inf)])
+
+
+def format_atom_line(atom_num, atom_name, res_name, chain_id, res_num, coords):
+    # An ATOM line as the output writers wrote them before the bulk writer
+    x, y, z = [str(round(c, 3)).rjust(8, " ") for c in coords]
+    return (f"ATOM  {str(atom_num).rjust(5, ' ')} {atom_name.ljust(4, ' ')} {res_name.rjust(3, ' ')} "
+            f"{chain_id}{str(res_num).rjust(4, ' ')}    {x}{y}{z}\n")
+
+
+def test_round_coords_near_ties():
+    values = get_tie_values()
+    assert round_coords(values).tolist() == [round(v, 3) for v in values.tolist()]
+
+
+def test_round_coords_random():
+    values = np.random.default_rng(0).uniform(-500, 500, 100000)
+    assert round_coords(values).tolist() == [round(v, 3) for v in values.tolist()]
+
+
+@pytest.mark.parametrize("chain_id", ["A", "B"])
+def test_format_atom_lines(chain_id):
+    values = get_tie_values()
+    coords = values[:values.shape[0] // 3 * 3].reshape(-1, 3)
+    num_atoms = coords.shape[0]
+    atom_names = ["N", "CA", "C", "O", "CB", "OXT"]
+    res_names = ["GLY", "ALA", "TRP", "HOH", "K"]
+    records = AtomRecords([atom_names[i % len(atom_names)] for i in range(num_atoms)],
+                          [res_names[i % len(res_names)] for i in range(num_atoms)],
+                          [i // 4 - 5 for i in range(num_atoms)], coords)
+    expected = "".join(format_atom_line(i + 1, records.atom_names[i], records.res_names[i], chain_id,
+                                        records.res_nums[i], coords[i].tolist()) for i in range(num_atoms))
+    assert format_atom_lines(records, chain_id) == expected
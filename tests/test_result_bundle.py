@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from PdbWriter import AtomRecords
+from ResultBundle import ResultBundle, BundledProtein, encode_nodes, decode_nodes
+"""
+Round trip of the arrays and nodes written to a result bundle, including replacing the results of a parameter set.
+"""
+
+NUM_RESIDUES = 40
+
+
+def make_nodes(rng, num_nodes):
+    # Nodes like MotionTree.nodes, numbered from 0 with the domains as sorted utilised residue indices
+    nodes = {}
+    for i in range(num_nodes):
+        indices = rng.permutation(NUM_RESIDUES)
+        split = int(rng.integers(1, NUM_RESIDUES - 1))
+        nodes[i] = {
+            "magnitude": float(rng.uniform(5, 50)),
+            "large_domain": sorted(indices[:split].tolist()),
+            "small_domain": sorted(indices[split:].tolist())
+        }
+    return nodes
+
+
+def make_link_mat(rng):
+    return np.column_stack([rng.integers(0, NUM_RESIDUES, (NUM_RESIDUES - 1, 2)).astype(np.float64),
+                            rng.uniform(0, 10, NUM_RESIDUES - 1), np.arange(2, NUM_RESIDUES + 1)])
+
+
+def make_atom_records(rng, num_atoms):
+    return AtomRecords(["CA"] * num_atoms, ["GLY"] * num_atoms, list(range(1, num_atoms + 1)),
+                       rng.uniform(-50, 50, (num_atoms, 3)))
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def test_nodes_round_trip(rng):
+    nodes = make_nodes(rng, 6)
+    assert decode_nodes(*encode_nodes(nodes)) == nodes
+
+
+def test_empty_nodes_round_trip():
+    assert decode_nodes(*encode_nodes({})) == {}
+
+
+def test_bundle_round_trip(tmp_path, rng):
+    res_nums_1 = np.arange(NUM_RESIDUES) + 3
+    res_nums_2 = np.arange(NUM_RESIDUES) + 10
+    diff_dist_mat = rng.uniform(0, 5, NUM_RESIDUES * (NUM_RESIDUES - 1) // 2)
+    pdb_models = [("A", make_atom_records(rng, 25)), ("B", make_atom_records(rng, 25))]
+    path = str(tmp_path / "1ake_A_4ake_A.npz")
+    bundle = ResultBundle.create(path, BundledProtein("1ake", "A", res_nums_1), BundledProtein("4ake", "A", res_nums_2),
+                                 False, 1.5, diff_dist_mat, pdb_models)
+
+    link_mat_1, nodes_1 = make_link_mat(rng), make_nodes(rng, 3)
+    link_mat_2, nodes_2 = make_link_mat(rng), make_nodes(rng, 2)
+    bundle.add_results(7.0, 5, 30, 5, link_mat_1, nodes_1, {"time": 1.0})
+    bundle.add_results(8.0, 5, 30, 5, link_mat_2, nodes_2)
+    # Replacing the results of a parameter set copies the bundle without them
+    new_nodes_1 = make_nodes(rng, 4)
+    bundle.add_results(7.0, 5, 30, 5, link_mat_1, new_nodes_1, {"time": 2.0})
+
+    bundle = ResultBundle(path)
+    assert isinstance(bundle.diff_dist_mat, np.memmap)
+    np.testing.assert_array_equal(bundle.diff_dist_mat, diff_dist_mat)
+    protein_1, protein_2 = bundle.get_proteins()
+    np.testing.assert_array_equal(protein_1.res_nums, res_nums_1)
+    np.testing.assert_array_equal(protein_2.res_nums, res_nums_2)
+    assert bundle.meta["rmsd"] == 1.5
+    assert sorted(bundle.get_param_sets()) == [(7.0, 5, 30, 5), (8.0, 5, 30, 5)]
+    np.testing.assert_array_equal(bundle.get_link_mat(7.0, 30), link_mat_1)
+    np.testing.assert_array_equal(bundle.get_link_mat(8.0, 30), link_mat_2)
+    assert bundle.get_nodes(7.0, 5, 30, 5) == new_nodes_1
+    assert bundle.get_nodes(8.0, 5, 30, 5) == nodes_2
+    assert bundle.get_results_meta(7.0, 5, 30, 5)["time"] == 2.0
+    assert len([name for name in bundle.members if name.startswith("nodes/sp_7.0_")]) == 4
+    for (chain_id, records), (expected_chain_id, expected) in zip(bundle.get_pdb_models(), pdb_models):
+        assert chain_id == expected_chain_id
+        assert records.atom_names.tolist() == expected.atom_names
+        assert records.res_names.tolist() == expected.res_names
+        assert records.res_nums.tolist() == expected.res_nums
+        np.testing.assert_array_equal(records.coords, expected.coords)